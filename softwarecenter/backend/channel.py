@@ -37,50 +37,67 @@ class ChannelsManager(object):
     def __init__(self, db, **kwargs):
         self.distro = softwarecenter.distro.get_distro()
         self.db = db
+        self._init_channels_cache()
 
     # public
     @property
     def channels(self):
-        return self._get_channels_from_db()
+        return self._get_cached_channels(False, self._get_channels_from_db)
 
     @property
     def channels_installed_only(self):
-        return self._get_channels_from_db(True)
+        return self._get_cached_channels(True, self._get_channels_from_db)
 
     @classmethod
     def channel_available(kls, channelname):
         pass
 
     # private
-    def _get_channels_from_db(self, installed_only=False):
+    def _init_channels_cache(self):
+        # installed_only -> channels of the database generation
+        self._channels_cache = {}
+        self._channels_cache_generation = None
+
+    def _invalidate_channels_cache(self, *args):
+        self._channels_cache = {}
+
+    def _get_cached_channels(self, installed_only, build_channels):
+        """ return the channels build by build_channels(installed_only),
+            they are only rebuild when the database was reopened or the
+            cache got invalidated
         """
-        (internal) implements 'channels()' and 'channels_installed_only()'
-        properties
+        if self._channels_cache_generation != self.db.generation:
+            self._channels_cache = {}
+            self._channels_cache_generation = self.db.generation
+        channels = self._channels_cache.get(installed_only)
+        if channels is None:
+            channels = build_channels(installed_only=installed_only)
+            self._channels_cache[installed_only] = channels
+        return list(channels)
+
+    def _get_channel_list(self):
+        """ return the (name, origin) of the channels in the database,
+            only the first channel of each origin is used
         """
-        distro_channel_origin = self.distro.get_distro_channel_name()
-
-        # gather the set of software channels and order them
         other_channel_list = []
         cached_origins = []
-        for channel_iter in self.db.xapiandb.allterms("XOL"):
-            if len(channel_iter.term) == 3:
-                continue
-            channel_name = channel_iter.term[3:]
-            channel_origin = ""
-
-            # get origin information for this channel
-            m = self.db.xapiandb.postlist_begin(channel_iter.term)
-            doc = self.db.xapiandb.get_document(m.get_docid())
-            for term_iter in doc.termlist():
-                if (term_iter.term.startswith("XOO") and
-                        len(term_iter.term) > 3):
-                    channel_origin = term_iter.term[3:]
-                    break
+        for (channel_name, channel_origin) in self.db.get_channel_origins():
             LOG.debug("channel_name: %s" % channel_name)
             LOG.debug("channel_origin: %s" % channel_origin)
             if channel_origin not in cached_origins:
                 other_channel_list.append((channel_name, channel_origin))
                 cached_origins.append(channel_origin)
+        return other_channel_list
+
+    def _get_channels_from_db(self, installed_only=False):
+        """
+        (internal) implements 'channels()' and 'channels_installed_only()'
+        properties
+        """
+        distro_channel_origin = self.distro.get_distro_channel_name()
+
+        # gather the set of software channels and order them
+        other_channel_list = self._get_channel_list()
 
         dist_channel = None
         other_channels = []
@@ -44,6 +44,9 @@ class AptChannelsManager(ChannelsManager):
         self.db = db
         self.distro = get_distro()
         self.backend = get_install_backend()
+        self._init_channels_cache()
+        self.backend.connect("channels-changed",
+                             self._invalidate_channels_cache)
         self.backend.connect("channels-changed",
                              self._remove_no_longer_needed_extra_channels)
         # kick off a background check for changes that may have been made
@@ -62,7 +65,7 @@ class AptChannelsManager(ChannelsManager):
             Distribution, Partners, PPAs alphabetically,
             Other channels alphabetically, Unknown channel last
         """
-        return self._get_channels()
+        return self._get_cached_channels(False, self._get_channels)
 
     @property
     def channels_installed_only(self):
@@ -72,13 +75,14 @@ class AptChannelsManager(ChannelsManager):
             Distribution, Partners, PPAs alphabetically,
             Other channels alphabetically, Unknown channel last
         """
-        return self._get_channels(installed_only=True)
+        return self._get_cached_channels(True, self._get_channels)
 
     def feed_in_private_sources_list_entries(self, entries):
         added = False
         for entry in entries:
             added |= self._feed_in_private_sources_list_entry(entry)
         if added:
+            self._invalidate_channels_cache()
             self.backend.emit("channels-changed", True)
 
     def add_channel(self, name, icon, query):
@@ -92,6 +96,7 @@ class AptChannelsManager(ChannelsManager):
                                   channel_icon=icon,
                                   channel_query=query)
         self.extra_channels.append(channel)
+        self._invalidate_channels_cache()
         self.backend.emit("channels-changed", True)
 
         if channel.installed_only:
@@ -145,6 +150,7 @@ class AptChannelsManager(ChannelsManager):
                     self.extra_channels.remove(channel)
                     removed = True
         if removed:
+            self._invalidate_channels_cache()
             self.backend.emit("channels-changed", True)
 
     def _check_for_channel_updates_timer(self):
@@ -181,27 +187,7 @@ class AptChannelsManager(ChannelsManager):
         distro_channel_name = self.distro.get_distro_channel_name()
 
         # gather the set of software channels and order them
-        other_channel_list = []
-        cached_origins = []
-        for channel_iter in self.db.xapiandb.allterms("XOL"):
-            if len(channel_iter.term) == 3:
-                continue
-            channel_name = channel_iter.term[3:]
-            channel_origin = ""
-
-            # get origin information for this channel
-            m = self.db.xapiandb.postlist_begin(channel_iter.term)
-            doc = self.db.xapiandb.get_document(m.get_docid())
-            for term_iter in doc.termlist():
-                if (term_iter.term.startswith("XOO") and
-                      len(term_iter.term) > 3):
-                    channel_origin = term_iter.term[3:]
-                    break
-            self._logger.debug("channel_name: %s" % channel_name)
-            self._logger.debug("channel_origin: %s" % channel_origin)
-            if channel_origin not in cached_origins:
-                other_channel_list.append((channel_name, channel_origin))
-                cached_origins.append(channel_origin)
+        other_channel_list = self._get_channel_list()
 
         dist_channel = None
         partner_channel = None
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import struct
+
+# every frame starts with the payload length as a network order uint32
+FRAME_HEADER = struct.Struct("!I")
+
+
+def pack_frame(payload):
+    """ return the payload with the frame header prepended """
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class FrameReader(object):
+    """ Collects data chunks and splits them into frame payloads.
+
+        The chunks are only joined once a frame is complete so reading
+        a big frame in many small chunks stays linear.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._buffered = 0
+        self._frame_size = None
+
+    def feed(self, chunk):
+        """ add a chunk of data and return the list of payloads of the
+            frames that are complete now
+        """
+        payloads = []
+        if chunk:
+            self._chunks.append(chunk)
+            self._buffered += len(chunk)
+        while True:
+            if self._frame_size is None:
+                if self._buffered < FRAME_HEADER.size:
+                    break
+                data = self._join()
+                (self._frame_size,) = FRAME_HEADER.unpack_from(data)
+                self._set_data(data[FRAME_HEADER.size:])
+            if self._buffered < self._frame_size:
+                break
+            data = self._join()
+            payloads.append(data[:self._frame_size])
+            self._set_data(data[self._frame_size:])
+            self._frame_size = None
+        return payloads
+
+    @property
+    def buffered(self):
+        """ the number of bytes that are not part of a complete frame """
+        return self._buffered
+
+    def get_pending(self):
+        """ return the data of the incomplete frame (without the header)
+            or the data that was fed if it was never framed
+        """
+        data = self._join()
+        if self._frame_size is None:
+            return data
+        return data[:self._frame_size]
+
+    def _join(self):
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    def _set_data(self, data):
+        self._chunks = [data] if data else []
+        self._buffered = len(data)
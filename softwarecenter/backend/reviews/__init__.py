@@ -27,7 +27,7 @@ import struct
 import shutil
 import subprocess
 import time
-import threading
+import xapian
 
 from bsddb import db as bdb
 
@@ -55,6 +55,14 @@ from softwarecenter.paths import (SOFTWARE_CENTER_CACHE_DIR,
 from softwarecenter.enums import ReviewSortMethods
 
 from softwarecenter.backend.spawn_helper import SpawnHelper
+from softwarecenter.backgroundsave import (
+    atomic_pickle_dump,
+    get_background_save_worker,
+)
+from softwarecenter.backend.reviews.stats_store import (
+    FLAG_MISSING_HISTOGRAM,
+    ReviewStatsStore,
+)
 
 LOG = logging.getLogger(__name__)
 
@@ -75,6 +83,104 @@ class ReviewStats(object):
                 self.rating_spread, self.dampened_rating))
 
 
+class ReviewStatsCache(object):
+    """A Application -> ReviewStats mapping backed by a ReviewStatsStore.
+
+    ReviewStats objects are only created on lookup, stats that got
+    updated at runtime are kept in memory until the store is rewritten.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._updated = {}
+
+    def _make_stats(self, pkgname, record):
+        stats = ReviewStats(Application("", pkgname))
+        (stats.ratings_average, stats.ratings_total, stats.rating_spread,
+         stats.dampened_rating) = record
+        return stats
+
+    def get(self, application, default=None):
+        stats = self._updated.get(application.pkgname)
+        if stats is not None:
+            return stats
+        record = self.store.get(application.pkgname)
+        if record is None:
+            return default
+        return self._make_stats(application.pkgname, record)
+
+    def __getitem__(self, application):
+        stats = self.get(application)
+        if stats is None:
+            raise KeyError(application)
+        return stats
+
+    def __setitem__(self, application, stats):
+        self._updated[application.pkgname] = stats
+
+    def __contains__(self, application):
+        return (application.pkgname in self._updated or
+                application.pkgname in self.store)
+
+    def __len__(self):
+        return len(self.store) + len(
+            [pkgname for pkgname in self._updated
+             if pkgname not in self.store])
+
+    def iteritems(self):
+        for (pkgname, record) in self.store.iteritems():
+            if pkgname not in self._updated:
+                yield (Application("", pkgname),
+                       self._make_stats(pkgname, record))
+        for (pkgname, stats) in self._updated.iteritems():
+            yield (Application("", pkgname), stats)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return [app for (app, stats) in self.iteritems()]
+
+    def values(self):
+        return [stats for (app, stats) in self.iteritems()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get_updated(self):
+        """ return a copy of the pkgname -> ReviewStats that are not
+            in the store yet
+        """
+        return dict(self._updated)
+
+    def get_records(self):
+        """ return the (pkgname, record) items for ReviewStatsStore.write()
+            without creating ReviewStats objects for the stored stats
+        """
+        records = [(pkgname, record)
+                   for (pkgname, record) in self.store.iteritems()
+                   if pkgname not in self._updated]
+        records.extend((pkgname, _get_record_from_stats(stats))
+                       for (pkgname, stats) in self._updated.iteritems())
+        return records
+
+
+def _get_record_from_stats(stats):
+    return (stats.ratings_average, stats.ratings_total,
+            getattr(stats, "rating_spread", None),
+            getattr(stats, "dampened_rating", 3.00))
+
+
+def get_review_stats_records(review_stats):
+    """ return the (pkgname, record) items of a Application -> ReviewStats
+        mapping (a dict or a ReviewStatsCache)
+    """
+    if isinstance(review_stats, ReviewStatsCache):
+        return review_stats.get_records()
+    return [(app.pkgname, _get_record_from_stats(stats))
+            for (app, stats) in review_stats.iteritems()]
+
+
 class UsefulnessCache(object):
 
     USEFULNESS_CACHE = {}
@@ -125,14 +231,22 @@ class UsefulnessCache(object):
             LOG.warn("Read usefulness results from server but failed to "
                 "write to cache")
 
-    def save_usefulness_cache_file(self):
+    def save_usefulness_cache_file(self, nonblocking=True):
         """write the dict out to cache file"""
         cachedir = SOFTWARE_CENTER_CACHE_DIR
         try:
             if not os.path.exists(cachedir):
                 os.makedirs(cachedir)
-            pickle.dump(self.USEFULNESS_CACHE,
-                      open(self.USEFULNESS_CACHE_FILE, "w"))
+        except OSError:
+            return False
+        votes = dict(self.USEFULNESS_CACHE)
+        if nonblocking:
+            get_background_save_worker().schedule(
+                self.USEFULNESS_CACHE_FILE,
+                lambda: atomic_pickle_dump(votes, self.USEFULNESS_CACHE_FILE))
+            return True
+        try:
+            atomic_pickle_dump(votes, self.USEFULNESS_CACHE_FILE)
             return True
         except:
             return False
@@ -261,6 +375,8 @@ class ReviewLoader(GObject.GObject):
     # cache the ReviewStats
     REVIEW_STATS_CACHE = {}
     _cache_version_old = False
+    # pkgname -> sortable dampened rating, see get_rating_sort_keys()
+    _rating_sort_keys = None
     _review_sort_methods = ReviewSortMethods.REVIEW_SORT_METHODS
 
     def __init__(self, cache, db, distro=None):
@@ -270,25 +386,47 @@ class ReviewLoader(GObject.GObject):
         self.distro = distro
         if not self.distro:
             self.distro = softwarecenter.distro.get_distro()
-        fname = "%s_%s" % (uri_to_filename(self.distro.REVIEWS_SERVER),
-                           "review-stats-pkgnames.p")
-        self.REVIEW_STATS_CACHE_FILE = os.path.join(SOFTWARE_CENTER_CACHE_DIR,
-                                                    fname)
+        basename = os.path.join(
+            SOFTWARE_CENTER_CACHE_DIR,
+            "%s_%s" % (uri_to_filename(self.distro.REVIEWS_SERVER),
+                       "review-stats-pkgnames"))
+        self.REVIEW_STATS_CACHE_FILE = basename + ".bin"
+        # the pickle of older versions, only read for migration
+        self.REVIEW_STATS_PICKLE_FILE = basename + ".p"
+        # unity reads this file, so keep its name stable
         self.REVIEW_STATS_BSDDB_FILE = "%s__%s.%s.db" % (
-            self.REVIEW_STATS_CACHE_FILE,
+            self.REVIEW_STATS_PICKLE_FILE,
             bdb.DB_VERSION_MAJOR,
             bdb.DB_VERSION_MINOR)
 
         self.language = get_languages()[0]
-        if os.path.exists(self.REVIEW_STATS_CACHE_FILE):
-            try:
-                self.REVIEW_STATS_CACHE = pickle.load(
-                    open(self.REVIEW_STATS_CACHE_FILE))
-                self._cache_version_old = self._missing_histogram_in_cache()
-            except:
-                LOG.exception("review stats cache load failure")
-                os.rename(self.REVIEW_STATS_CACHE_FILE,
-                    self.REVIEW_STATS_CACHE_FILE + ".fail")
+        if (not os.path.exists(self.REVIEW_STATS_CACHE_FILE) and
+                os.path.exists(self.REVIEW_STATS_PICKLE_FILE)):
+            self._migrate_review_stats_pickle()
+        self._review_stats_store = ReviewStatsStore(
+            self.REVIEW_STATS_CACHE_FILE)
+        self.REVIEW_STATS_CACHE = ReviewStatsCache(self._review_stats_store)
+        self._cache_version_old = bool(
+            self._review_stats_store.flags & FLAG_MISSING_HISTOGRAM)
+
+    def _migrate_review_stats_pickle(self):
+        """ one time import of the review stats pickle of older versions
+            into the compact store
+        """
+        try:
+            review_stats = pickle.load(open(self.REVIEW_STATS_PICKLE_FILE))
+            self.REVIEW_STATS_CACHE = review_stats
+            flags = 0
+            if self._missing_histogram_in_cache():
+                flags |= FLAG_MISSING_HISTOGRAM
+            ReviewStatsStore.write(self.REVIEW_STATS_CACHE_FILE,
+                                   get_review_stats_records(review_stats),
+                                   flags)
+            os.remove(self.REVIEW_STATS_PICKLE_FILE)
+        except:
+            LOG.exception("review stats cache migration failure")
+            os.rename(self.REVIEW_STATS_PICKLE_FILE,
+                self.REVIEW_STATS_PICKLE_FILE + ".fail")
 
     def _missing_histogram_in_cache(self):
         '''iterate through review stats to see if it has been fully reloaded
@@ -310,6 +448,19 @@ class ReviewLoader(GObject.GObject):
     def update_review_stats(self, translated_application, stats):
         application = Application("", translated_application.pkgname)
         self.REVIEW_STATS_CACHE[application] = stats
+        self._rating_sort_keys = None
+
+    def get_rating_sort_keys(self):
+        """ return a dict of pkgname -> xapian sortable dampened rating
+            that is used for sorting by top rated, it is rebuilt after
+            the review stats changed
+        """
+        if self._rating_sort_keys is None:
+            self._rating_sort_keys = dict(
+                (pkgname, xapian.sortable_serialise(record[3]))
+                for (pkgname, record) in get_review_stats_records(
+                    self.REVIEW_STATS_CACHE))
+        return self._rating_sort_keys
 
     def get_review_stats(self, translated_application):
         """return a ReviewStats (number of reviews, rating)
@@ -319,8 +470,7 @@ class ReviewLoader(GObject.GObject):
         # check cache
         try:
             application = Application("", translated_application.pkgname)
-            if application in self.REVIEW_STATS_CACHE:
-                return self.REVIEW_STATS_CACHE[application]
+            return self.REVIEW_STATS_CACHE.get(application)
         except ValueError:
             pass
 
@@ -333,21 +483,51 @@ class ReviewLoader(GObject.GObject):
         cachedir = SOFTWARE_CENTER_CACHE_DIR
         if not os.path.exists(cachedir):
             os.makedirs(cachedir)
-        # write out the stats
+        # take a snapshot in the main thread, the writing is done by the
+        # background save worker
+        records = get_review_stats_records(self.REVIEW_STATS_CACHE)
+        saved = self._get_review_stats_in_memory()
+        flags = 0
+        if self._cache_version_old:
+            flags |= FLAG_MISSING_HISTOGRAM
         if nonblocking:
-            t = threading.Thread(target=self._save_review_stats_cache_blocking)
-            t.run()
+            def save():
+                self._save_review_stats_cache_blocking(records, flags)
+                GLib.idle_add(self._on_review_stats_cache_saved, saved)
+            get_background_save_worker().schedule(
+                self.REVIEW_STATS_CACHE_FILE, save)
         else:
-            self._save_review_stats_cache_blocking()
+            self._save_review_stats_cache_blocking(records, flags)
+            self._on_review_stats_cache_saved(saved)
+
+    def _get_review_stats_in_memory(self):
+        """ return the pkgname -> ReviewStats that are not in the store """
+        if isinstance(self.REVIEW_STATS_CACHE, ReviewStatsCache):
+            return self.REVIEW_STATS_CACHE.get_updated()
+        return dict((app.pkgname, stats)
+                    for (app, stats) in self.REVIEW_STATS_CACHE.iteritems())
+
+    def _on_review_stats_cache_saved(self, saved):
+        """ switch the cache over to the new store file, stats that got
+            updated after the save was requested stay in memory
+        """
+        current = self._get_review_stats_in_memory()
+        self._review_stats_store.open()
+        cache = ReviewStatsCache(self._review_stats_store)
+        for (pkgname, stats) in current.iteritems():
+            if saved.get(pkgname) is not stats:
+                cache[Application("", pkgname)] = stats
+        self.REVIEW_STATS_CACHE = cache
+        return False
 
-    def _save_review_stats_cache_blocking(self):
-        # dump out for software-center in simple pickle
-        self._dump_pickle_for_sc()
+    def _save_review_stats_cache_blocking(self, records, flags=0):
+        # dump out for software-center in the compact store
+        ReviewStatsStore.write(self.REVIEW_STATS_CACHE_FILE, records, flags)
         # dump out in c-friendly dbm format for unity
         try:
             outfile = self.REVIEW_STATS_BSDDB_FILE
             outdir = self.REVIEW_STATS_BSDDB_FILE + ".dbenv/"
-            self._dump_bsddbm_for_unity(outfile, outdir)
+            self._dump_bsddbm_for_unity(outfile, outdir, records)
         except (bdb.DBError, MemoryError) as e:
             # see bug #858437, db corruption seems to be rather common
             # on ecryptfs
@@ -355,18 +535,13 @@ class ReviewLoader(GObject.GObject):
             LOG.warn("error creating bsddb: '%s' (corrupted?)" % e)
             try:
                 shutil.rmtree(outdir)
-                self._dump_bsddbm_for_unity(outfile, outdir)
+                self._dump_bsddbm_for_unity(outfile, outdir, records)
             except:
                 LOG.exception("trying to repair DB failed")
 
-    def _dump_pickle_for_sc(self):
-        """ write out the full REVIEWS_STATS_CACHE as a pickle """
-        pickle.dump(self.REVIEW_STATS_CACHE,
-                      open(self.REVIEW_STATS_CACHE_FILE, "w"))
-
-    def _dump_bsddbm_for_unity(self, outfile, outdir):
-        """ write out the subset that unity needs of the REVIEW_STATS_CACHE
-            as a C friendly (using struct) bsddb
+    def _dump_bsddbm_for_unity(self, outfile, outdir, records):
+        """ write out the subset that unity needs of the review stats
+            records as a C friendly (using struct) bsddb
         """
         env = bdb.DBEnv()
         if not os.path.exists(outdir):
@@ -380,12 +555,13 @@ class ReviewLoader(GObject.GObject):
                 dbtype=bdb.DB_HASH,
                 mode=0600,
                 flags=bdb.DB_CREATE)
-        for (app, stats) in self.REVIEW_STATS_CACHE.iteritems():
+        for (pkgname, (ratings_average, ratings_total, rating_spread,
+                       dampened_rating)) in records:
             # pkgname is ascii by policy, so its fine to use str() here
-            db[str(app.pkgname)] = struct.pack('iii',
-                                               stats.ratings_average or 0,
-                                               stats.ratings_total,
-                                               stats.dampened_rating)
+            db[str(pkgname)] = struct.pack('iii',
+                                           ratings_average or 0,
+                                           ratings_total,
+                                           dampened_rating)
         db.close()
         env.close()
 
@@ -524,6 +700,10 @@ class ReviewLoaderFake(ReviewLoader):
         reviews = self._reviews_cache[application]
         self.emit("get-reviews-finished", application, reviews)
 
+    def get_rating_sort_keys(self):
+        # the stats are made up on demand in get_review_stats()
+        return None
+
     def get_review_stats(self, application):
         if not application in self._review_stats_cache:
             stat = ReviewStats(application)
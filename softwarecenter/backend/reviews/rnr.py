@@ -164,7 +164,9 @@ class ReviewLoaderSpawningRNRClient(ReviewLoader):
         if self._cache_version_old and self._server_has_histogram(
                 piston_review_stats):
             self.REVIEW_STATS_CACHE = {}
-            self.save_review_stats_cache_file()
+            self._cache_version_old = False
+            # the refresh below needs the new file mtime
+            self.save_review_stats_cache_file(nonblocking=False)
             self.refresh_review_stats()
             return
 
@@ -180,6 +182,7 @@ class ReviewLoaderSpawningRNRClient(ReviewLoader):
             s.dampened_rating = calc_dr(s.rating_spread)
             review_stats[s.app] = s
         self.REVIEW_STATS_CACHE = review_stats
+        self._rating_sort_keys = None
         self.emit("refresh-review-stats-finished", review_stats)
         self.save_review_stats_cache_file()
 
@@ -0,0 +1,169 @@
+# Copyright (C) 2012 Canonical
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import mmap
+import os
+import struct
+
+from softwarecenter.backgroundsave import atomic_write
+
+LOG = logging.getLogger(__name__)
+
+# The file layout is:
+#   header:  magic, format version, flags, number of records
+#   index:   (name offset, name length) per record, sorted by pkgname
+#   records: ratings average, ratings total, 5 bucket histogram and
+#            dampened rating per record, in the same order as the index
+#   names:   the concatenated (ascii) pkgnames
+MAGIC = "SCRS"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sIII")
+INDEX_ENTRY = struct.Struct("<II")
+RECORD = struct.Struct("<dI5Id")
+
+# the stats were migrated from a cache that had no rating histograms
+FLAG_MISSING_HISTOGRAM = 1 << 0
+
+# a ratings average of None is stored as NaN
+_NO_AVERAGE = float("nan")
+
+
+class ReviewStatsStore(object):
+    """A read-only view on a compact binary review stats file.
+
+    The file is memory mapped and looked up with a binary search over
+    the sorted pkgname index so that opening it is O(1) and no python
+    objects are created for packages that are never looked up.
+    Records are returned as (ratings_average, ratings_total,
+    rating_spread, dampened_rating) tuples.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.flags = 0
+        self._mmap = None
+        self._count = 0
+        self._index_offset = HEADER.size
+        self._records_offset = HEADER.size
+        self.open()
+
+    def open(self):
+        """(Re)open the file, e.g. after it got replaced by write()."""
+        self.close()
+        try:
+            f = open(self.path, "rb")
+        except IOError:
+            return
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                return
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        (magic, version, flags, count) = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            LOG.warn("ignoring review stats file %r with unknown format",
+                     self.path)
+            buf.close()
+            return
+        self._mmap = buf
+        self.flags = flags
+        self._count = count
+        self._records_offset = (HEADER.size + count * INDEX_ENTRY.size)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._mmap = None
+        self.flags = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _name_at(self, i):
+        (offset, length) = INDEX_ENTRY.unpack_from(
+            self._mmap, self._index_offset + i * INDEX_ENTRY.size)
+        return self._mmap[offset:offset + length]
+
+    def _record_at(self, i):
+        values = RECORD.unpack_from(
+            self._mmap, self._records_offset + i * RECORD.size)
+        average = values[0]
+        # NaN is the only value that is not equal to itself
+        if average != average:
+            average = None
+        return (average, values[1], list(values[2:7]), values[7])
+
+    def _find(self, pkgname):
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name_at(mid) < pkgname:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._name_at(lo) == pkgname:
+            return lo
+        return -1
+
+    def get(self, pkgname):
+        """Return the record tuple for pkgname or None."""
+        if self._mmap is None:
+            return None
+        i = self._find(str(pkgname))
+        if i < 0:
+            return None
+        return self._record_at(i)
+
+    def __contains__(self, pkgname):
+        return self._mmap is not None and self._find(str(pkgname)) >= 0
+
+    def iteritems(self):
+        """Iterate over (pkgname, record tuple) in pkgname order."""
+        for i in range(self._count):
+            yield (self._name_at(i), self._record_at(i))
+
+    @classmethod
+    def write(cls, path, items, flags=0):
+        """Write (pkgname, record tuple) items to path atomically."""
+        # pkgname is ascii by policy, so its fine to use str() here
+        items = sorted((str(pkgname), record) for (pkgname, record) in items)
+        count = len(items)
+        names_offset = (HEADER.size + count * INDEX_ENTRY.size +
+                        count * RECORD.size)
+        index = []
+        records = []
+        names = []
+        offset = names_offset
+        for (pkgname, (average, total, spread, dampened)) in items:
+            index.append(INDEX_ENTRY.pack(offset, len(pkgname)))
+            if average is None:
+                average = _NO_AVERAGE
+            spread = [int(s) for s in (list(spread or []) + [0] * 5)[:5]]
+            records.append(RECORD.pack(float(average), int(total),
+                                       *(spread + [float(dampened)])))
+            names.append(pkgname)
+            offset += len(pkgname)
+
+        def write_func(f):
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, flags, count))
+            f.write("".join(index))
+            f.write("".join(records))
+            f.write("".join(names))
+        atomic_write(path, write_func)
@@ -22,11 +22,18 @@ try:
 except ImportError:
     import pickle
 
+import errno
+import fcntl
+import itertools
 import logging
 import os
 import json
+import socket
+import subprocess
+import threading
 
 import softwarecenter.paths
+from softwarecenter.backend.framing import FrameReader, pack_frame
 from softwarecenter.paths import PistonHelpers
 
 from gi import version_info as gi_version
@@ -34,6 +41,206 @@ from gi.repository import GObject, GLib
 
 LOG = logging.getLogger(__name__)
 
+# replies that are bigger than this are deserialized in a thread
+DESERIALIZE_IN_THREAD_SIZE = 64 * 1024
+
+# the bytes read from the daemon socket per main loop iteration
+DAEMON_READ_SIZE = 256 * 1024
+
+
+class PistonHelperDaemon(object):
+    """ A long running piston_generic_helper.py that serves the
+        run_generic_piston_helper() calls of all SpawnHelpers.
+
+        Requests and replies are pickled dicts in length prefixed frames
+        on a socketpair, the replies are matched to the waiting
+        SpawnHelper by the request id so calls can overlap. Big replies
+        are deserialized in a thread, like the replies of a spawned
+        helper. If the daemon dies the waiting calls are redone with a
+        helper per call.
+    """
+
+    def __init__(self):
+        self._sock = None
+        self._proc = None
+        self._io_watch = None
+        self._reader = None
+        self._pending = {}
+        # the number of replies that are deserialized in a thread
+        self._nr_deserializing = 0
+        self._ids = itertools.count(1)
+        # set once starting the daemon failed or it died
+        self.failed = False
+
+    @property
+    def running(self):
+        return self._sock is not None
+
+    def _spawn_daemon(self, child_sock):
+        binary = os.path.join(
+            softwarecenter.paths.datadir, PistonHelpers.GENERIC_HELPER)
+        # the socket is the stdin of the daemon, all other fds of the
+        # parent are closed
+        cmd = [binary, "--datadir", softwarecenter.paths.datadir,
+               "--daemon", "0"]
+        LOG.debug("starting piston helper daemon: '%s'" % cmd)
+        return subprocess.Popen(cmd, stdin=child_sock.fileno(),
+                                close_fds=True)
+
+    def start(self):
+        if self.running:
+            return True
+        if self.failed:
+            return False
+        (sock, child_sock) = socket.socketpair()
+        # other helpers must not inherit our end of the socket
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        try:
+            self._proc = self._spawn_daemon(child_sock)
+        except (OSError, ValueError) as e:
+            LOG.warn("can not start piston helper daemon: %s" % e)
+            sock.close()
+            self.failed = True
+            return False
+        finally:
+            child_sock.close()
+        sock.setblocking(False)
+        self._sock = sock
+        self._reader = FrameReader()
+        self._io_watch = GLib.io_add_watch(
+            sock.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._on_io)
+        return True
+
+    def call(self, spawn_helper, request):
+        """ send the request dict, the reply is passed to
+            spawn_helper._on_daemon_reply(); returns False if the daemon
+            is not available
+        """
+        if not self.start():
+            return False
+        request_id = next(self._ids)
+        payload = pickle.dumps(dict(request, id=request_id),
+                               pickle.HIGHEST_PROTOCOL)
+        try:
+            self._sock.setblocking(True)
+            self._sock.sendall(pack_frame(payload))
+            self._sock.setblocking(False)
+        except socket.error as e:
+            LOG.warn("piston helper daemon went away: %s" % e)
+            self._shutdown()
+            return False
+        self._pending[request_id] = (spawn_helper, request)
+        return True
+
+    def _on_io(self, source, condition):
+        nr_read = 0
+        while nr_read < DAEMON_READ_SIZE:
+            try:
+                chunk = self._sock.recv(64 * 1024)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # no more data for now
+                    break
+                chunk = ""
+            if not chunk:
+                LOG.warn("piston helper daemon exited")
+                self._shutdown()
+                return False
+            nr_read += len(chunk)
+            for payload in self._reader.feed(chunk):
+                self._on_reply(payload)
+            if not self.running:
+                return False
+        else:
+            # do not block the main loop, the rest is read in the next
+            # iteration
+            return True
+        if condition & (GLib.IO_HUP | GLib.IO_ERR):
+            self._shutdown()
+            return False
+        return True
+
+    def _on_reply(self, payload):
+        if len(payload) < DESERIALIZE_IN_THREAD_SIZE:
+            self._dispatch(pickle.loads(payload))
+            return
+        # do not freeze the UI while unpickling big replies (e.g. the
+        # review stats)
+        self._nr_deserializing += 1
+
+        def deserialize():
+            try:
+                response = pickle.loads(payload)
+            except:
+                LOG.exception("can not load reply of piston helper daemon")
+                response = None
+            GLib.idle_add(self._on_deserialized, response)
+        t = threading.Thread(target=deserialize,
+                             name="PistonHelperDaemonDeserialize")
+        t.daemon = True
+        t.start()
+
+    def _on_deserialized(self, response):
+        self._nr_deserializing -= 1
+        if response is not None:
+            self._dispatch(response)
+        # the daemon went away while the reply was deserialized
+        if not self.running and not self._nr_deserializing:
+            self._redo_pending()
+        return False
+
+    def _dispatch(self, response):
+        (spawn_helper, request) = self._pending.pop(
+            response["id"], (None, None))
+        if spawn_helper is None:
+            LOG.warn("unexpected reply from piston helper daemon")
+            return
+        spawn_helper._on_daemon_reply(response)
+
+    def _shutdown(self):
+        """ stop using the daemon and redo the pending calls with a
+            helper per call
+        """
+        self.failed = True
+        if self._io_watch:
+            GLib.source_remove(self._io_watch)
+            self._io_watch = None
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+        if self._proc and self._proc.poll() is None:
+            self._proc.terminate()
+        # the replies that are still deserialized may answer some of the
+        # pending calls
+        if not self._nr_deserializing:
+            self._redo_pending()
+
+    def _redo_pending(self):
+        pending = self._pending
+        self._pending = {}
+        for (spawn_helper, request) in pending.values():
+            spawn_helper._run_generic_piston_helper_spawned(**request)
+
+    def stop(self):
+        self._shutdown()
+        self.failed = False
+
+
+_piston_helper_daemon = None
+
+
+def get_piston_helper_daemon():
+    """ return the shared PistonHelperDaemon or None if it is disabled
+        with SOFTWARE_CENTER_DISABLE_PISTON_HELPER_DAEMON
+    """
+    global _piston_helper_daemon
+    if "SOFTWARE_CENTER_DISABLE_PISTON_HELPER_DAEMON" in os.environ:
+        return None
+    if _piston_helper_daemon is None:
+        _piston_helper_daemon = PistonHelperDaemon()
+    return _piston_helper_daemon
+
 
 class SpawnHelper(GObject.GObject):
 
@@ -60,12 +267,42 @@ class SpawnHelper(GObject.GObject):
         self._io_watch = None
         self._child_watch = None
         self._cmd = None
+        # the output of the helper, see _helper_io_ready()
+        self._chunks = []
+        self._frame_reader = None
+        self._reading = False
+        self._finished_status = None
+        # set if a framed helper exited without a complete reply
+        self._reply_missing = False
+        # the helper writes its reply as a single frame
+        self.framed = False
         self.needs_auth = False
         self.no_relogin = False
         self.ignore_cache = False
         self.parent_xid = None
 
     def run_generic_piston_helper(self, klass, func, **kwargs):
+        # only useful for debugging
+        if "SOFTWARE_CENTER_DISABLE_SPAWN_HELPER" in os.environ:
+            return
+        daemon = get_piston_helper_daemon()
+        # the daemon always replies with the unpickled objects
+        if daemon and self._expect_format == "pickle":
+            request = {"klass": klass,
+                       "func": func,
+                       "kwargs": kwargs,
+                       "needs_auth": self.needs_auth,
+                       "no_relogin": self.no_relogin,
+                       "parent_xid": self.parent_xid or 0,
+                       "ignore_cache": self.ignore_cache,
+                       }
+            if daemon.call(self, request):
+                LOG.debug("run_generic_piston_helper() via daemon")
+                return
+        self._run_generic_piston_helper_spawned(klass, func, kwargs)
+
+    def _run_generic_piston_helper_spawned(self, klass, func, kwargs,
+                                           **ignored):
         binary = os.path.join(
             softwarecenter.paths.datadir, PistonHelpers.GENERIC_HELPER)
         cmd = [binary]
@@ -82,8 +319,14 @@ class SpawnHelper(GObject.GObject):
         cmd += [klass, func]
         if kwargs:
             cmd.append(json.dumps(kwargs))
+        cmd.append("--framed")
         LOG.debug("run_generic_piston_helper()")
-        self.run(cmd)
+        # only this call is framed, run() may be used for other helpers
+        self.framed = True
+        try:
+            self.run(cmd)
+        finally:
+            self.framed = False
 
     def run(self, cmd):
         # only useful for debugging
@@ -94,26 +337,59 @@ class SpawnHelper(GObject.GObject):
             cmd, flags=GObject.SPAWN_DO_NOT_REAP_CHILD,
             standard_output=True, standard_error=True)
         LOG.debug("running: '%s' as pid: '%s'" % (cmd, pid))
+        flags = fcntl.fcntl(stdout, fcntl.F_GETFL)
+        fcntl.fcntl(stdout, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._chunks = []
+        self._frame_reader = FrameReader() if self.framed else None
+        self._reading = True
+        self._finished_status = None
+        self._reply_missing = False
         # python-gobject >= 3.7.3 has changed some API in incompatible
         # ways, so we need to check the version for which one to use.
         if gi_version < (3, 7, 3):
             self._child_watch = GLib.child_watch_add(
                 pid, self._helper_finished, (stdout, stderr))
             self._io_watch = GLib.io_add_watch(
-                stdout, GObject.IO_IN, self._helper_io_ready, (stdout, ))
+                stdout, GObject.IO_IN | GObject.IO_HUP,
+                self._helper_io_ready, (stdout, ))
         else:
             self._child_watch = GLib.child_watch_add(
                 GLib.PRIORITY_DEFAULT, pid, self._helper_finished,
                 data=(stdout, stderr))
             self._io_watch = GLib.io_add_watch(
-                stdout, GLib.PRIORITY_DEFAULT, GObject.IO_IN,
+                stdout, GLib.PRIORITY_DEFAULT, GObject.IO_IN | GObject.IO_HUP,
                 self._helper_io_ready, (stdout, ))
 
+    def _on_daemon_reply(self, response):
+        """ emit the same signals for a daemon reply as for a helper
+            that was spawned for this call
+        """
+        if "error" in response:
+            LOG.warn("got error from helper: '%s'" % response["error"])
+            self._stderr = response["error"]
+            self.emit("error", response["error"])
+            return
+        data = response["data"]
+        LOG.debug("got data for daemon call: '%s'" % data)
+        self.emit("data-available", data)
+        self.emit("exited", 0)
+
     def _helper_finished(self, pid, status, (stdout, stderr)):
         LOG.debug("helper_finished: '%s' '%s'" % (pid, status))
+        if self._child_watch:
+            GLib.source_remove(self._child_watch)
+            self._child_watch = None
+        if self._reading:
+            # make sure "data-available" is emitted before "exited" or
+            # "error", the rest of the output is still being read
+            self._finished_status = (status, stderr)
+            return
+        self._emit_finished(status, stderr)
+
+    def _emit_finished(self, status, stderr):
         # get status code
         res = os.WEXITSTATUS(status)
-        if res == 0:
+        if res == 0 and not self._reply_missing:
             self.emit("exited", res)
         else:
             LOG.warn("exit code %s from helper for '%s'" % (res, self._cmd))
@@ -123,24 +399,71 @@ class SpawnHelper(GObject.GObject):
             if err:
                 LOG.warn("got error from helper: '%s'" % err)
             self.emit("error", err)
-            os.close(stderr)
-        if self._io_watch:
-            # remove with a delay timeout delay to ensure that any
-            # pending data is still flushed
-            GLib.timeout_add(100, GLib.source_remove, self._io_watch)
-        if self._child_watch:
-            GLib.source_remove(self._child_watch)
+        os.close(stderr)
 
     def _helper_io_ready(self, source, condition, (stdout,)):
-        # read the raw data
-        data = ""
+        """ read the available output without blocking, the chunks are
+            only joined once the reply is complete
+        """
+        eof = False
         while True:
-            s = os.read(stdout, 1024)
-            if not s:
+            try:
+                chunk = os.read(stdout, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not chunk:
+                eof = True
                 break
-            data += s
+            if self._frame_reader:
+                payloads = self._frame_reader.feed(chunk)
+                if payloads:
+                    self._reply_complete(stdout, payloads[0])
+                    return False
+            else:
+                self._chunks.append(chunk)
+        if not eof:
+            return True
+        data = "".join(self._chunks)
+        if self._frame_reader or not data:
+            # the helper exited without a (complete) reply, there is
+            # nothing to emit but the exit status
+            if self._frame_reader:
+                LOG.warn("no complete reply from helper for '%s'" % self._cmd)
+                self._reply_missing = True
+            self._close_stdout(stdout)
+            self._reading = False
+            if self._finished_status:
+                self._emit_finished(*self._finished_status)
+                self._finished_status = None
+            return False
+        self._reply_complete(stdout, data)
+        return False
+
+    def _close_stdout(self, stdout):
         os.close(stdout)
+        self._io_watch = None
+        self._chunks = []
+        self._frame_reader = None
+
+    def _reply_complete(self, stdout, data):
+        self._close_stdout(stdout)
         self._stdout = data
+        if len(data) < DESERIALIZE_IN_THREAD_SIZE:
+            self._emit_data(self._deserialize(data))
+            return
+        # do not freeze the UI while unpickling big replies
+
+        def deserialize():
+            result = self._deserialize(data)
+            GLib.idle_add(self._emit_data, result)
+        t = threading.Thread(target=deserialize,
+                             name="SpawnHelperDeserialize")
+        t.daemon = True
+        t.start()
+
+    def _deserialize(self, data):
         if self._expect_format == "pickle":
             # unpickle it, we should *always* get valid data here, so if
             # we don't this should raise a error
@@ -157,6 +480,13 @@ class SpawnHelper(GObject.GObject):
             pass
         else:
             LOG.error("unknown format: '%s'", self._expect_format)
+        return data
+
+    def _emit_data(self, data):
         LOG.debug("got data for cmd: '%s'='%s'" % (self._cmd, data))
         self.emit("data-available", data)
+        self._reading = False
+        if self._finished_status:
+            self._emit_finished(*self._finished_status)
+            self._finished_status = None
         return False
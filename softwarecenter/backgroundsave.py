@@ -0,0 +1,139 @@
+# Copyright (C) 2012 Canonical
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import atexit
+import logging
+import os
+import tempfile
+import threading
+import time
+
+# py3 compat
+try:
+    import cPickle as pickle
+    pickle  # pyflakes
+except ImportError:
+    import pickle
+
+LOG = logging.getLogger(__name__)
+
+
+def atomic_write(path, write_func):
+    """Call write_func(fileobj) on a temp file next to path and rename
+    it over path once it was fully written.
+    """
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    (fd, tmp) = tempfile.mkstemp(prefix=os.path.basename(path) + ".",
+                                 dir=dirname or ".")
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            write_func(f)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def atomic_pickle_dump(obj, path):
+    """Pickle obj to path atomically."""
+    atomic_write(path, lambda f: pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL))
+
+
+class BackgroundSaveWorker(object):
+    """Runs save functions in a single background thread.
+
+    Save requests are keyed (usually by the filename) and a request that
+    is still pending is replaced by a newer one for the same key, so a
+    burst of changes results in a single write. The time each save took
+    is available in `save_durations`.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = {}
+        # keys in the order they were first requested
+        self._order = []
+        self._busy = False
+        self._thread = None
+        self.save_durations = {}
+
+    def schedule(self, key, save_func):
+        """Run save_func() in the background, replacing a pending
+        request for the same key.
+        """
+        with self._cond:
+            if key not in self._pending:
+                self._order.append(key)
+            self._pending[key] = save_func
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="BackgroundSaveWorker")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._order:
+                    self._cond.wait()
+                key = self._order.pop(0)
+                save_func = self._pending.pop(key)
+                self._busy = True
+            start = time.time()
+            try:
+                save_func()
+            except:
+                LOG.exception("saving %r failed", key)
+            duration = time.time() - start
+            LOG.debug("saving %r took %.3fs", key, duration)
+            with self._cond:
+                self.save_durations[key] = duration
+                self._busy = False
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until all pending saves are written, returns False if
+        they are not done after timeout seconds.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._cond:
+            while self._order or self._busy:
+                if timeout is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+
+_background_save_worker = None
+
+
+def get_background_save_worker():
+    """Return the BackgroundSaveWorker that is flushed on exit."""
+    global _background_save_worker
+    if _background_save_worker is None:
+        _background_save_worker = BackgroundSaveWorker()
+        atexit.register(_background_save_worker.flush)
+    return _background_save_worker
@@ -1,6 +1,5 @@
 import xapian
 
-from softwarecenter.distro import get_distro
 from softwarecenter.enums import (XapianValues,
                                   AVAILABLE_FOR_PURCHASE_MAGIC_CHANNEL_NAME,
                                   )
@@ -22,10 +21,12 @@ class AppFilter(xapian.MatchDecider):
     Filter that can be hooked into xapian get_mset to filter for criteria that
     are based around the package details that are not listed in xapian
     (like installed_only) or archive section
+
+    The pkgname of the document is checked against the precomputed
+    pkgname sets of the database instead of the apt cache.
     """
     def __init__(self, db, cache):
         xapian.MatchDecider.__init__(self)
-        self.distro = get_distro()
         self.db = db
         self.cache = cache
         self.available_only = False
@@ -76,30 +77,37 @@ class AppFilter(xapian.MatchDecider):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def get_cache_key(self):
+        """ return a hashable value that describes the filter state """
+        restricted_list = self.restricted_list
+        if restricted_list is not False:
+            restricted_list = frozenset(restricted_list)
+        return (self.available_only,
+                global_filter.supported_only,
+                self.installed_only,
+                self.not_installed_only,
+                restricted_list)
+
     def __call__(self, doc):
         """return True if the package should be displayed"""
-        # get pkgname from document
+        # the pkgname is used and not doc.get_docid() as that is the docid
+        # in the sub-database for documents of a-x-i or the agent db
         pkgname = self.db.get_pkgname(doc)
-        #logging.debug(
-        #    "filter: supported_only: %s installed_only: %s '%s'" % (
-        #        self.supported_only, self.installed_only, pkgname))
         if self.available_only:
             # an item is considered available if it is either found
             # in the cache or is available for purchase
-            if (not pkgname in self.cache and
+            if (not pkgname in self.db.get_filter_pkgnames("available") and
                 not doc.get_value(XapianValues.ARCHIVE_CHANNEL) ==
                     AVAILABLE_FOR_PURCHASE_MAGIC_CHANNEL_NAME):
                 return False
         if self.installed_only:
-            if (not pkgname in self.cache or
-                    not self.cache[pkgname].is_installed):
+            if not pkgname in self.db.get_filter_pkgnames("installed"):
                 return False
         if self.not_installed_only:
-            if (pkgname in self.cache and
-                    self.cache[pkgname].is_installed):
+            if pkgname in self.db.get_filter_pkgnames("installed"):
                 return False
         if global_filter.supported_only:
-            if not self.distro.is_supported(self.cache, doc, pkgname):
+            if not pkgname in self.db.get_filter_pkgnames("supported"):
                 return False
         if self.restricted_list is not False:  # keep != False as the set can
                                                # be empty
@@ -0,0 +1,108 @@
+# Copyright (C) 2013 Canonical
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from collections import namedtuple
+
+from softwarecenter.db.application import Application
+from softwarecenter.enums import XapianValues
+
+# prices of apps that are not for sale
+FREE_AS_IN_BEER = ("0.00", "")
+
+_AppRowFields = namedtuple("_AppRowFields", (
+    "docid",
+    "pkgname",
+    "appname",
+    "display_name",
+    "display_summary",
+    "iconname",
+    "icon_url",
+    "price",
+    "categories",
+    "state",
+))
+
+
+class AppRow(_AppRowFields):
+    """ A compact and immutable record with everything that is needed to
+        display a document in a list, see make_app_row()
+    """
+
+    __slots__ = ()
+
+    # bits of the state field
+    AVAILABLE = 1
+    INSTALLED = 2
+    PURCHASABLE = 4
+
+    @property
+    def is_available(self):
+        return bool(self.state & self.AVAILABLE)
+
+    @property
+    def is_installed(self):
+        return bool(self.state & self.INSTALLED)
+
+    @property
+    def is_purchasable(self):
+        return bool(self.state & self.PURCHASABLE)
+
+    def get_application(self):
+        return Application(self.appname, self.pkgname, self.iconname)
+
+
+def get_app_state(cache, pkgname, price):
+    """ return the AppRow state bits of pkgname """
+    state = 0
+    if price not in FREE_AS_IN_BEER:
+        state |= AppRow.PURCHASABLE | AppRow.AVAILABLE
+    if pkgname in cache:
+        pkg = cache[pkgname]
+        # compare here instead of keeping the .candidate to avoid
+        # leaking candidates
+        if pkg.candidate is not None:
+            state |= AppRow.AVAILABLE
+        if state & AppRow.AVAILABLE and pkg.is_installed:
+            state |= AppRow.INSTALLED
+    return state
+
+
+def make_app_row(db, cache, doc):
+    """ return the AppRow for the given xapian.Document """
+    pkgname = db.get_pkgname(doc)
+    price = doc.get_value(XapianValues.PRICE)
+    return AppRow(
+        doc.get_docid(),
+        pkgname,
+        db.get_appname(doc),
+        Application.get_display_name(db, doc),
+        Application.get_display_summary(db, doc),
+        db.get_iconname(doc),
+        db.get_icon_download_url(doc),
+        price,
+        doc.get_value(XapianValues.CATEGORIES),
+        get_app_state(cache, pkgname, price))
+
+
+def get_app_rows(db, cache, docids):
+    """ return the AppRows for a batch of docids """
+    xapiandb = db.xapiandb
+    return [make_app_row(db, cache, xapiandb.get_document(docid))
+            for docid in docids]
+
+
+def update_app_row_state(cache, row):
+    """ return a copy of row with the state for the current cache """
+    return row._replace(state=get_app_state(cache, row.pkgname, row.price))
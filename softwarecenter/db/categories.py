@@ -25,6 +25,13 @@ import os
 import string
 import xapian
 
+# py3 compat
+try:
+    import cPickle as pickle
+    pickle  # pyflakes
+except ImportError:
+    import pickle
+
 # we use lxml.etree instead of xml.etree.ElementTree because it's quite a bit
 # faster, especially on slow machines like ARM
 import lxml.etree as ET
@@ -38,18 +45,31 @@ from softwarecenter.enums import (
     AppInfoFields,
     NonAppVisibility,
     SortMethods,
+    XapianValues,
 )
 from softwarecenter.backend.recagent import RecommenderAgent
-from softwarecenter.db.appfilter import AppFilter
+from softwarecenter.backgroundsave import (
+    atomic_pickle_dump,
+    get_background_save_worker,
+)
+from softwarecenter.db.appfilter import (
+    AppFilter,
+    get_global_filter,
+)
+from softwarecenter.db.database import get_display_name_sort_key
 from softwarecenter.db.enquire import AppEnquire
+from softwarecenter.distro import get_distro
 from softwarecenter.region import get_region_cached
-from softwarecenter.utils import utf8
+from softwarecenter.utils import ExecutionTime, utf8
 
 from gettext import gettext as _
 
 # not possible not use local logger
 LOG = logging.getLogger(__name__)
 
+# bump when the format of the parsed categories cache changes
+CATEGORIES_CACHE_VERSION = 1
+
 
 def get_category_by_name(categories, untrans_name):
     # find a specific category
@@ -77,6 +97,176 @@ def categories_sorted_by_name(categories):
     return sorted_cats
 
 
+def _get_document_sort_key(db, doc):
+    """ the key to sort documents by display name, like AppEnquire does
+        for SortMethods.BY_ALPHABET
+    """
+    if not (db._axi_values and "display_name" in db._axi_values):
+        return doc.get_value(XapianValues.PKGNAME)
+    if db.has_display_name_sort_key:
+        sort_key = doc.get_value(XapianValues.DISPLAY_NAME_SORT_KEY)
+        if sort_key:
+            return sort_key
+    return get_display_name_sort_key(
+        doc.get_value(db._axi_values["display_name"]))
+
+
+def categorise_documents(db, categories_and_queries, docids):
+    """ assign each of the given docids (of the combined database, like
+        MSetItem.docid) to the first category (in the given order) whose
+        query matches the document
+
+        Returns a list of (category, docids, documents) tuples with the
+        documents sorted by display name, categories without documents
+        are skipped
+    """
+    remaining = set(docids)
+    xapiandb = db.xapiandb
+    enquire = xapian.Enquire(xapiandb)
+    # the matches are only needed for their docids
+    enquire.set_weighting_scheme(xapian.BoolWeight())
+    categorised = []
+    for (cat, query) in categories_and_queries:
+        if not remaining:
+            break
+        enquire.set_query(query)
+        # the documents are only read for the not yet assigned docids
+        matches = [(m.docid, m.document)
+                   for m in enquire.get_mset(0, xapiandb.get_doccount())
+                   if m.docid in remaining]
+        if not matches:
+            continue
+        matches.sort(key=lambda match: _get_document_sort_key(db, match[1]))
+        cat_docids = [docid for (docid, doc) in matches]
+        remaining.difference_update(cat_docids)
+        categorised.append(
+            (cat, cat_docids, [doc for (docid, doc) in matches]))
+    return categorised
+
+
+class CategoryStats(object):
+    """ the number of documents and of applications in a category
+
+    The (exact) counts are only computed when they are used, the check
+    for an empty category stops at the first matching document.
+    """
+
+    def __init__(self, db, query):
+        self.db = db
+        self.query = query
+        self._empty = None
+        self._nr_docs = None
+        self._nr_apps = None
+
+    @property
+    def empty(self):
+        if self._empty is None:
+            if self._nr_docs is not None:
+                self._empty = self._nr_docs == 0
+            else:
+                self._empty = not self.db.has_matches(self.query)
+        return self._empty
+
+    @property
+    def nr_docs(self):
+        if self._nr_docs is None:
+            if self._empty:
+                self._nr_docs = 0
+            else:
+                self._nr_docs = self.db.get_matches_count(self.query)
+        return self._nr_docs
+
+    @property
+    def nr_apps(self):
+        if self._nr_apps is None:
+            if self.empty:
+                self._nr_apps = 0
+            else:
+                self._nr_apps = self.db.get_matches_count(
+                    xapian.Query(xapian.Query.OP_AND,
+                                 self.query,
+                                 xapian.Query("ATapplication")))
+        return self._nr_apps
+
+    def __repr__(self):
+        return "<CategoryStats nr_docs=%i nr_apps=%i>" % (
+            self.nr_docs, self.nr_apps)
+
+
+class CategoryStatistics(object):
+    """
+    Provides the CategoryStats of categories (or any query), the counts
+    are cached per database generation and state of the global
+    supported-only filter
+    """
+
+    def __init__(self, db):
+        self.db = db
+        # str(query) -> CategoryStats for the current cache key
+        self._stats = {}
+        self._cache_key = None
+
+    def _get_supported_only(self):
+        """ drop the cached stats if the database or the filter changed
+            and return the supported-only state
+        """
+        supported_only = get_global_filter().supported_only
+        cache_key = (self.db.generation, supported_only)
+        if cache_key != self._cache_key:
+            self._stats = {}
+            self._cache_key = cache_key
+        return supported_only
+
+    def get_stats_for_query(self, query):
+        """ return the CategoryStats of the documents matching query """
+        supported_only = self._get_supported_only()
+        key = str(query)
+        stats = self._stats.get(key)
+        if stats is None:
+            if supported_only:
+                query = xapian.Query(xapian.Query.OP_AND,
+                                     query,
+                                     get_distro().get_supported_query())
+            stats = CategoryStats(self.db, query)
+            self._stats[key] = stats
+        return stats
+
+    def get_stats(self, category):
+        """ return the CategoryStats of the given category """
+        return self.get_stats_for_query(category.query)
+
+    def update(self, categories):
+        """ compute the stats of the given categories and all their
+            subcategories (if not cached already)
+        """
+        with ExecutionTime("category statistics"):
+            self._update(categories)
+
+    def _update(self, categories):
+        for cat in categories:
+            if cat.query is not None:
+                self.get_stats(cat)
+            self._update(cat.subcategories)
+
+    def get_non_empty(self, categories):
+        """ return the categories that contain documents """
+        self.update(categories)
+        return [cat for cat in categories
+                if cat.query is not None and not self.get_stats(cat).empty]
+
+
+_category_statistics = None
+
+
+def get_category_statistics(db):
+    """ return the shared CategoryStatistics for the given db """
+    global _category_statistics
+    if (_category_statistics is None or
+            _category_statistics.db is not db):
+        _category_statistics = CategoryStatistics(db)
+    return _category_statistics
+
+
 def get_query_for_category(db, untranslated_category_name):
     cat_parser = CategoriesParser(db)
     categories = cat_parser.parse_applications_menu()
@@ -249,6 +439,10 @@ class CategoriesParser(object):
         self.db = db
         # build the string substitution support
         self._build_string_template_dict()
+        # the .directory files read and if the db was used while parsing,
+        # both need to be unchanged for the disk cache to be valid
+        self._directory_files = []
+        self._uses_db = False
 
     def parse_applications_menu(self, datadir=None, use_cache=True):
         """ parse a application menu and return a list of Category objects """
@@ -262,10 +456,32 @@ class CategoriesParser(object):
         if use_cache and cachekey in self.CATEGORIES_PARSER_CACHE:
             return self.CATEGORIES_PARSER_CACHE[cachekey]
 
-        categories = []
         # we support multiple menu files and menu drop ins
         menu_files = [datadir + "/desktop/software-center.menu"]
         menu_files += glob.glob(datadir + "/menu.d/*.menu")
+
+        stamp = self._get_cache_stamp(menu_files)
+        categories = None
+        if use_cache:
+            categories = self._load_disk_cache(datadir, stamp)
+        if categories is None:
+            categories = self._parse_menu_files(menu_files)
+            self._save_disk_cache(datadir, stamp, categories)
+
+        # add to the cache
+        self.CATEGORIES_PARSER_CACHE[cachekey] = categories
+
+        # debug print
+        for cat in categories:
+            LOG.debug("%s %s %s" % (cat.name.decode('utf8'),
+                                    cat.iconname,
+                                    cat.query))
+        return categories
+
+    def _parse_menu_files(self, menu_files):
+        self._directory_files = []
+        self._uses_db = False
+        categories = []
         for f in menu_files:
             if not os.path.exists(f):
                 continue
@@ -285,17 +501,110 @@ class CategoriesParser(object):
         for cat in categories:
             self._build_unallocated_queries(cat.subcategories)
         self._build_unallocated_queries(categories)
+        return categories
 
-        # add to the cache
-        self.CATEGORIES_PARSER_CACHE[cachekey] = categories
+    # the on disk cache of the parsed categories, the queries are
+    # stored serialised
+    def _get_disk_cache_path(self):
+        return os.path.join(softwarecenter.paths.SOFTWARE_CENTER_CACHE_DIR,
+                            "categories.p")
 
-        # debug print
-        for cat in categories:
-            LOG.debug("%s %s %s" % (cat.name.decode('utf8'),
-                                    cat.iconname,
-                                    cat.query))
+    def _get_cache_stamp(self, menu_files):
+        """ the data the parsed categories depend on (besides the
+            .directory files and the db that are checked separately)
+        """
+        menu_mtimes = []
+        for f in menu_files:
+            if os.path.exists(f):
+                menu_mtimes.append((f, os.path.getmtime(f)))
+        # the names are translated with gettext
+        lang = (os.environ.get("LANGUAGE"),
+                locale.setlocale(locale.LC_MESSAGES))
+        return (CATEGORIES_CACHE_VERSION, tuple(menu_mtimes), lang,
+                self._template_dict["CURRENT_REGION"])
+
+    def _get_directory_files_stamp(self, filenames):
+        return [(f, os.path.getmtime(f) if os.path.exists(f) else None)
+                for f in filenames]
+
+    def _get_db_stamp(self):
+        # wildcard queries are expanded against the terms of the db
+        xapiandb = self.db.xapiandb
+        return (xapiandb.get_doccount(), xapiandb.get_lastdocid())
+
+    def _load_disk_cache(self, datadir, stamp):
+        path = self._get_disk_cache_path()
+        if not os.path.exists(path):
+            return None
+        try:
+            entry = pickle.load(open(path, "rb")).get(datadir)
+            if entry is None or entry["stamp"] != stamp:
+                return None
+            filenames = [f for (f, mtime) in entry["directory_files"]]
+            if (self._get_directory_files_stamp(filenames) !=
+                    entry["directory_files"]):
+                return None
+            if (entry["db_stamp"] is not None and
+                    entry["db_stamp"] != self._get_db_stamp()):
+                return None
+            categories = [self._category_from_dict(d)
+                          for d in entry["categories"]]
+        except Exception as e:
+            LOG.warn("failed to read the categories cache '%s': %s" % (
+                path, e))
+            return None
+        LOG.debug("using the categories cache '%s'" % path)
         return categories
 
+    def _save_disk_cache(self, datadir, stamp, categories):
+        path = self._get_disk_cache_path()
+        try:
+            entry = {
+                "stamp": stamp,
+                "directory_files": self._get_directory_files_stamp(
+                    self._directory_files),
+                "db_stamp": self._get_db_stamp() if self._uses_db else None,
+                "categories": [self._category_to_dict(cat)
+                               for cat in categories],
+            }
+        except Exception as e:
+            LOG.warn("can not cache the categories: %s" % e)
+            return
+
+        def _save():
+            try:
+                cache = pickle.load(open(path, "rb"))
+            except Exception:
+                cache = {}
+            cache[datadir] = entry
+            atomic_pickle_dump(cache, path)
+        get_background_save_worker().schedule(path, _save)
+
+    def _category_to_dict(self, cat):
+        return {
+            "untranslated_name": cat.untranslated_name,
+            "name": cat.name,
+            "iconname": cat.iconname,
+            "query": cat.query.serialise(),
+            "only_unallocated": cat.only_unallocated,
+            "dont_display": cat.dont_display,
+            "flags": cat.flags,
+            "sortmode": cat.sortmode,
+            "item_limit": cat.item_limit,
+            "subcategories": [self._category_to_dict(subcat)
+                              for subcat in cat.subcategories],
+        }
+
+    def _category_from_dict(self, d):
+        # the query already contains the subcategory queries
+        cat = Category(d["untranslated_name"], d["name"], d["iconname"],
+                       xapian.Query.unserialise(d["query"]),
+                       d["only_unallocated"], d["dont_display"],
+                       d["flags"], [], d["sortmode"], d["item_limit"])
+        cat.subcategories = [self._category_from_dict(subcat)
+                             for subcat in d["subcategories"]]
+        return cat
+
     def _build_string_template_dict(self):
         """ this build the dict used to substitute menu entries dynamically,
             currently used for the CURRENT_REGION
@@ -326,6 +635,7 @@ class CategoriesParser(object):
         from softwarecenter.db.update import DesktopConfigParser
         cp = DesktopConfigParser()
         fname = "/usr/share/desktop-directories/%s" % element.text
+        self._directory_files.append(fname)
         if not os.path.exists(fname):
             return None
         LOG.debug("reading '%s'" % fname)
@@ -411,6 +721,7 @@ class CategoriesParser(object):
                 # mangled to workaround xapian's query parser lack of
                 # quoting :/
                 s = "pkg_wildcard:%s" % qtext.replace("-", "_")
+                self._uses_db = True
                 q = self.db.xapian_parser.parse_query(s,
                     xapian.QueryParser.FLAG_WILDCARD)
                 query = xapian.Query(xapian_op, query, q)
@@ -16,6 +16,7 @@
 # this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import json
 import locale
 import logging
 import os
@@ -25,11 +26,12 @@ import threading
 import xapian
 from softwarecenter.db.application import Application
 from softwarecenter.db.pkginfo import get_pkg_info
+from softwarecenter.distro import get_distro
 import softwarecenter.paths
 
 from gi.repository import GObject, Gio, GLib
 
-from softwarecenter.utils import ExecutionTime
+from softwarecenter.utils import ExecutionTime, utf8
 from softwarecenter.enums import (
     AVAILABLE_FOR_PURCHASE_MAGIC_CHANNEL_NAME,
     PkgStates,
@@ -41,6 +43,36 @@ from gettext import gettext as _
 
 LOG = logging.getLogger(__name__)
 
+# the metadata key of the json encoded channel label -> origin mapping
+# that is written at index time
+CHANNEL_ORIGINS_METADATA_KEY = "channel-origins"
+
+
+def get_channel_origin_from_termlist(xapiandb, label_term):
+    """ return the origin (XOO term) of the first document with the
+        given channel label term or "" if it has none
+    """
+    m = xapiandb.postlist_begin(label_term)
+    doc = xapiandb.get_document(m.get_docid())
+    for term_iter in doc.termlist():
+        if (term_iter.term.startswith("XOO") and
+                len(term_iter.term) > 3):
+            return term_iter.term[3:]
+    return ""
+
+
+def get_channel_origins_from_db(xapiandb):
+    """ return a dict with the origin of each channel label (XOL term)
+        in the given database
+    """
+    origins = {}
+    for channel_iter in xapiandb.allterms("XOL"):
+        if len(channel_iter.term) == 3:
+            continue
+        origins[channel_iter.term[3:]] = get_channel_origin_from_termlist(
+            xapiandb, channel_iter.term)
+    return origins
+
 
 def get_reinstall_previous_purchases_query():
     """Return a query to get applications purchased
@@ -70,6 +102,25 @@ def parse_axi_values_file(filename="/var/lib/apt-xapian-index/values"):
     return axi_values
 
 
+def get_sort_key_locale():
+    """ return the locale that is used for locale.strxfrm() """
+    # calling setlocale() without a locale just queries the current one
+    return locale.setlocale(locale.LC_COLLATE)
+
+
+def is_same_locale(name, other_name):
+    """ True if the locale names refer to the same locale, e.g.
+        en_US.UTF-8 and en_US.utf8
+    """
+    return locale.normalize(name) == locale.normalize(other_name)
+
+
+def get_display_name_sort_key(display_name):
+    """ return the precomputed sort key for the given display name """
+    # strxfrm() can not encode non-ascii unicode strings
+    return locale.strxfrm(utf8(display_name))
+
+
 class SearchQuery(list):
     """ a list wrapper for a search query. it can take a search string
         or a list of search strings
@@ -107,7 +158,7 @@ class LocaleSorter(xapian.KeyMaker):
         self.db = db
 
     def __call__(self, doc):
-        return locale.strxfrm(
+        return get_display_name_sort_key(
             doc.get_value(self.db._axi_values["display_name"]))
 
 
@@ -117,15 +168,21 @@ class TopRatedSorter(xapian.KeyMaker):
         super(TopRatedSorter, self).__init__()
         self.db = db
         self.review_loader = review_loader
+        # the keys are precomputed by the review loader when the stats
+        # are refreshed, None if the loader does not support that
+        self._sort_keys = review_loader.get_rating_sort_keys()
+        self._no_rating_key = xapian.sortable_serialise(0)
 
     def __call__(self, doc):
+        if self._sort_keys is not None:
+            return self._sort_keys.get(self.db.get_pkgname(doc),
+                                       self._no_rating_key)
         app = Application(self.db.get_appname(doc),
                           self.db.get_pkgname(doc))
         stats = self.review_loader.get_review_stats(app)
-        import xapian
         if stats:
             return xapian.sortable_serialise(stats.dampened_rating)
-        return xapian.sortable_serialise(0)
+        return self._no_rating_key
 
 
 class StoreDatabase(GObject.GObject):
@@ -168,6 +225,23 @@ class StoreDatabase(GObject.GObject):
         self._db_per_thread = {}
         self._parser_per_thread = {}
         self._axi_stamp_monitor = None
+        self._has_display_name_sort_key = None
+        # pkgname -> applications of the installed pkgnames, see
+        # get_installed_apps()
+        self._installed_apps = None
+        self._app_pkgnames = None
+        # pkgname -> (appname -> docid, first app docid, first a-x-i
+        # docid), see get_xapian_document()
+        self._docid_index = {}
+        # the (label, origin) of the channels, see get_channel_origins()
+        self._channel_origins = None
+        # (kind, name) -> frozenset() of docids or pkgnames, see
+        # get_filter_docids() and get_filter_pkgnames()
+        self._filter_docids = {}
+        self._filter_docids_lock = threading.Lock()
+        # changes every time the database is (re)opened
+        self.generation = 0
+        self._aptcache.connect("cache-ready", self._on_cache_ready)
 
     @property
     def xapiandb(self):
@@ -230,6 +304,13 @@ class StoreDatabase(GObject.GObject):
         # clean existing DBs on open
         self._db_per_thread = {}
         self._parser_per_thread = {}
+        self._has_display_name_sort_key = None
+        self._installed_apps = None
+        self._app_pkgnames = None
+        self._filter_docids = {}
+        self._docid_index = {}
+        self._channel_origins = None
+        self.generation += 1
         # add the apt-xapian-database for here (we don't do this
         # for now as we do not have a good way to integrate non-apps
         # with the UI)
@@ -288,6 +369,17 @@ class StoreDatabase(GObject.GObject):
         """
         return self.xapiandb.get_metadata("db-schema-version")
 
+    @property
+    def has_display_name_sort_key(self):
+        """ True if the XapianValues.DISPLAY_NAME_SORT_KEY values in the
+            database were created for the current locale
+        """
+        if self._has_display_name_sort_key is None:
+            self._has_display_name_sort_key = is_same_locale(
+                self.xapiandb.get_metadata("display-name-sort-key-locale"),
+                get_sort_key_locale())
+        return self._has_display_name_sort_key
+
     def reopen(self):
         """ reopen the database """
         LOG.debug("reopen() database")
@@ -301,27 +393,64 @@ class StoreDatabase(GObject.GObject):
         assert popcon_max > 0
         return popcon_max
 
-    def get_query_for_pkgnames(self, pkgnames):
-        """ return a xapian query that matches exactly the list of pkgnames """
+    def get_matches_count(self, query, xfilter=None, exact=True):
+        """ return the number of documents matching the given query
+
+        This does not materialise the matching documents. If `exact` is
+        False the (much cheaper) xapian estimate is returned instead of
+        the exact count. A query given as a single term string is
+        answered directly from the term frequency (if no filter is used),
+        the empty term matches all documents.
+        """
+        if isinstance(query, basestring):
+            if xfilter is None:
+                if query == "":
+                    return self.xapiandb.get_doccount()
+                return self.xapiandb.get_termfreq(query)
+            query = xapian.Query(query)
         enquire = xapian.Enquire(self.xapiandb)
-        query = xapian.Query()
+        enquire.set_query(query)
+        if exact:
+            # checking all documents makes the estimate exact
+            checkatleast = self.xapiandb.get_doccount()
+        else:
+            checkatleast = 0
+        matches = enquire.get_mset(0, 0, checkatleast, None, xfilter)
+        return matches.get_matches_estimated()
+
+    def has_matches(self, query):
+        """ return True if any document matches the given query, the
+            match stops at the first one
+        """
+        enquire = xapian.Enquire(self.xapiandb)
+        enquire.set_query(query)
+        enquire.set_weighting_scheme(xapian.BoolWeight())
+        return len(enquire.get_mset(0, 1)) > 0
+
+    def get_pkgname_terms(self, pkgnames):
+        """ return a list with the term that should be used to match each
+            of the pkgnames, the "AP" term if there is a app for it and
+            the "XP" (apt-xapian-index) term otherwise
+        """
+        xapiandb = self.xapiandb
+        terms = []
         for pkgname in pkgnames:
-            # even on the raspberry pi this query is super quick (~0.003s)
-            with ExecutionTime("de-dup query_for_pkgnames"):
-                tmp_query = xapian.Query("AP" + pkgname)
-                enquire.set_query(tmp_query)
-                result = enquire.get_mset(0, 1)
             # see bug #1043159, we need to ensure that we de-duplicate
-            # when there is a pkg and a app (e.g. from the s-c-agent) in the db
-            if len(result) == 1:
-                query = xapian.Query(xapian.Query.OP_OR,
-                                     query,
-                                     xapian.Query("AP" + pkgname))
+            # when there is a pkg and a app (e.g. from the s-c-agent) in
+            # the db
+            if xapiandb.term_exists("AP" + pkgname):
+                terms.append("AP" + pkgname)
             else:
-                query = xapian.Query(xapian.Query.OP_OR,
-                                     query,
-                                     xapian.Query("XP" + pkgname))
-        return query
+                terms.append("XP" + pkgname)
+        return terms
+
+    def get_query_for_pkgnames(self, pkgnames):
+        """ return a xapian query that matches exactly the list of pkgnames """
+        with ExecutionTime("de-dup query_for_pkgnames"):
+            terms = self.get_pkgname_terms(set(pkgnames))
+        if not terms:
+            return xapian.Query()
+        return xapian.Query(xapian.Query.OP_OR, sorted(terms))
 
     def get_query_list_from_search_entry(self, search_term,
                                          category_query=None):
@@ -512,6 +641,133 @@ class StoreDatabase(GObject.GObject):
             return True
         return False
 
+    def _on_cache_ready(self, cache):
+        self._filter_docids = {}
+        if self._installed_apps is not None:
+            self.update_installed_apps()
+
+    def get_filter_docids(self, name):
+        """ return a frozenset() with the docids of the documents whose
+            package is "installed", "available" (in the cache or for
+            purchase) or "supported" by the distro
+
+            The docids are the ones of the combined database (like
+            MSetItem.docid), not the ones Document.get_docid() returns
+            for documents of the added databases. The sets are build on
+            first use and dropped when the database is reopened or the
+            cache is ready again.
+        """
+        return self._get_filter_set("docids", name)
+
+    def get_filter_pkgnames(self, name):
+        """ return a frozenset() with the pkgnames in the database that
+            are "installed", "available" (in the cache) or "supported"
+            by the distro, see get_filter_docids()
+        """
+        return self._get_filter_set("pkgnames", name)
+
+    def _get_filter_set(self, kind, name):
+        key = (kind, name)
+        items = self._filter_docids.get(key)
+        if items is not None:
+            return items
+        with self._filter_docids_lock:
+            # keep a reference, a reset while building must not be
+            # overwritten with the old data
+            filter_docids = self._filter_docids
+            items = filter_docids.get(key)
+            if items is None:
+                with ExecutionTime("building the %s %s set" % (name, kind)):
+                    if kind == "docids":
+                        items = self._build_filter_docids(name)
+                    else:
+                        items = self._build_filter_pkgnames(name)
+                filter_docids[key] = items
+        return items
+
+    def _build_filter_pkgnames(self, name):
+        cache = self._aptcache
+        if name == "installed":
+            wanted = lambda pkgname: (pkgname in cache and
+                                      cache[pkgname].is_installed)
+        elif name == "available":
+            wanted = lambda pkgname: pkgname in cache
+        elif name == "supported":
+            distro = get_distro()
+            # the distros look only at the cache, not at the document
+            wanted = lambda pkgname: distro.is_supported(cache, None, pkgname)
+        else:
+            raise ValueError("unknown filter set '%s'" % name)
+        pkgnames = set()
+        # AP is used by our own databases, XP by apt-xapian-index, the
+        # mangled APM/XPM terms are skipped (pkgnames are lowercase)
+        for prefix in ("AP", "XP"):
+            for t in self.xapiandb.allterms(prefix):
+                if t.term.startswith(prefix + "M"):
+                    continue
+                pkgname = t.term[2:]
+                if pkgname not in pkgnames and wanted(pkgname):
+                    pkgnames.add(pkgname)
+        return frozenset(pkgnames)
+
+    def _build_filter_docids(self, name):
+        docids = set()
+        for pkgname in self.get_filter_pkgnames(name):
+            for prefix in ("AP", "XP"):
+                docids.update(
+                    m.docid for m in self.xapiandb.postlist(prefix + pkgname))
+        if name == "available":
+            docids.update(m.docid for m in self.xapiandb.postlist(
+                "AH" + AVAILABLE_FOR_PURCHASE_MAGIC_CHANNEL_NAME))
+        return frozenset(docids)
+
+    def _get_app_pkgnames(self):
+        """ return all pkgnames that have a AP term, without loading
+            any document
+        """
+        if self._app_pkgnames is None:
+            self._app_pkgnames = [
+                t.term[2:] for t in self.xapiandb.allterms("AP")
+                # skip the mangled APM terms, pkgnames are lowercase
+                if not t.term.startswith("APM")]
+        return self._app_pkgnames
+
+    def update_installed_apps(self, pkgnames=None):
+        """ update the installed apps index for the given pkgnames (or
+            all pkgnames in the database), only the documents of newly
+            installed packages are read
+        """
+        if self._installed_apps is None:
+            # nothing to update, it gets build on the next use
+            return
+        if pkgnames is None:
+            pkgnames = self._get_app_pkgnames()
+        for pkgname in pkgnames:
+            installed = (pkgname in self._aptcache and
+                         self._aptcache[pkgname].is_installed)
+            if not installed:
+                self._installed_apps.pop(pkgname, None)
+            elif pkgname not in self._installed_apps:
+                apps = set()
+                for m in self.xapiandb.postlist("AP" + pkgname):
+                    doc = self.xapiandb.get_document(m.docid)
+                    if self.get_appname(doc):
+                        apps.add(self.get_application(doc))
+                self._installed_apps[pkgname] = apps
+
+    def get_installed_apps(self):
+        """ return a set() of the Applications in the database whose
+            package is installed
+        """
+        if self._installed_apps is None:
+            with ExecutionTime("building the installed apps index"):
+                self._installed_apps = {}
+                self.update_installed_apps()
+        apps = set()
+        for pkg_apps in self._installed_apps.itervalues():
+            apps.update(pkg_apps)
+        return apps
+
     def get_apps_for_pkgname(self, pkgname):
         """ Return set of docids with the matching applications for the
             given pkgname """
@@ -534,6 +790,43 @@ class StoreDatabase(GObject.GObject):
             popcon = 0
         return popcon
 
+    def _get_docid_index_entry(self, pkgname):
+        """ return the (appname -> docid, first app docid, first a-x-i
+            docid) index entry of the given pkgname, the documents of a
+            pkgname are only read on the first lookup
+        """
+        entry = self._docid_index.get(pkgname)
+        if entry is None:
+            apps = {}
+            app_docid = None
+            for m in self.xapiandb.postlist("AP" + pkgname):
+                doc = self.xapiandb.get_document(m.docid)
+                if doc.get_value(XapianValues.PKGNAME) != pkgname:
+                    continue
+                if app_docid is None:
+                    app_docid = m.docid
+                # the postlist is sorted by docid so the first document
+                # of a appname wins, like in the "AA" postlist
+                appname = self.get_appname(doc)
+                if appname and appname not in apps:
+                    apps[appname] = m.docid
+            axi_docid = None
+            for m in self.xapiandb.postlist("XP" + pkgname):
+                axi_docid = m.docid
+                break
+            entry = (apps, app_docid, axi_docid)
+            self._docid_index[pkgname] = entry
+        return entry
+
+    def _get_docid(self, appname, pkgname):
+        apps, app_docid, axi_docid = self._get_docid_index_entry(pkgname)
+        # first the appname in the app-install-data namespace, then the
+        # pkgname and then the matching package from a-x-i
+        for docid in (apps.get(appname), app_docid, axi_docid):
+            if docid is not None:
+                return docid
+        return None
+
     def get_xapian_document(self, appname, pkgname):
         """Get the matching xapian document for appname, pkgname.
 
@@ -542,23 +835,28 @@ class StoreDatabase(GObject.GObject):
         """
         #LOG.debug("get_xapian_document app='%s' pkg='%s'" % (appname,
         #    pkgname))
-        # first search for appname in the app-install-data namespace
-        for m in self.xapiandb.postlist("AA" + appname):
-            doc = self.xapiandb.get_document(m.docid)
-            if doc.get_value(XapianValues.PKGNAME) == pkgname:
-                return doc
-        # then search for pkgname in the app-install-data namespace
-        for m in self.xapiandb.postlist("AP" + pkgname):
-            doc = self.xapiandb.get_document(m.docid)
-            if doc.get_value(XapianValues.PKGNAME) == pkgname:
-                return doc
-        # then look for matching packages from a-x-i
-        for m in self.xapiandb.postlist("XP" + pkgname):
-            doc = self.xapiandb.get_document(m.docid)
-            return doc
-        # no matching document found
-        raise IndexError("No app '%s' for '%s' in database" % (appname,
-            pkgname))
+        docid = self._get_docid(appname, pkgname)
+        if docid is None:
+            # no matching document found
+            raise IndexError("No app '%s' for '%s' in database" % (appname,
+                pkgname))
+        return self.xapiandb.get_document(docid)
+
+    def get_xapian_documents(self, pairs):
+        """Get the matching xapian documents for a list of (appname,
+        pkgname) pairs.
+
+        The result list has None for the pairs without a document.
+
+        """
+        docs = []
+        for (appname, pkgname) in pairs:
+            docid = self._get_docid(appname, pkgname)
+            if docid is None:
+                docs.append(None)
+            else:
+                docs.append(self.xapiandb.get_document(docid))
+        return docs
 
     def is_pkgname_known(self, pkgname):
         """Check if 'pkgname' is known to this database.
@@ -608,20 +906,54 @@ class StoreDatabase(GObject.GObject):
                 origins.add(term.term[3:])
         return list(origins)
 
+    def get_channel_origins(self):
+        """ return a list of (label, origin) tuples of the channels in
+            the current database, sorted by label
+
+            The origins are read from the metadata written at index
+            time, only the channels that are not part of it (e.g. from
+            apt-xapian-index) are looked up in the termlists.
+        """
+        if self._channel_origins is None:
+            xapiandb = self.xapiandb
+            try:
+                stored = json.loads(
+                    xapiandb.get_metadata(CHANNEL_ORIGINS_METADATA_KEY) or
+                    "{}")
+            except ValueError:
+                LOG.warn("invalid channel origins in the database metadata")
+                stored = {}
+            stored = dict((label.encode("utf-8"), origin.encode("utf-8"))
+                          for (label, origin) in stored.items())
+            channel_origins = []
+            for channel_iter in xapiandb.allterms("XOL"):
+                if len(channel_iter.term) == 3:
+                    continue
+                label = channel_iter.term[3:]
+                origin = stored.get(label)
+                if origin is None:
+                    origin = get_channel_origin_from_termlist(
+                        xapiandb, channel_iter.term)
+                channel_origins.append((label, origin))
+            self._channel_origins = channel_origins
+        return self._channel_origins
+
     def get_exact_matches(self, pkgnames=[]):
         """Returns a list of fake MSetItems. If the pkgname is available, then
            MSetItem.document is pkgnames proper xapian document. If the pkgname
            is not available, then MSetItem is actually an Application.
         """
-        matches = []
+        apps = []
         for pkgname in pkgnames:
             app = Application('', pkgname.split('?')[0])
             if '?' in pkgname:
                 app.request = pkgname.split('?')[1]
+            apps.append(app)
+        terms = self.get_pkgname_terms([a.pkgname for a in apps])
+        matches = []
+        for (app, term) in zip(apps, terms):
             match = app
-            for m in self.xapiandb.postlist("XP" + app.pkgname):
-                match = self.xapiandb.get_document(m.docid)
-            for m in self.xapiandb.postlist("AP" + app.pkgname):
+            for m in self.xapiandb.postlist(term):
                 match = self.xapiandb.get_document(m.docid)
             matches.append(FakeMSetItem(match))
         return matches
@@ -29,6 +29,7 @@ from gi.repository import GLib
 from .categories import (
     CategoriesParser,
     get_category_by_name,
+    get_category_statistics,
 )
 from .database import StoreDatabase
 from .application import Application
@@ -78,6 +79,7 @@ class SoftwareCenterDataProvider(dbus.service.Object):
         self.db._aptcache.open(blocking=True)
         # categories
         self.categories = CategoriesParser(self.db).parse_applications_menu()
+        self.category_statistics = get_category_statistics(self.db)
         # ensure reviews get refreshed
         self.review_loader = get_review_loader(self.db._aptcache, self.db)
         self.review_loader.refresh_review_stats()
@@ -130,7 +132,8 @@ class SoftwareCenterDataProvider(dbus.service.Object):
 
     @update_activity_timestamp
     def _get_available_categories(self):
-        return [cat.name for cat in self.categories]
+        return [cat.name for cat in
+                self.category_statistics.get_non_empty(self.categories)]
 
     @dbus.service.method(DBUS_DATA_PROVIDER_IFACE,
                          in_signature='s', out_signature='as')
@@ -141,7 +144,8 @@ class SoftwareCenterDataProvider(dbus.service.Object):
     @update_activity_timestamp
     def _get_available_subcategories(self, category_name):
         cat = get_category_by_name(self.categories, category_name)
-        return [subcat.name for subcat in cat.subcategories]
+        return [subcat.name for subcat in
+                self.category_statistics.get_non_empty(cat.subcategories)]
 
     @dbus.service.method('com.ubuntu.SoftwareCenterDataProvider',
                          in_signature='s', out_signature='a(ssss)')
@@ -18,10 +18,19 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import logging
-import time
 import threading
+import weakref
 import xapian
 
+from collections import OrderedDict
+
+# py3 compat
+try:
+    from queue import Queue
+    Queue  # pyflakes
+except ImportError:
+    from Queue import Queue
+
 from gi.repository import GObject, GLib
 
 from softwarecenter.enums import (SortMethods,
@@ -35,6 +44,155 @@ from softwarecenter.utils import ExecutionTime
 
 LOG = logging.getLogger(__name__)
 
+# the number of persistent threads used for nonblocking searches
+SEARCH_WORKER_THREADS = 2
+
+# the number of query results an AppEnquire keeps
+QUERY_RESULT_CACHE_SIZE = 32
+
+
+class SearchWorkerPool(object):
+    """
+    A small pool of persistent threads that run the blocking xapian
+    searches of AppEnquire and wake up the main loop once a search
+    is finished (instead of one new thread per query)
+    """
+
+    def __init__(self, nr_threads=SEARCH_WORKER_THREADS):
+        # required with older pygobject so that the workers can
+        # run while the main loop sleeps
+        GObject.threads_init()
+        self._queue = Queue()
+        self._threads = []
+        for i in range(nr_threads):
+            # the thread names are stable so that StoreDatabase only
+            # opens one xapian db per worker
+            t = threading.Thread(target=self._run,
+                                 name="ThreadedQuery-%s" % (i + 1))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, func, done_callback):
+        """ Run func in a worker thread and call done_callback in the
+            main loop once it has finished
+        """
+        self._queue.put((func, done_callback))
+
+    def _run(self):
+        while True:
+            func, done_callback = self._queue.get()
+            try:
+                func()
+            except Exception:
+                LOG.exception("search in worker thread failed")
+            GLib.idle_add(done_callback)
+
+
+_search_worker_pool = None
+
+
+def get_search_worker_pool():
+    global _search_worker_pool
+    if _search_worker_pool is None:
+        _search_worker_pool = SearchWorkerPool()
+    return _search_worker_pool
+
+
+class CachedMSetItem(object):
+    """ A stand-in for the xapian.MSetItem of a cached query result """
+
+    def __init__(self, db, docid):
+        self._db = db
+        self.docid = docid
+
+    @property
+    def document(self):
+        return self._db.xapiandb.get_document(self.docid)
+
+
+class QueryResultCache(object):
+    """
+    A LRU cache of query results (docids, nr_apps, nr_pkgs and the
+    used nonapps visibility). It is cleared when the database is
+    (re)opened or the cache is ready again (e.g. after a transaction).
+
+    Use get_query_result_cache() to get the one shared by all AppEnquire
+    objects of a database, it connects to the database and cache signals
+    only once.
+    """
+
+    def __init__(self, cache, db, size=QUERY_RESULT_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        # incremented on each clear() so that results of queries that
+        # were started before can be ignored
+        self.generation = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self._caches = []
+        # "open" is emitted by reopen() as well
+        db.connect("open", lambda db, path: self.clear())
+        self.add_cache(cache)
+
+    def add_cache(self, cache):
+        """ clear the results when the given cache is ready again """
+        if cache in self._caches:
+            return
+        self._caches.append(cache)
+        cache.connect("cache-ready", lambda cache: self.clear())
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._results.clear()
+
+    def get(self, key):
+        """ return the result for the given key or None """
+        with self._lock:
+            result = self._results.pop(key, None)
+            if result is None:
+                self.misses += 1
+            else:
+                # move to the end, the most recently used one
+                self._results[key] = result
+                self.hits += 1
+            LOG.debug("query result cache %s (%i hits, %i misses)" % (
+                "hit" if result is not None else "miss",
+                self.hits, self.misses))
+        return result
+
+    def store(self, key, result, generation):
+        """ store the result of a query that was started when the
+            cache had the given generation
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._results.pop(key, None)
+            self._results[key] = result
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+
+
+# the query result cache of each database, shared by all its AppEnquire
+# objects (a new one is created e.g. for each Category.get_documents())
+_query_result_caches = weakref.WeakKeyDictionary()
+
+
+def get_query_result_cache(cache, db):
+    """ return the QueryResultCache shared by the AppEnquire objects of
+        the given database
+    """
+    result_cache = _query_result_caches.get(db)
+    if result_cache is None:
+        result_cache = QueryResultCache(cache, db)
+        _query_result_caches[db] = result_cache
+    else:
+        result_cache.add_cache(cache)
+    return result_cache
+
 
 class AppEnquire(GObject.GObject):
     """
@@ -71,8 +229,18 @@ class AppEnquire(GObject.GObject):
         self.exact = False
         self.nr_pkgs = 0
         self.nr_apps = 0
+        # set to False to use the (cheaper) xapian estimates for the
+        # nr_apps/nr_pkgs counts instead of exact counts
+        self.exact_counts = True
         self._matches = []
         self.match_docids = set()
+        # incremented for each new query, used to cancel superseded ones
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._result_cache = get_query_result_cache(cache, db)
+        # (key, result cache generation) of the running query or None if
+        # its result should not be cached
+        self._result_cache_key = None
 
     def __len__(self):
         return len(self._matches)
@@ -82,49 +250,53 @@ class AppEnquire(GObject.GObject):
         """ return the list of matches as xapian.MSetItem """
         return self._matches
 
+    def _is_superseded(self, generation):
+        """ True if a newer query was started after the given generation """
+        return generation is not None and generation != self._generation
+
     def _threaded_perform_search(self):
-        self._perform_search_complete = False
-        # generate a name and ensure we never have two threads
-        # with the same name
-        names = [thread.name for thread in threading.enumerate()]
-        for i in range(threading.active_count() + 1, 0, -1):
-            thread_name = 'ThreadedQuery-%s' % i
-            if not thread_name in names:
-                break
-        # create and start it
-        t = threading.Thread(
-            target=self._blocking_perform_search, name=thread_name)
-        t.start()
-        # don't block the UI while the thread is running
+        generation = self._generation
+        state = {"complete": False}
+
+        def _on_search_done():
+            state["complete"] = True
+            return False
+        get_search_worker_pool().submit(
+            lambda: self._blocking_perform_search(generation),
+            _on_search_done)
+        # don't block the UI while the worker is running, the worker
+        # wakes up the main context via GLib.idle_add() once it is done,
+        # so we sleep in iteration() instead of polling
         context = GLib.main_context_default()
-        while not self._perform_search_complete:
-            time.sleep(0.02)  # 50 fps
-            while context.pending():
-                context.iteration()
-        t.join()
+        while not state["complete"]:
+            context.iteration(True)
+
+        # a newer query got started while we were waiting (e.g. because
+        # the user continued typing), the newer query emits the signal
+        if self._is_superseded(generation):
+            LOG.debug("query generation %s superseded" % generation)
+            return
 
         # call the query-complete callback
         self.emit("query-complete")
 
-    def _get_estimate_nr_apps_and_nr_pkgs(self, enquire, q, xfilter):
-        # filter out docs of pkgs of which there exists a doc of the app
-        enquire.set_query(xapian.Query(xapian.Query.OP_AND,
-                                       q, xapian.Query("ATapplication")))
-
+    def _get_estimate_nr_apps_and_nr_pkgs(self, q, xfilter):
         try:
-            tmp_matches = enquire.get_mset(0, len(self.db), None, xfilter)
+            nr_apps = self.db.get_matches_count(
+                xapian.Query(xapian.Query.OP_AND,
+                             q, xapian.Query("ATapplication")),
+                xfilter, exact=self.exact_counts)
+            # filter out docs of pkgs of which there exists a doc of the app
+            nr_pkgs = self.db.get_matches_count(
+                xapian.Query(xapian.Query.OP_AND_NOT,
+                             q, xapian.Query("XD")),
+                xfilter, exact=self.exact_counts) - nr_apps
         except Exception:
             LOG.exception("_get_estimate_nr_apps_and_nr_pkgs failed")
             return (0, 0)
-
-        nr_apps = tmp_matches.get_matches_estimated()
-        enquire.set_query(xapian.Query(xapian.Query.OP_AND_NOT,
-                                       q, xapian.Query("XD")))
-        tmp_matches = enquire.get_mset(0, len(self.db), None, xfilter)
-        nr_pkgs = tmp_matches.get_matches_estimated() - nr_apps
         return (nr_apps, nr_pkgs)
 
-    def _blocking_perform_search(self):
+    def _blocking_perform_search(self, generation=None):
         # WARNING this call may run in a thread, so it's *not*
         #         allowed to touch gtk, otherwise hell breaks loose
 
@@ -142,12 +314,15 @@ class AppEnquire(GObject.GObject):
         else:
             xfilter = None
 
-        # go over the queries
-        self.nr_apps, self.nr_pkgs = 0, 0
-        _matches = self._matches
-        match_docids = self.match_docids
+        # go over the queries, results are collected locally and only
+        # committed at the end if no newer query superseded this one
+        total_nr_apps, total_nr_pkgs = 0, 0
+        _matches = []
+        match_docids = set(self.match_docids)
 
         for q in self.search_query:
+            if self._is_superseded(generation):
+                return
             LOG.debug("initial query: '%s'" % q)
 
             # for searches we may want to disable show/hide
@@ -161,7 +336,7 @@ class AppEnquire(GObject.GObject):
                 with ExecutionTime("de-duplication"):
                     q_app = xapian.Query(terms[0].replace("XP", "AP"))
                     nr_apps, nr_pkgs = self._get_estimate_nr_apps_and_nr_pkgs(
-                        enquire, q_app, xfilter)
+                        q_app, xfilter)
                     if nr_apps == 1:
                         q = q_app
                         # this is a app query now
@@ -169,16 +344,18 @@ class AppEnquire(GObject.GObject):
 
             with ExecutionTime("calculate nr_apps and nr_pkgs: "):
                 nr_apps, nr_pkgs = self._get_estimate_nr_apps_and_nr_pkgs(
-                    enquire, q, xfilter)
-                self.nr_apps += nr_apps
-                self.nr_pkgs += nr_pkgs
+                    q, xfilter)
+                total_nr_apps += nr_apps
+                total_nr_pkgs += nr_pkgs
 
             # only show apps by default (unless in always visible mode)
+            apps_only = False
             if self.nonapps_visible != NonAppVisibility.ALWAYS_VISIBLE:
                 if not exact_pkgname_query:
                     q = xapian.Query(xapian.Query.OP_AND,
                                      xapian.Query("ATapplication"),
                                      q)
+                    apps_only = True
 
             LOG.debug("nearly completely filtered query: '%s'" % q)
 
@@ -211,8 +388,14 @@ class AppEnquire(GObject.GObject):
             # display name - all categories / channels
             elif (self.db._axi_values and
                   "display_name" in self.db._axi_values):
-                enquire.set_sort_by_key(LocaleSorter(self.db), reverse=False)
-                # fallback to pkgname - if needed?
+                # only our own app documents have the precomputed key,
+                # the a-x-i package documents need the python sorter
+                if apps_only and self.db.has_display_name_sort_key:
+                    enquire.set_sort_by_value(
+                        XapianValues.DISPLAY_NAME_SORT_KEY, False)
+                else:
+                    enquire.set_sort_by_key(LocaleSorter(self.db),
+                                            reverse=False)
             # fallback to pkgname - if needed?
             else:
                 enquire.set_sort_by_value_then_relevance(
@@ -231,8 +414,8 @@ class AppEnquire(GObject.GObject):
             # promote exact matches to a "app", this will make the
             # show/hide technical items work correctly
             if exact_pkgname_query and len(matches) == 1:
-                self.nr_apps += 1
-                self.nr_pkgs -= 2
+                total_nr_apps += 1
+                total_nr_pkgs -= 2
 
             # add matches, but don't duplicate docids
             with ExecutionTime("append new matches to existing ones:"):
@@ -246,21 +429,60 @@ class AppEnquire(GObject.GObject):
         if (not _matches and
             self.nonapps_visible not in (NonAppVisibility.ALWAYS_VISIBLE,
                                          NonAppVisibility.NEVER_VISIBLE)):
+            if self._is_superseded(generation):
+                return
             self.nonapps_visible = NonAppVisibility.ALWAYS_VISIBLE
-            self._blocking_perform_search()
-
-        # wake up the UI if run in a search thread
-        self._perform_search_complete = True
+            self._blocking_perform_search(generation)
+            return
+
+        with self._lock:
+            if self._is_superseded(generation):
+                return
+            self._matches = _matches
+            self.match_docids = match_docids
+            self.nr_apps = total_nr_apps
+            self.nr_pkgs = total_nr_pkgs
+            if self._result_cache_key is not None:
+                key, cache_generation = self._result_cache_key
+                self._result_cache.store(
+                    key,
+                    ([m.docid for m in _matches], total_nr_apps,
+                     total_nr_pkgs, self.nonapps_visible),
+                    cache_generation)
+
+    def _get_result_cache_key(self, persistent_duplicate_filter):
+        """ return the key for the query result cache or None if the
+            result of the current query can not be cached
+        """
+        # the result depends on the matches of the previous queries or
+        # on the review stats that are refreshed in the background
+        if (persistent_duplicate_filter or
+                self.sortmode == SortMethods.BY_TOP_RATED):
+            return None
+        if self.filter and self.filter.required:
+            filter_key = self.filter.get_cache_key()
+        else:
+            filter_key = None
+        return (tuple(str(q) for q in self.search_query),
+                self.sortmode,
+                filter_key,
+                self.nonapps_visible,
+                self.limit)
+
+    def _set_cached_result(self, result):
+        docids, nr_apps, nr_pkgs, nonapps_visible = result
+        with self._lock:
+            self._matches = [CachedMSetItem(self.db, docid)
+                             for docid in docids]
+            self.match_docids = set(docids)
+            self.nr_apps = nr_apps
+            self.nr_pkgs = nr_pkgs
+            self.nonapps_visible = nonapps_visible
 
     def get_estimated_matches_count(self, query):
         with ExecutionTime("estimate item count for query: '%s'" % query):
-            enquire = xapian.Enquire(self.db.xapiandb)
-            enquire.set_query(query)
-            # no performance difference between the two
-            #tmp_matches = enquire.get_mset(0, 1, None, None)
-            #nr_pkgs = tmp_matches.get_matches_estimated()
-            tmp_matches = enquire.get_mset(0, len(self.db), None, None)
-            nr_pkgs = len(tmp_matches)
+            nr_pkgs = self.db.get_matches_count(query,
+                                                exact=self.exact_counts)
         return nr_pkgs
 
     def set_query(self, search_query,
@@ -314,10 +536,25 @@ class AppEnquire(GObject.GObject):
             self.sortmode = SortMethods.BY_ALPHABET
             self.limit = 0
 
-        # flush old query matches
-        self._matches = []
-        if not persistent_duplicate_filter:
-            self.match_docids = set()
+        # flush old query matches and mark any query that may still be
+        # running in a search worker as superseded
+        with self._lock:
+            self._generation += 1
+            self._matches = []
+            if not persistent_duplicate_filter:
+                self.match_docids = set()
+            self._result_cache_key = None
+
+        # navigating back to a previous view runs the same query again
+        key = self._get_result_cache_key(persistent_duplicate_filter)
+        if key is not None:
+            result = self._result_cache.get(key)
+            if result is not None:
+                self._set_cached_result(result)
+                if self.nonblocking_load:
+                    self.emit("query-complete")
+                return True
+            self._result_cache_key = (key, self._result_cache.generation)
 
         # we support single and list search_queries,
         # if list, we append them one by one
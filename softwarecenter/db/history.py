@@ -77,6 +77,10 @@ class PackageHistory(object):
         """Return the date that the given package name got installed """
         pass
 
+    def get_removed_date(self, pkg_name):
+        """Return the date that the given package name got removed """
+        pass
+
 
 # make it a singleton
 pkg_history = None
@@ -26,6 +26,7 @@ from gi.repository import Gio
 
 import glob
 import gzip
+from collections import deque
 import os.path
 import logging
 import string
@@ -39,6 +40,10 @@ except ImportError:
 
 LOG = logging.getLogger(__name__)
 
+from softwarecenter.backgroundsave import (
+    atomic_pickle_dump,
+    get_background_save_worker,
+)
 from softwarecenter.paths import SOFTWARE_CENTER_CACHE_DIR
 from softwarecenter.utils import ExecutionTime
 from softwarecenter.db.history import Transaction, PackageHistory
@@ -91,13 +96,16 @@ class AptHistory(PackageHistory):
         self.update_callback = None
         LOG.debug("init history")
         # this takes a long time, run it in the idle handler
-        self._transactions = []
+        self._clear()
         self._history_ready = False
         GLib.idle_add(self._rescan, use_cache)
 
     @property
     def transactions(self):
-        return self._transactions
+        # the list is only rebuilt after the history changed
+        if self._transactions_list is None:
+            self._transactions_list = list(self._transactions)
+        return self._transactions_list
 
     @property
     def history_ready(self):
@@ -108,16 +116,20 @@ class AptHistory(PackageHistory):
 
     def _rescan(self, use_cache=True):
         self._history_ready = False
-        self._transactions = []
+        self._clear()
         p = os.path.join(SOFTWARE_CENTER_CACHE_DIR, "apthistory.p")
         cachetime = 0
         if os.path.exists(p) and use_cache:
             with ExecutionTime("loading pickle cache"):
                 try:
-                    self._transactions = pickle.load(open(p))
+                    transactions = pickle.load(open(p))
                     cachetime = os.path.getmtime(p)
                 except:
                     LOG.exception("failed to load cache")
+                else:
+                    # the cache has the newest transaction first
+                    for trans in reversed(transactions):
+                        self._add_transaction(trans)
         for history_gz_file in sorted(glob.glob(self.history_file + ".*.gz"),
                                       cmp=self._mtime_cmp):
             if os.path.getmtime(history_gz_file) < cachetime:
@@ -126,7 +138,9 @@ class AptHistory(PackageHistory):
             self._scan(history_gz_file)
         self._scan(self.history_file)
         if use_cache:
-            pickle.dump(self._transactions, open(p, "w"))
+            transactions = list(self.transactions)
+            get_background_save_worker().schedule(
+                p, lambda: atomic_pickle_dump(transactions, p))
         self._history_ready = True
 
     def _scan(self, history_file, rescan=False):
@@ -150,11 +164,33 @@ class AptHistory(PackageHistory):
                     len(self._transactions) > 0 and
                     trans.start_date <= self._transactions[0].start_date):
                 continue
-            # add it
-            # FIXME: this is a list, so potentially slow, but its sorted
-            #        so we could (and should) do a binary search
-            if not trans in self._transactions:
-                self._transactions.insert(0, trans)
+            self._add_transaction(trans)
+
+    def _clear(self):
+        # the newest transaction first
+        self._transactions = deque()
+        self._transactions_list = None
+        # the start dates of all known transactions, transactions
+        # compare equal if their start dates do
+        self._start_dates = set()
+        # pkgname -> start date of the last transaction that installed
+        # (or removed) it
+        self._installed_dates = {}
+        self._removed_dates = {}
+
+    def _add_transaction(self, trans):
+        """ add trans in front of the known transactions unless it is
+            already known
+        """
+        if trans.start_date in self._start_dates:
+            return
+        self._start_dates.add(trans.start_date)
+        self._transactions.appendleft(trans)
+        self._transactions_list = None
+        for pkg in trans.install:
+            self._installed_dates[pkg.split(" ")[0]] = trans.start_date
+        for pkg in trans.remove + trans.purge:
+            self._removed_dates[pkg.split(" ")[0]] = trans.start_date
 
     def _on_apt_history_changed(self, monitor, afile, other_file, event):
         if event == Gio.FileMonitorEvent.CHANGES_DONE_HINT:
@@ -166,13 +202,10 @@ class AptHistory(PackageHistory):
         self.update_callback = update_callback
 
     def get_installed_date(self, pkg_name):
-        installed_date = None
-        for trans in self._transactions:
-            for pkg in trans.install:
-                if pkg.split(" ")[0] == pkg_name:
-                    installed_date = trans.start_date
-                    return installed_date
-        return installed_date
+        return self._installed_dates.get(pkg_name)
+
+    def get_removed_date(self, pkg_name):
+        return self._removed_dates.get(pkg_name)
 
     def _find_in_terminal_log(self, date, term_file):
         found = False
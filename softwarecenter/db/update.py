@@ -17,12 +17,16 @@
 # this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import functools
+import hashlib
+import locale
 import logging
 import json
 import re
 import os
 import string
 import shutil
+import tempfile
 import time
 import xapian
 
@@ -64,8 +68,16 @@ from softwarecenter.enums import (
     DB_SCHEMA_VERSION,
     XapianValues,
 )
-from softwarecenter.db.database import parse_axi_values_file
+from softwarecenter.db.database import (
+    CHANNEL_ORIGINS_METADATA_KEY,
+    get_channel_origins_from_db,
+    get_display_name_sort_key,
+    get_sort_key_locale,
+    is_same_locale,
+    parse_axi_values_file,
+)
 
+from contextlib import contextmanager
 from locale import getdefaultlocale
 import gettext
 
@@ -92,6 +104,17 @@ WEIGHT_APT_PKGNAME = 8
 WEIGHT_APT_SUMMARY = 5
 WEIGHT_APT_DESCRIPTION = 1
 
+# commit the database after this many documents while indexing
+INDEX_BATCH_SIZE = 1000
+
+# every document is tagged with the source file it got created from so
+# that a incremental update can replace the documents of a changed file
+SOURCE_FILE_TERM_PREFIX = "XSF"
+# metadata prefixes for the source file stamp (mtime and size) and the
+# highest popcon value of the documents of a source file
+SOURCE_STAMP_METADATA_PREFIX = "source-stamp:"
+SOURCE_POPCON_METADATA_PREFIX = "source-popcon:"
+
 # some globals (FIXME: that really need to go into a new Update class)
 popcon_max = 0
 seen = set()
@@ -135,10 +158,178 @@ def get_pkgname_terms(pkgname):
     return result
 
 
+def get_source_stamp(filename):
+    """ return a string that changes when the given file changes """
+    st = os.stat(filename)
+    return "%r %i" % (st.st_mtime, st.st_size)
+
+
+def get_apt_state_stamp():
+    """ return a string that changes when the apt package lists change
+        (e.g. after a apt-get update or when a PPA is added or removed),
+        the origin, section and candidate data of the documents is taken
+        from them
+    """
+    try:
+        import apt_pkg
+    except ImportError:
+        return ""
+    listsdir = apt_pkg.config.find_dir("Dir::State::lists")
+    stamps = []
+    for filename in sorted(glob(os.path.join(listsdir, "*"))):
+        if (os.path.basename(filename) == "lock" or
+                not os.path.isfile(filename)):
+            continue
+        stamps.append("%s %s" % (os.path.basename(filename),
+                                 get_source_stamp(filename)))
+    return hashlib.md5("\n".join(stamps)).hexdigest()
+
+
 def get_default_locale():
     return getdefaultlocale(('LANGUAGE', 'LANG', 'LC_CTYPE', 'LC_ALL'))[0]
 
 
+def get_system_collation_locale(filename="/etc/default/locale"):
+    """ return the LC_COLLATE locale that is configured for the system
+        (LC_ALL, LC_COLLATE or LANG of /etc/default/locale) or None
+    """
+    settings = {}
+    try:
+        with open(filename) as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if "=" not in line:
+                    continue
+                (key, value) = line.split("=", 1)
+                settings[key.strip()] = value.strip().strip("\"'")
+    except IOError:
+        return None
+    for key in ("LC_ALL", "LC_COLLATE", "LANG"):
+        if settings.get(key):
+            return settings[key]
+    return None
+
+
+@contextmanager
+def system_collation():
+    """ use the collation of the system locale for the sort keys
+        while indexing, the database is usually build by the dpkg trigger
+        that runs with the C locale. If the locale of a user does not
+        match, AppEnquire falls back to sorting with the LocaleSorter
+    """
+    old_locale = locale.setlocale(locale.LC_COLLATE)
+    system_locale = get_system_collation_locale()
+    if system_locale:
+        try:
+            locale.setlocale(locale.LC_COLLATE, system_locale)
+        except locale.Error as e:
+            LOG.warn("can not use the system locale %r for the sort keys: "
+                     "%s", system_locale, e)
+    try:
+        yield
+    finally:
+        locale.setlocale(locale.LC_COLLATE, old_locale)
+
+
+def _with_system_collation(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with system_collation():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class DatabaseIndexer(object):
+    """Holds the state that is shared by all documents of a indexing run.
+
+    This is a single configured xapian.TermGenerator and the result of
+    the spelling support check. Documents are committed to the database
+    in batches of `batch_size` (0 disables intermediate commits).
+    """
+
+    def __init__(self, db, batch_size=INDEX_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.term_generator = xapian.TermGenerator()
+        self.term_generator.set_database(db)
+        if self._supports_spelling(db):
+            self.term_generator.set_flags(xapian.TermGenerator.FLAG_SPELLING)
+        self.nr_docs = 0
+        self._nr_uncommitted = 0
+        self._start_time = time.time()
+        self._source_file = None
+        self._popcon_max_before = 0
+
+    @staticmethod
+    def _supports_spelling(db):
+        try:
+            # this tests if we have spelling suggestions (there must be
+            # a better way?!?) - this is needed as inmemory does not have
+            # spelling corrections, but it allows setting the flag and will
+            # raise a exception much later
+            db.add_spelling("test")
+            db.remove_spelling("test")
+        except xapian.UnimplementedError:
+            return False
+        return True
+
+    def begin_source(self, filename):
+        """Tag all following documents with the given source file and
+        record its stamp so that incremental updates can detect changes.
+        """
+        global popcon_max
+        self._source_file = filename
+        # track the popcon max of this source on its own
+        self._popcon_max_before = popcon_max
+        popcon_max = 0
+        self.db.set_metadata(SOURCE_STAMP_METADATA_PREFIX + filename,
+                             get_source_stamp(filename))
+
+    def finish_source(self):
+        """Record the popcon max of the current source file."""
+        global popcon_max
+        if self._source_file is None:
+            return
+        self.db.set_metadata(
+            SOURCE_POPCON_METADATA_PREFIX + self._source_file,
+            str(float(popcon_max)))
+        popcon_max = max(self._popcon_max_before, popcon_max)
+        self._source_file = None
+
+    def remove_source(self, filename):
+        """Remove all documents and the metadata of the given source."""
+        self.db.delete_document(SOURCE_FILE_TERM_PREFIX + filename)
+        # setting a empty value removes the metadata entry
+        self.db.set_metadata(SOURCE_STAMP_METADATA_PREFIX + filename, "")
+        self.db.set_metadata(SOURCE_POPCON_METADATA_PREFIX + filename, "")
+        self._nr_uncommitted += 1
+
+    def add_document(self, doc):
+        if self._source_file is not None:
+            doc.add_term(SOURCE_FILE_TERM_PREFIX + self._source_file)
+        self.db.add_document(doc)
+        self.nr_docs += 1
+        self._nr_uncommitted += 1
+        if self.batch_size and self._nr_uncommitted >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        """Write out the pending documents."""
+        if not self._nr_uncommitted:
+            return
+        self.db.flush()
+        self._nr_uncommitted = 0
+        LOG.debug("committed %i documents (%.1f docs/sec)",
+                  self.nr_docs, self.docs_per_second)
+
+    @property
+    def docs_per_second(self):
+        elapsed = time.time() - self._start_time
+        if elapsed <= 0:
+            return 0.0
+        return self.nr_docs / elapsed
+
+
 class AppInfoParserBase(object):
     """Base class for reading AppInfo meta-data."""
 
@@ -315,6 +506,9 @@ class AppInfoParserBase(object):
         display_name = axi_values.get("display_name")
         if display_name is not None:
             doc.add_value(display_name, name)
+        # precomputed sort key so that sorting does not need a KeyMaker
+        doc.add_value(XapianValues.DISPLAY_NAME_SORT_KEY,
+                      get_display_name_sort_key(name))
 
         # cataloged_times
         catalogedtime = axi_values.get("catalogedtime")
@@ -458,21 +652,9 @@ class AppInfoParserBase(object):
 
         return doc
 
-    def index_app_info(self, db, cache):
-        term_generator = xapian.TermGenerator()
-        term_generator.set_database(db)
-        try:
-            # this tests if we have spelling suggestions (there must be
-            # a better way?!?) - this is needed as inmemory does not have
-            # spelling corrections, but it allows setting the flag and will
-            # raise a exception much later
-            db.add_spelling("test")
-            db.remove_spelling("test")
-            # this enables the flag for it (we only reach this line if
-            # the db supports spelling suggestions)
-            term_generator.set_flags(xapian.TermGenerator.FLAG_SPELLING)
-        except xapian.UnimplementedError:
-            pass
+    def index_app_info(self, db, cache, indexer):
+        """ index the app info with the DatabaseIndexer of the run """
+        term_generator = indexer.term_generator
         doc = self.make_doc(cache)
         if not doc:
             LOG.debug("%r.index_app_info: returned invalid doc %r, ignoring.",
@@ -528,7 +710,7 @@ class AppInfoParserBase(object):
                     keyword, WEIGHT_DESKTOP_KEYWORD)
 
         # now add it
-        db.add_document(doc)
+        indexer.add_document(doc)
 
 
 class SCAApplicationParser(AppInfoParserBase):
@@ -959,26 +1141,30 @@ def ascii_upper(key):
     return key.translate(ascii_trans_table)
 
 
-def update(db, cache, datadir=None):
+def update(db, cache, datadir=None, indexer=None):
     if not datadir:
         datadir = softwarecenter.paths.APP_INSTALL_DESKTOP_PATH
-    update_from_app_install_data(db, cache, datadir)
-    update_from_var_lib_apt_lists(db, cache)
+    if indexer is None:
+        indexer = DatabaseIndexer(db)
+    update_from_app_install_data(db, cache, datadir, indexer=indexer)
+    update_from_var_lib_apt_lists(db, cache, indexer=indexer)
     # add db global meta-data
     LOG.debug("adding popcon_max_desktop %r", popcon_max)
     db.set_metadata("popcon_max_desktop",
                     xapian.sortable_serialise(float(popcon_max)))
 
 
-def update_from_json_string(db, cache, json_string, origin):
+def update_from_json_string(db, cache, json_string, origin, indexer=None):
     """Index from json string, must include origin url (free form string)."""
+    if indexer is None:
+        indexer = DatabaseIndexer(db)
     for sec in json.loads(json_string):
         parser = JsonTagSectionParser(sec, origin)
-        parser.index_app_info(db, cache)
+        parser.index_app_info(db, cache, indexer)
     return True
 
 
-def update_from_var_lib_apt_lists(db, cache, listsdir=None):
+def update_from_var_lib_apt_lists(db, cache, listsdir=None, indexer=None):
     """ index the files in /var/lib/apt/lists/*AppInfo """
     try:
         import apt_pkg
@@ -986,40 +1172,58 @@ def update_from_var_lib_apt_lists(db, cache, listsdir=None):
         return False
     if not listsdir:
         listsdir = apt_pkg.config.find_dir("Dir::State::lists")
+    if indexer is None:
+        indexer = DatabaseIndexer(db)
     context = GLib.main_context_default()
     for appinfo in glob("%s/*AppInfo" % listsdir):
         LOG.debug("processing %r", appinfo)
         # process events
         while context.pending():
             context.iteration()
+        index_appinfo_file(db, cache, appinfo, indexer)
+    return True
+
+
+def index_appinfo_file(db, cache, appinfo, indexer):
+    """ index a single /var/lib/apt/lists/*AppInfo file """
+    import apt_pkg
+    indexer.begin_source(appinfo)
+    try:
         tagf = apt_pkg.TagFile(open(appinfo))
         for section in tagf:
             parser = DesktopTagSectionParser(section, appinfo)
-            parser.index_app_info(db, cache)
-    return True
+            parser.index_app_info(db, cache, indexer)
+    finally:
+        indexer.finish_source()
 
 
-def update_from_single_appstream_file(db, cache, filename):
+def update_from_single_appstream_file(db, cache, filename, indexer):
     from lxml import etree
 
-    tree = etree.parse(open(filename))
-    root = tree.getroot()
-    if not root.tag == "applications":
-        LOG.error("failed to read %r expected Applications root tag",
-                  filename)
-        return
-    for appinfo in root.iter("application"):
-        parser = AppStreamXMLParser(appinfo, filename)
-        parser.index_app_info(db, cache)
+    indexer.begin_source(filename)
+    try:
+        tree = etree.parse(open(filename))
+        root = tree.getroot()
+        if not root.tag == "applications":
+            LOG.error("failed to read %r expected Applications root tag",
+                      filename)
+            return
+        for appinfo in root.iter("application"):
+            parser = AppStreamXMLParser(appinfo, filename)
+            parser.index_app_info(db, cache, indexer)
+    finally:
+        indexer.finish_source()
 
 
-def update_from_appstream_xml(db, cache, xmldir=None):
+def update_from_appstream_xml(db, cache, xmldir=None, indexer=None):
     if not xmldir:
         xmldir = softwarecenter.paths.APPSTREAM_XML_PATH
+    if indexer is None:
+        indexer = DatabaseIndexer(db)
     context = GLib.main_context_default()
 
     if os.path.isfile(xmldir):
-        update_from_single_appstream_file(db, cache, xmldir)
+        update_from_single_appstream_file(db, cache, xmldir, indexer)
         return True
 
     for appstream_xml in glob(os.path.join(xmldir, "*.xml")):
@@ -1027,42 +1231,54 @@ def update_from_appstream_xml(db, cache, xmldir=None):
         # process events
         while context.pending():
             context.iteration()
-        update_from_single_appstream_file(db, cache, appstream_xml)
+        update_from_single_appstream_file(db, cache, appstream_xml, indexer)
     return True
 
 
-def update_from_app_install_data(db, cache, datadir=None):
+def update_from_app_install_data(db, cache, datadir=None, indexer=None):
     """ index the desktop files in $datadir/desktop/*.desktop """
     if not datadir:
         datadir = softwarecenter.paths.APP_INSTALL_DESKTOP_PATH
+    if indexer is None:
+        indexer = DatabaseIndexer(db)
     context = GLib.main_context_default()
     for desktopf in glob(datadir + "/*.desktop") + glob(datadir + "/*.scope"):
         LOG.debug("processing %r", desktopf)
         # process events
         while context.pending():
             context.iteration()
-        try:
-            if desktopf.endswith('.scope'):
-                parser = ScopeConfigParser()
-            else:
-                parser = DesktopConfigParser()
-            parser.read(desktopf)
-            parser.index_app_info(db, cache)
-        except Exception as e:
-            # Print a warning, no error (Debian Bug #568941)
-            LOG.debug("error processing: %r %r", desktopf, e)
-            warning_text = _(
-                "The file: '%s' could not be read correctly. The application "
-                "associated with this file will not be included in the "
-                "software catalog. Please consider raising a bug report "
-                "for this issue with the maintainer of that application")
-            LOG.warning(warning_text, desktopf)
+        index_desktop_file(db, cache, desktopf, indexer)
     return True
 
 
+def index_desktop_file(db, cache, desktopf, indexer):
+    """ index a single .desktop or .scope file """
+    indexer.begin_source(desktopf)
+    try:
+        if desktopf.endswith('.scope'):
+            parser = ScopeConfigParser()
+        else:
+            parser = DesktopConfigParser()
+        parser.read(desktopf)
+        parser.index_app_info(db, cache, indexer)
+    except Exception as e:
+        # Print a warning, no error (Debian Bug #568941)
+        LOG.debug("error processing: %r %r", desktopf, e)
+        warning_text = _(
+            "The file: '%s' could not be read correctly. The application "
+            "associated with this file will not be included in the "
+            "software catalog. Please consider raising a bug report "
+            "for this issue with the maintainer of that application")
+        LOG.warning(warning_text, desktopf)
+    finally:
+        indexer.finish_source()
+
+
 def update_from_software_center_agent(db, cache, ignore_cache=False,
-                                      include_sca_qa=False):
+                                      include_sca_qa=False, indexer=None):
     """Update the index based on the software-center-agent data."""
+    if indexer is None:
+        indexer = DatabaseIndexer(db)
 
     def _available_cb(sca, available):
         LOG.debug("update_from_software_center_agent: available: %r",
@@ -1103,7 +1319,7 @@ def update_from_software_center_agent(db, cache, ignore_cache=False,
         for item in sca.available_for_me:
             try:
                 parser = SCAPurchasedApplicationParser(item)
-                parser.index_app_info(db, cache)
+                parser.index_app_info(db, cache, indexer)
                 available_for_me_pkgnames.add(item.application["package_name"])
             except:
                 LOG.exception("error processing: %r", item)
@@ -1131,7 +1347,7 @@ def update_from_software_center_agent(db, cache, ignore_cache=False,
         try:
             # now the normal parser
             parser = SCAApplicationParser(entry)
-            parser.index_app_info(db, cache)
+            parser.index_app_info(db, cache, indexer)
         except:
             LOG.exception("update_from_software_center_agent: "
                           "error processing %r:", entry.name)
@@ -1141,8 +1357,241 @@ def update_from_software_center_agent(db, cache, ignore_cache=False,
     return sca.good_data
 
 
+def _get_appstream_xml_path():
+    if os.path.exists('./data/app-stream/appdata.xml'):
+        return './data/app-stream/appdata.xml'
+    return softwarecenter.paths.APPSTREAM_XML_PATH
+
+
+def _get_index_sources(debian_sources, appstream_sources, appinfo_dir):
+    """ return the list of (kind, filename) tuples that a rebuild indexes,
+        in the same order as the serial update_from_* functions
+    """
+    sources = []
+    if debian_sources:
+        datadir = appinfo_dir or softwarecenter.paths.APP_INSTALL_DESKTOP_PATH
+        for desktopf in (glob(datadir + "/*.desktop") +
+                         glob(datadir + "/*.scope")):
+            sources.append(("desktop", desktopf))
+        try:
+            import apt_pkg
+            listsdir = apt_pkg.config.find_dir("Dir::State::lists")
+            for appinfo in glob("%s/*AppInfo" % listsdir):
+                sources.append(("appinfo", appinfo))
+        except ImportError:
+            pass
+    if appstream_sources:
+        xmldir = _get_appstream_xml_path()
+        if os.path.isfile(xmldir):
+            sources.append(("appstream", xmldir))
+        else:
+            for appstream_xml in glob(os.path.join(xmldir, "*.xml")):
+                sources.append(("appstream", appstream_xml))
+    return sources
+
+
+def set_popcon_max_metadata(db, sources):
+    """ store the highest popcon of the given (kind, filename) sources
+        as "popcon_max_desktop" metadata, based on the popcon metadata of
+        each source
+
+        Only the debian sources count, like in update() the appstream
+        sources are not included.
+    """
+    global popcon_max
+    popcon_max = 0
+    for (kind, filename) in sources:
+        if kind == "appstream":
+            continue
+        value = db.get_metadata(SOURCE_POPCON_METADATA_PREFIX + filename)
+        if value:
+            popcon_max = max(popcon_max, float(value))
+    LOG.debug("adding popcon_max_desktop %r", popcon_max)
+    db.set_metadata("popcon_max_desktop",
+                    xapian.sortable_serialise(float(popcon_max)))
+
+
+# the functions that index a single source file of the given kind
+SOURCE_INDEXERS = {
+    "appinfo": index_appinfo_file,
+    "appstream": update_from_single_appstream_file,
+    "desktop": index_desktop_file,
+}
+
+# the cache used by the shard workers, set before the workers are forked
+_shard_cache = None
+
+
+def _index_shard(args):
+    """ index the given sources into a new database at shard_path,
+        this runs in a worker process of the parallel rebuild
+    """
+    (shard_path, sources, batch_size) = args
+    db = xapian.WritableDatabase(shard_path, xapian.DB_CREATE_OR_OVERWRITE)
+    indexer = DatabaseIndexer(db, batch_size)
+    for (kind, filename) in sources:
+        LOG.debug("processing %r", filename)
+        SOURCE_INDEXERS[kind](db, _shard_cache, filename, indexer)
+    indexer.commit()
+    db.close()
+    return indexer.nr_docs
+
+
+def _rebuild_database_parallel(rebuild_path, cache, debian_sources,
+                               appstream_sources, appinfo_dir, jobs,
+                               batch_size):
+    """ index the sources with a pool of `jobs` processes into temporary
+        shard databases and merge those into a new database at rebuild_path
+
+        The shards are consecutive slices of the sources and are merged
+        in order so the docids are the same as for a serial rebuild.
+    """
+    import multiprocessing
+    global _shard_cache
+    start_time = time.time()
+    sources = _get_index_sources(
+        debian_sources, appstream_sources, appinfo_dir)
+    # use a few shards per job so that a slow shard does not stall the pool
+    nr_shards = max(1, min(len(sources), jobs * 4))
+    shard_size = (len(sources) + nr_shards - 1) // nr_shards or 1
+    tmpdir = tempfile.mkdtemp(prefix="shards-",
+                              dir=os.path.dirname(rebuild_path) or ".")
+    try:
+        shards = []
+        for i in range(0, max(len(sources), 1), shard_size):
+            shard_path = os.path.join(tmpdir, "shard-%05i" % len(shards))
+            shards.append((shard_path, sources[i:i + shard_size], batch_size))
+        _shard_cache = cache
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_index_shard, shards)
+        finally:
+            pool.close()
+            pool.join()
+            _shard_cache = None
+        # merge the shards, the docids are renumbered in the shard order
+        if os.path.exists(rebuild_path):
+            shutil.rmtree(rebuild_path)
+        compactor = xapian.Compactor()
+        compactor.set_destdir(rebuild_path)
+        for (shard_path, shard_sources, shard_batch_size) in shards:
+            compactor.add_source(shard_path)
+        compactor.compact()
+    finally:
+        shutil.rmtree(tmpdir)
+    nr_docs = sum(results)
+    elapsed = time.time() - start_time
+    LOG.info("indexed %i documents with %i jobs (%.1f docs/sec)",
+             nr_docs, jobs, nr_docs / elapsed if elapsed > 0 else 0.0)
+    db = xapian.WritableDatabase(rebuild_path, xapian.DB_OPEN)
+    if debian_sources:
+        set_popcon_max_metadata(db, sources)
+    return db
+
+
+def update_channel_origins_metadata(db):
+    """ store the channel label -> origin mapping of the db in its
+        metadata so that it does not need to be looked up in the
+        termlists at runtime
+    """
+    db.set_metadata(CHANNEL_ORIGINS_METADATA_KEY,
+                    json.dumps(get_channel_origins_from_db(db)))
+
+
+def _replace_database(pathname, rebuild_path):
+    """ move the database at rebuild_path to pathname """
+    old_path = pathname + "_old"
+    # use shutil.move() instead of os.rename() as this will automatically
+    # figure out if it can use os.rename or needs to do the move "manually"
+    try:
+        shutil.move(pathname, old_path)
+        shutil.move(rebuild_path, pathname)
+        shutil.rmtree(old_path)
+        return True
+    except:
+        LOG.warn("Cannot copy refreshed database to correct location: %r.",
+                 pathname)
+        return False
+
+
+@_with_system_collation
+def update_database_incrementally(pathname, appinfo_dir=None,
+                                  batch_size=INDEX_BATCH_SIZE):
+    """ update the database at pathname, only the documents of source
+        files that were added, changed or removed since the last run are
+        (re)indexed. The update is done in a copy of the database that
+        replaces it once it is complete.
+
+        Returns False if the database cannot be updated incrementally
+        (e.g. because of a schema version mismatch or because the apt
+        lists changed) and needs a full rebuild_database() instead.
+    """
+    try:
+        current_db = xapian.Database(pathname)
+    except xapian.Error as e:
+        LOG.info("can not update %r incrementally: %s", pathname, e)
+        return False
+    mofile = gettext.find("app-install-data")
+    if mofile:
+        mo_time = str(os.path.getctime(mofile))
+    else:
+        mo_time = ""
+    if (current_db.get_metadata("db-schema-version") != DB_SCHEMA_VERSION or
+            current_db.get_metadata("index-sources") != "debian" or
+            not is_same_locale(
+                current_db.get_metadata("display-name-sort-key-locale"),
+                get_sort_key_locale()) or
+            current_db.get_metadata("app-install-mo-time") != mo_time or
+            current_db.get_metadata("apt-state-stamp") !=
+            get_apt_state_stamp()):
+        LOG.info("database %r needs a full rebuild", pathname)
+        return False
+    current_db.close()
+
+    old_path = pathname + "_old"
+    rebuild_path = pathname + "_rb"
+    for path in (old_path, rebuild_path):
+        if os.path.exists(path):
+            LOG.warn("Removing the leftover database %r.", path)
+            shutil.rmtree(path)
+    shutil.copytree(pathname, rebuild_path)
+    cache = get_pkg_info()
+    cache.open()
+    db = xapian.WritableDatabase(rebuild_path, xapian.DB_OPEN)
+
+    indexed = {}
+    for key in db.metadata_keys(SOURCE_STAMP_METADATA_PREFIX):
+        indexed[key[len(SOURCE_STAMP_METADATA_PREFIX):]] = \
+            db.get_metadata(key)
+    sources = _get_index_sources(True, False, appinfo_dir)
+    indexer = DatabaseIndexer(db, batch_size)
+    # sources that are gone
+    current = set([filename for (kind, filename) in sources])
+    for filename in set(indexed) - current:
+        LOG.debug("removing %r", filename)
+        indexer.remove_source(filename)
+    # new or changed sources
+    for (kind, filename) in sources:
+        if indexed.get(filename) == get_source_stamp(filename):
+            continue
+        LOG.debug("reindexing %r", filename)
+        indexer.remove_source(filename)
+        SOURCE_INDEXERS[kind](db, cache, filename, indexer)
+
+    # the popcon max of the current sources, just like for a full
+    # rebuild
+    set_popcon_max_metadata(db, sources)
+    indexer.commit()
+    update_channel_origins_metadata(db)
+    db.flush()
+    db.close()
+    LOG.info("reindexed %i documents", indexer.nr_docs)
+    return _replace_database(pathname, rebuild_path)
+
+
+@_with_system_collation
 def rebuild_database(pathname, debian_sources=True, appstream_sources=False,
-                     appinfo_dir=None):
+                     appinfo_dir=None, batch_size=INDEX_BATCH_SIZE, jobs=1):
     #cache = apt.Cache(memonly=True)
     cache = get_pkg_info()
     cache.open()
@@ -1176,34 +1625,47 @@ def rebuild_database(pathname, debian_sources=True, appstream_sources=False,
             return False
 
     # write it
-    db = xapian.WritableDatabase(rebuild_path, xapian.DB_CREATE_OR_OVERWRITE)
-
-    if debian_sources:
-        update(db, cache, appinfo_dir)
-    if appstream_sources:
-        if os.path.exists('./data/app-stream/appdata.xml'):
-            update_from_appstream_xml(db, cache,
-                './data/app-stream/appdata.xml')
-        else:
-            update_from_appstream_xml(db, cache)
+    if jobs > 1:
+        db = _rebuild_database_parallel(
+            rebuild_path, cache, debian_sources, appstream_sources,
+            appinfo_dir, jobs, batch_size)
+    else:
+        db = xapian.WritableDatabase(
+            rebuild_path, xapian.DB_CREATE_OR_OVERWRITE)
+        indexer = DatabaseIndexer(db, batch_size)
+
+        if debian_sources:
+            update(db, cache, appinfo_dir, indexer=indexer)
+        if appstream_sources:
+            update_from_appstream_xml(
+                db, cache, _get_appstream_xml_path(), indexer=indexer)
+        if debian_sources:
+            # the same popcon max as the parallel and incremental paths,
+            # also when update() ran before in this process
+            set_popcon_max_metadata(db, _get_index_sources(
+                debian_sources, appstream_sources, appinfo_dir))
+        indexer.commit()
+        LOG.info("indexed %i documents (%.1f docs/sec)",
+                 indexer.nr_docs, indexer.docs_per_second)
 
     # write the database version into the file
     db.set_metadata("db-schema-version", DB_SCHEMA_VERSION)
+    # only a database build from the debian sources can be updated
+    # incrementally by update_database_incrementally()
+    db.set_metadata("index-sources", ",".join(
+        [name for (name, used) in (("debian", debian_sources),
+                                   ("appstream", appstream_sources))
+         if used]))
+    # the sort keys are only valid for the locale they got created with
+    db.set_metadata("display-name-sort-key-locale", get_sort_key_locale())
+    # the apt data in the documents is only valid for these apt lists
+    db.set_metadata("apt-state-stamp", get_apt_state_stamp())
     # update the mo file stamp for the langpack checks
     mofile = gettext.find("app-install-data")
     if mofile:
         mo_time = os.path.getctime(mofile)
         db.set_metadata("app-install-mo-time", str(mo_time))
+    update_channel_origins_metadata(db)
     db.flush()
 
-    # use shutil.move() instead of os.rename() as this will automatically
-    # figure out if it can use os.rename or needs to do the move "manually"
-    try:
-        shutil.move(pathname, old_path)
-        shutil.move(rebuild_path, pathname)
-        shutil.rmtree(old_path)
-        return True
-    except:
-        LOG.warn("Cannot copy refreshed database to correct location: %r.",
-                 pathname)
-        return False
+    return _replace_database(pathname, rebuild_path)
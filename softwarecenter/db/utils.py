@@ -52,14 +52,7 @@ def run_software_center_agent(db):
 
 def get_installed_apps_list(db):
     """ return a list of installed applications """
-    apps = set()
-    for doc in db:
-        if db.get_appname(doc):
-            pkgname = db.get_pkgname(doc)
-            if (pkgname in db._aptcache and
-                    db._aptcache[pkgname].is_installed):
-                apps.add(db.get_application(doc))
-    return apps
+    return db.get_installed_apps()
 
 
 def get_installed_package_list():
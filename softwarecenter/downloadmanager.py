@@ -0,0 +1,350 @@
+# Copyright (C) 2013 Canonical
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import itertools
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from gi.repository import GObject, GLib
+
+# py3 compat
+try:
+    from urllib.error import HTTPError
+    from urllib.parse import urlsplit
+    from urllib.request import Request, urlopen
+    HTTPError, urlsplit, Request, urlopen  # pyflakes
+except ImportError:
+    from urllib2 import HTTPError, Request, urlopen
+    from urlparse import urlsplit
+
+# py3 compat
+try:
+    import cPickle as pickle
+    pickle  # pyflakes
+except ImportError:
+    import pickle
+
+import softwarecenter.paths
+from softwarecenter.backgroundsave import (
+    atomic_pickle_dump,
+    atomic_write,
+    get_background_save_worker,
+)
+
+LOG = logging.getLogger(__name__)
+
+# lower values are downloaded first
+PRIORITY_HIGH = 0
+PRIORITY_DEFAULT = 50
+PRIORITY_LOW = 100
+
+DOWNLOAD_WORKER_THREADS = 4
+DOWNLOADS_PER_HOST = 2
+DOWNLOAD_TIMEOUT = 30
+
+# the files in the download cache dir are removed (least recently used
+# first) once they use more than this
+DOWNLOAD_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# downloaded files are used without asking the server again for this
+# many seconds, after that they are revalidated with their ETag or
+# Last-Modified header
+DOWNLOAD_CACHE_MAX_AGE = 24 * 60 * 60
+
+
+class DownloadRequest(object):
+    """ The request of a single caller for a url, the callback is
+        called as callback(path, error) in the main loop unless the
+        request was cancelled
+    """
+
+    def __init__(self, url, path, callback):
+        self.url = url
+        self.path = path
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _deliver(self, path, error):
+        if not self.cancelled:
+            self.callback(path, error)
+        return False
+
+
+class _Download(object):
+    """ A download of url to path that is shared by all the requests
+        for it
+    """
+
+    def __init__(self, url, path, priority, seq):
+        self.url = url
+        self.path = path
+        self.host = urlsplit(url).netloc
+        self.priority = priority
+        self.seq = seq
+        self.requests = []
+
+
+class DownloadManager(object):
+    """ Downloads files in a few worker threads.
+
+        Downloads run with at most max_per_host connections per server,
+        the one with the lowest priority value first. Requests for a
+        url that is already being downloaded share the download. Files
+        older than max_age are revalidated with a conditional GET and
+        the files in cache_dir are expired (least recently used first)
+        once they are bigger than max_cache_bytes.
+    """
+
+    def __init__(self, cache_dir=None, max_cache_bytes=DOWNLOAD_CACHE_MAX_BYTES,
+                 max_age=DOWNLOAD_CACHE_MAX_AGE,
+                 max_per_host=DOWNLOADS_PER_HOST,
+                 nr_threads=DOWNLOAD_WORKER_THREADS):
+        # required with older pygobject so that the workers can
+        # run while the main loop sleeps
+        GObject.threads_init()
+        if cache_dir is None:
+            cache_dir = os.path.join(
+                softwarecenter.paths.SOFTWARE_CENTER_CACHE_DIR,
+                "download-cache")
+        self.cache_dir = cache_dir
+        self.index_path = cache_dir.rstrip(os.sep) + "-index.p"
+        self.max_cache_bytes = max_cache_bytes
+        self.max_age = max_age
+        self.max_per_host = max_per_host
+        self._cond = threading.Condition()
+        self._counter = itertools.count()
+        # (url, path) -> _Download for all queued and running downloads
+        self._downloads = {}
+        self._queue = []
+        self._active_per_host = {}
+        # path -> dict with the url, etag, last_modified, size and
+        # fetched time, in least recently used order
+        self._index = self._load_index()
+        self._cache_bytes = sum(entry["size"]
+                                for (path, entry) in self._index.items()
+                                if self._is_cached(path))
+        for i in range(nr_threads):
+            t = threading.Thread(target=self._run,
+                                 name="DownloadManager-%s" % (i + 1))
+            t.daemon = True
+            t.start()
+
+    def download(self, url, path, callback, priority=PRIORITY_DEFAULT):
+        """ Download url to path and call callback(path, error) once it
+            is there. If the file is already there and fresh the
+            callback is called right away. Returns a DownloadRequest
+        """
+        request = DownloadRequest(url, path, callback)
+        with self._cond:
+            if self._is_fresh(url, path):
+                self._touch(path)
+                fresh = True
+            else:
+                fresh = False
+                key = (url, path)
+                download = self._downloads.get(key)
+                if download is None:
+                    download = _Download(
+                        url, path, priority, next(self._counter))
+                    self._downloads[key] = download
+                    self._queue.append(download)
+                    self._cond.notify()
+                download.priority = min(download.priority, priority)
+                download.requests.append(request)
+        if fresh:
+            request._deliver(path, None)
+        return request
+
+    def _is_cached(self, path):
+        return os.path.dirname(path) == self.cache_dir
+
+    def _is_fresh(self, url, path):
+        if not os.path.exists(path):
+            return False
+        entry = self._index.get(path)
+        if entry is None:
+            # files from before the index (or not downloaded by us)
+            # are used as they are
+            if self._is_cached(path):
+                self._add_entry(path, url, None, None)
+            return True
+        return (entry["url"] == url and
+                time.time() - entry["fetched"] < self.max_age)
+
+    def _touch(self, path):
+        entry = self._index.pop(path, None)
+        if entry is not None:
+            # the new order is saved with the next change of the index
+            self._index[path] = entry
+
+    def _add_entry(self, path, url, etag, last_modified):
+        old = self._index.pop(path, None)
+        size = os.path.getsize(path)
+        self._index[path] = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "size": size,
+            "fetched": time.time(),
+        }
+        if self._is_cached(path):
+            if old is not None:
+                self._cache_bytes -= old["size"]
+            self._cache_bytes += size
+            self._expire(keep=path)
+        self._schedule_save_index()
+
+    def _expire(self, keep):
+        for path in list(self._index.keys()):
+            if self._cache_bytes <= self.max_cache_bytes:
+                break
+            if path == keep or not self._is_cached(path):
+                continue
+            entry = self._index.pop(path)
+            self._cache_bytes -= entry["size"]
+            LOG.debug("expiring '%s' from the download cache", path)
+            try:
+                os.unlink(path)
+            except OSError as e:
+                LOG.warn("failed to remove '%s' (%s)", path, e)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "rb") as f:
+                index = pickle.load(f)
+        except IOError:
+            return OrderedDict()
+        except Exception:
+            LOG.exception("failed to read the download cache index")
+            return OrderedDict()
+        # forget about files that were removed behind our back
+        for path in list(index.keys()):
+            if not os.path.exists(path):
+                del index[path]
+        return index
+
+    def _schedule_save_index(self):
+        index = OrderedDict(self._index)
+        index_path = self.index_path
+        get_background_save_worker().schedule(
+            index_path, lambda: atomic_pickle_dump(index, index_path))
+
+    def _next_download(self):
+        """ return the queued download with the lowest priority value
+            whose host has a free slot
+        """
+        best = None
+        for download in self._queue:
+            if (self._active_per_host.get(download.host, 0) >=
+                    self.max_per_host):
+                continue
+            if (best is None or
+                    (download.priority, download.seq) <
+                    (best.priority, best.seq)):
+                best = download
+        if best is not None:
+            self._queue.remove(best)
+            self._active_per_host[best.host] = (
+                self._active_per_host.get(best.host, 0) + 1)
+        return best
+
+    def _run(self):
+        while True:
+            with self._cond:
+                download = self._next_download()
+                while download is None:
+                    self._cond.wait()
+                    download = self._next_download()
+                # nobody is waiting for it anymore
+                skip = all(r.cancelled for r in download.requests)
+            if not skip:
+                try:
+                    self._fetch(download)
+                    error = None
+                except Exception as e:
+                    if os.path.exists(download.path):
+                        LOG.warn("failed to revalidate '%s', using the old "
+                                 "file (%s)", download.url, e)
+                        error = None
+                    else:
+                        LOG.debug("failed to download '%s' (%s)",
+                                  download.url, e)
+                        error = e
+            with self._cond:
+                self._active_per_host[download.host] -= 1
+                requests = [r for r in download.requests if not r.cancelled]
+                if skip and requests:
+                    # it was requested again in the meantime
+                    download.requests = requests
+                    self._queue.append(download)
+                else:
+                    del self._downloads[(download.url, download.path)]
+                self._cond.notify_all()
+            if skip:
+                continue
+            for request in requests:
+                GLib.idle_add(request._deliver, download.path, error)
+
+    def _fetch(self, download):
+        """ runs in a worker thread """
+        http_request = Request(download.url)
+        with self._cond:
+            entry = self._index.get(download.path)
+            if (entry is not None and entry["url"] == download.url and
+                    os.path.exists(download.path)):
+                if entry["etag"]:
+                    http_request.add_header("If-None-Match", entry["etag"])
+                if entry["last_modified"]:
+                    http_request.add_header(
+                        "If-Modified-Since", entry["last_modified"])
+            else:
+                entry = None
+        try:
+            response = urlopen(http_request, timeout=DOWNLOAD_TIMEOUT)
+        except HTTPError as e:
+            if e.code == 304 and entry is not None:
+                LOG.debug("'%s' is not modified", download.url)
+                with self._cond:
+                    self._add_entry(download.path, download.url,
+                                    entry["etag"], entry["last_modified"])
+                return
+            raise
+        try:
+            content = response.read()
+            headers = response.info()
+        finally:
+            response.close()
+        atomic_write(download.path, lambda f: f.write(content))
+        with self._cond:
+            self._add_entry(download.path, download.url,
+                            headers.get("ETag"), headers.get("Last-Modified"))
+
+
+_download_manager = None
+
+
+def get_download_manager():
+    """ return the DownloadManager shared by the whole application """
+    global _download_manager
+    if _download_manager is None:
+        _download_manager = DownloadManager()
+    return _download_manager
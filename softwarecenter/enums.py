@@ -60,7 +60,7 @@ SOFTWARE_CENTER_TOS_LINK_NO_HEADER = "https://apps.ubuntu.com/cat/tos/plain/ "
 
 # version of the database, every time something gets added (like
 # terms for mime-type) increase this (but keep as a string!)
-DB_SCHEMA_VERSION = "7"
+DB_SCHEMA_VERSION = "8"
 
 # the default limit for a search
 DEFAULT_SEARCH_LIMIT = 10000
@@ -171,6 +171,9 @@ class XapianValues:
     DB_CATALOGED_TIME = 202
     # download size as the agent provides it
     DOWNLOAD_SIZE = 203
+    # locale.strxfrm() of the display name, see the
+    # "display-name-sort-key-locale" metadata for the locale used
+    DISPLAY_NAME_SORT_KEY = 204
 
 
 class AppInfoFields:
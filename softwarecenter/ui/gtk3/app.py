@@ -49,6 +49,7 @@ import softwarecenter.netstatus
 softwarecenter.netstatus.NETWORK_STATE
 
 from softwarecenter.backend.ubuntusso import UbuntuSSO
+from softwarecenter.backgroundsave import get_background_save_worker
 
 # db imports
 from softwarecenter.db.application import Application
@@ -628,6 +629,9 @@ class SoftwareCenterAppGtk3(SimpleGtkbuilderApp):
         # a wee bit
         self.window_main.hide()
         self.save_state()
+        # make sure the caches that are written in the background are
+        # complete before we exit
+        get_background_save_worker().flush()
         self.destroy()
 
         # this will not throw exceptions in pygi but "only" log via g_critical
@@ -23,6 +23,8 @@ from gi.repository import Gtk, GdkPixbuf
 import logging
 import os
 
+from collections import OrderedDict
+
 from gettext import gettext as _
 
 from softwarecenter.enums import (Icons,
@@ -33,7 +35,6 @@ from softwarecenter.utils import (
     ExecutionTime,
     SimpleFileDownloader,
     split_icon_ext,
-    capitalize_first_word,
     utf8,
     unescape,
 )
@@ -41,18 +42,27 @@ from softwarecenter.backend.installbackend import get_install_backend
 from softwarecenter.backend.reviews import get_review_loader
 from softwarecenter.paths import SOFTWARE_CENTER_ICON_CACHE_DIR
 
+from softwarecenter.db.approw import (
+    AppRow,
+    get_app_rows,
+    make_app_row,
+    update_app_row_state,
+)
 from softwarecenter.db.categories import (
     category_subcat,
     category_cat,
     CategoriesParser,
 )
-
-# global cache icons to speed up rendering
-_app_icon_cache = {}
-
+from softwarecenter.ui.gtk3.models.iconloader import (
+    IconLoader,
+    get_row_icons,
+)
+from softwarecenter.ui.gtk3.models.pixbufcache import (
+    get_pixbuf_cache,
+    PixbufCache,
+)
 
 LOG = logging.getLogger(__name__)
-_FREE_AS_IN_BEER = ("0.00", "")
 
 
 class CategoryRowReference:
@@ -100,6 +110,9 @@ class AppPropertiesHelper(GObject.GObject):
                           ),
     }
 
+    # the number of AppRows kept for xapian.Documents
+    MAX_CACHED_DOCUMENT_ROWS = 200
+
     def __init__(self, db, cache, icons, icon_size=48,
                  global_icon_cache=False):
         GObject.GObject.__init__(self)
@@ -119,10 +132,15 @@ class AppPropertiesHelper(GObject.GObject):
         self.icon_size = icon_size
 
         self._missing_icon = None  # delay this until actually needed
+        # pixbufs keyed by (icon_name, width, height)
         if global_icon_cache:
-            self.icon_cache = _app_icon_cache
+            self.icon_cache = get_pixbuf_cache()
         else:
-            self.icon_cache = {}
+            self.icon_cache = PixbufCache()
+        # xapian.Document -> AppRow, least recently used first
+        self._document_rows = OrderedDict()
+        # scaled icons on disk made from an older icon theme are outdated
+        self.icon_cache.set_icon_theme(self.icons)
 
     def _on_image_download_complete(
             self, downloader, image_file_path, pkgname):
@@ -138,7 +156,7 @@ class AppPropertiesHelper(GObject.GObject):
         # replace the icon in the icon_cache now that we've got the real
         # one
         icon_file = split_icon_ext(os.path.basename(image_file_path))
-        self.icon_cache[icon_file] = pb
+        self.icon_cache.set((icon_file, self.icon_size, self.icon_size), pb)
         self.emit("needs-refresh", pkgname)
 
     def _download_icon_and_show_when_ready(self, url, pkgname, icon_file_name):
@@ -161,94 +179,102 @@ class AppPropertiesHelper(GObject.GObject):
                                                       self.icon_size, 0)
         return self._missing_icon
 
+    # the following methods take a AppRow (as used in the models) or a
+    # xapian.Document
+    def get_app_row(self, doc):
+        """ return the AppRow for doc """
+        if isinstance(doc, AppRow):
+            return doc
+        # tiles and buttons keep their xapian.Document and ask for one
+        # property at a time, only the state is refreshed for them
+        row = self._document_rows.pop(doc, None)
+        if row is None:
+            row = make_app_row(self.db, self.cache, doc)
+        else:
+            row = update_app_row_state(self.cache, row)
+        self._document_rows[doc] = row
+        while len(self._document_rows) > self.MAX_CACHED_DOCUMENT_ROWS:
+            self._document_rows.popitem(last=False)
+        return row
+
+    def get_app_rows(self, docids):
+        """ return the AppRows for a batch of docids """
+        return get_app_rows(self.db, self.cache, docids)
+
     def update_availability(self, doc):
-        doc.available = None
-        doc.installed = None
-        doc.purchasable = None
-        self.is_installed(doc)
+        """ return the AppRow for doc with the availability of the
+            current cache
+        """
+        if isinstance(doc, AppRow):
+            return update_app_row_state(self.cache, doc)
+        return self.get_app_row(doc)
 
     def is_available(self, doc):
-        if doc.available is None:
-            pkgname = self.get_pkgname(doc)
-            doc.available = (
-                (pkgname in self.cache and
-                 # compare here instead of assigning .candidate to
-                 # .available to avoid leaking candidates
-                 self.cache[pkgname].candidate is not None)
-                or self.is_purchasable(doc))
-        return doc.available
+        return self.get_app_row(doc).is_available
 
     def is_installed(self, doc):
-        if doc.installed is None:
-            pkgname = self.get_pkgname(doc)
-            doc.installed = (self.is_available(doc) and
-                             pkgname in self.cache and
-                             self.cache[pkgname].is_installed)
-        return doc.installed
+        return self.get_app_row(doc).is_installed
 
     def is_purchasable(self, doc):
-        if doc.purchasable is None:
-            doc.purchasable = (doc.get_value(XapianValues.PRICE) not in
-                _FREE_AS_IN_BEER)
-        return doc.purchasable
+        return self.get_app_row(doc).is_purchasable
 
     def get_pkgname(self, doc):
+        if isinstance(doc, AppRow):
+            return doc.pkgname
         return self.db.get_pkgname(doc)
 
     def get_application(self, doc):
+        if isinstance(doc, AppRow):
+            return doc.get_application()
         return self.db.get_application(doc)
 
     def get_appname(self, doc):
-        app = self.db.get_application(doc)
-        return app.get_display_name(self.db, doc)
+        return self.get_app_row(doc).display_name
 
     def get_markup(self, doc):
-        app = self.db.get_application(doc)
-
         # the logic is that "apps" are displayed normally
-        # but "packages" are displayed with their summary as name
-        if app.appname:
-            appname = self.get_appname(doc)
-            summary = capitalize_first_word(self.db.get_summary(doc))
-        else:
-            appname = capitalize_first_word(self.db.get_summary(doc))
-            summary = self.get_pkgname(doc)
-
+        # but "packages" are displayed with their summary as name,
+        # see Application.get_display_name()
+        row = self.get_app_row(doc)
         return "%s\n<small>%s</small>" % (
-            GLib.markup_escape_text(appname),
-            GLib.markup_escape_text(summary))
+            GLib.markup_escape_text(row.display_name),
+            GLib.markup_escape_text(row.display_summary))
 
     def get_display_price(self, doc):
-        app = self.db.get_application(doc)
+        app = self.get_application(doc)
         details = app.get_details(self.db)
         return details.price
 
     def get_icon(self, doc):
+        row = self.get_app_row(doc)
         try:
-            full_icon_file_name = self.db.get_iconname(doc)
+            full_icon_file_name = row.iconname
             icon_file_name = split_icon_ext(full_icon_file_name)
             if icon_file_name:
                 icon_name = icon_file_name
-                if icon_name in self.icon_cache:
-                    return self.icon_cache[icon_name]
+                key = (icon_name, self.icon_size, self.icon_size)
                 # icons.load_icon takes between 0.001 to 0.01s on my
                 # machine, this is a significant burden because get_value
-                # is called *a lot*. caching is the only option
+                # is called *a lot*. caching is the only option, the
+                # cache also keeps the icons on disk for the next run
+                icon = self.icon_cache.lookup(key)
+                if icon is not None:
+                    return icon
 
                 # look for the icon on the iconpath
                 if self.icons.has_icon(icon_name):
                     icon = self.icons.load_icon(icon_name, self.icon_size, 0)
                     if icon:
-                        self.icon_cache[icon_name] = icon
+                        self.icon_cache.set(key, icon)
                         return icon
-                elif self.db.get_icon_download_url(doc):
-                    url = self.db.get_icon_download_url(doc)
+                elif row.icon_url:
                     self._download_icon_and_show_when_ready(
-                        url,
-                        self.get_pkgname(doc),
+                        row.icon_url,
+                        row.pkgname,
                         full_icon_file_name)
                     # display the missing icon while the real one downloads
-                    self.icon_cache[icon_name] = self.missing_icon
+                    # (only in memory so the next run looks again)
+                    self.icon_cache[key] = self.missing_icon
         except GObject.GError as e:
             LOG.debug("get_icon returned '%s'" % e)
         return self.missing_icon
@@ -282,7 +308,11 @@ class AppPropertiesHelper(GObject.GObject):
         return translated_catname
 
     def get_categories(self, doc):
-        categories = doc.get_value(XapianValues.CATEGORIES).split(';') or []
+        if isinstance(doc, AppRow):
+            categories = doc.categories
+        else:
+            categories = doc.get_value(XapianValues.CATEGORIES)
+        categories = categories.split(';') or []
         if categories and categories[0].startswith('DEPARTMENT:'):
             return _(categories[0].split('DEPARTMENT:')[1])
         for key in category_subcat:
@@ -300,9 +330,21 @@ class AppPropertiesHelper(GObject.GObject):
 
     def get_icon_at_size(self, doc, width, height):
         pixbuf = self.get_icon(doc)
-        pixbuf = pixbuf.scale_simple(width, height,
-                                     GdkPixbuf.InterpType.BILINEAR)
-        return pixbuf
+        if (pixbuf.get_width(), pixbuf.get_height()) == (width, height):
+            return pixbuf
+        is_missing = pixbuf is self.missing_icon
+        if is_missing:
+            icon_name = Icons.MISSING_APP
+        else:
+            icon_name = split_icon_ext(self.get_app_row(doc).iconname)
+        key = (icon_name, width, height)
+        scaled = self.icon_cache.lookup(key)
+        if scaled is None:
+            scaled = pixbuf.scale_simple(width, height,
+                                         GdkPixbuf.InterpType.BILINEAR)
+            # the missing icon may only be a placeholder for a download
+            self.icon_cache.set(key, scaled, save=not is_missing)
+        return scaled
 
 
 class AppGenericStore(AppPropertiesHelper):
@@ -310,7 +352,7 @@ class AppGenericStore(AppPropertiesHelper):
     # column types
     COL_TYPES = (GObject.TYPE_PYOBJECT,)
 
-    # column id
+    # column id, a AppRow (or a CategoryRowReference in a AppTreeStore)
     COL_ROW_DATA = 0
 
     # default icon size displayed in the treeview
@@ -341,6 +383,9 @@ class AppGenericStore(AppPropertiesHelper):
         self._in_progress = False
         self._break = False
 
+        # loads the icons of the current matches in the background
+        self.icon_loader = IconLoader(self)
+
         # other stuff
         self.active = False
 
@@ -361,6 +406,11 @@ class AppGenericStore(AppPropertiesHelper):
         # stub
         raise NotImplementedError
 
+    def set_row(self, it, row):
+        """ replace the AppRow of the row at it """
+        # stub
+        raise NotImplementedError
+
     # the following methods ensure that the contents data is refreshed
     # whenever a transaction potentially changes it:
     def _on_transaction_started(self, backend, pkgname, appname, trans_id,
@@ -377,48 +427,36 @@ class AppGenericStore(AppPropertiesHelper):
         pkgname = str(result.pkgname)
         if pkgname in self.transaction_path_map:
             path, it = self.transaction_path_map[pkgname]
-            doc = self.get_value(it, self.COL_ROW_DATA)
-            self.update_availability(doc)
+            row = self.get_value(it, self.COL_ROW_DATA)
+            self.set_row(it, self.update_availability(row))
             self.row_changed(path, it)
             del self.transaction_path_map[pkgname]
 
     def buffer_icons(self):
-
-        def buffer_icons():
-            #~ print "Buffering icons ..."
-            #t0 = GObject.get_current_time()
-            if self.current_matches is None:
-                return False
-            db = self.db.xapiandb
-            for m in self.current_matches:
-                doc = db.get_document(m.docid)
-
-                # calling get_icon is enough to cache the icon
-                self.get_icon(doc)
-
-                while Gtk.events_pending():
-                    Gtk.main_iteration()
-
-            #~ import sys
-            #~ t_lapsed = round(GObject.get_current_time() - t0, 3)
-            #~ print "Appstore buffered icons in %s seconds" % t_lapsed
-            #from softwarecenter.utils import get_nice_size
-            #~ cache_size = get_nice_size(sys.getsizeof(_app_icon_cache))
-            #~ print "Number of icons in cache: %s consuming: %sb" % (
-                #~ len(_app_icon_cache), cache_size)
-            return False    # remove from sources on completion
-
+        """ load the icons of the first current matches in the
+            background, the store emits "needs-refresh" when a batch of
+            them is ready
+        """
         if self.current_matches is not None:
-            GLib.idle_add(buffer_icons)
+            docids = [m.docid for m in
+                      self.current_matches[:self.icon_loader.preload_limit]]
+            # the documents are read here as the loader threads must not
+            # use the xapian database
+            self.icon_loader.load(get_row_icons(self.get_app_rows(docids)))
 
     def load_range(self, indices, step):
         # stub
         pass
 
 
-class AppListStore(Gtk.ListStore, AppGenericStore):
-    """ use for flat applist views. for large lists this appends rows approx
-        three times faster than the AppTreeStore equivalent
+class AppListStore(AppGenericStore, Gtk.TreeModel):
+    """ use for flat applist views. this is a virtual list model on top of
+        the docids of the matches, the documents are only read (a page at
+        a time) and turned into AppRows when their rows are displayed and
+        only the most recently used pages are kept in memory
+
+        like with any other model, detach it from its view before calling
+        set_from_matches() as that does not emit a signal for every row
     """
 
     __gsignals__ = {
@@ -433,73 +471,153 @@ class AppListStore(Gtk.ListStore, AppGenericStore):
                           ),
     }
 
+    # the amount of documents that are read at once
+    PAGE_SIZE = 50
+
+    # the amount of pages of documents that are kept in memory
+    MAX_CACHED_PAGES = 20
+
     def __init__(self, db, cache, icons, icon_size=AppGenericStore.ICON_SIZE,
                  global_icon_cache=True):
         AppGenericStore.__init__(
             self, db, cache, icons, icon_size, global_icon_cache)
-        Gtk.ListStore.__init__(self)
-        self.set_column_types(self.COL_TYPES)
 
         self.current_matches = None
+        self._docids = []
+        # page number -> list of documents, least recently used first
+        self._pages = OrderedDict()
+        # changes when the rows change, so old iters are no longer valid
+        self._stamp = 0
 
     def set_from_matches(self, matches):
         """ set the content of the liststore based on a list of
             xapian.MSetItems
         """
         LOG.debug("set_from_matches len(matches)='%s'" % len(matches))
+        self.icon_loader.cancel()
         self.current_matches = matches
-        n_matches = len(matches)
-        if n_matches == 0:
-            return
-
-        extent = min(self.LOAD_INITIAL, n_matches)
-
-        with ExecutionTime("store.append_initial"):
-            for doc in [m.document for m in matches][:extent]:
-                doc.available = doc.installed = doc.purchasable = None
-                self.append((doc,))
-
-        if n_matches == extent:
+        with ExecutionTime("store.set_docids"):
+            self._set_docids([m.docid for m in matches])
+        if not self._docids:
             return
-
-        with ExecutionTime("store.append_placeholders"):
-            for i in range(n_matches - extent):
-                self.append()
-
         self.emit('appcount-changed', len(matches))
         self.buffer_icons()
 
+    def _set_docids(self, docids):
+        self._docids = docids
+        self._pages.clear()
+        self._stamp += 1
+
+    def _get_page(self, page_nr):
+        page = self._pages.pop(page_nr, None)
+        if page is None:
+            start = page_nr * self.PAGE_SIZE
+            end = min(start + self.PAGE_SIZE, len(self._docids))
+            page = self.get_app_rows(self._docids[start:end])
+            while self._pages and len(self._pages) >= self.MAX_CACHED_PAGES:
+                self._pages.popitem(last=False)
+            # these rows are about to be displayed
+            self.icon_loader.prioritize(get_row_icons(page))
+        self._pages[page_nr] = page
+        return page
+
+    def get_row(self, index):
+        """ return the AppRow of the row with the given index """
+        page_nr, offset = divmod(index, self.PAGE_SIZE)
+        return self._get_page(page_nr)[offset]
+
+    def set_row(self, it, row):
+        page_nr, offset = divmod(it.user_data - 1, self.PAGE_SIZE)
+        # pages that are not in memory are read again when needed
+        if page_nr in self._pages:
+            self._pages[page_nr][offset] = row
+
     def load_range(self, indices, step):
         LOG.debug("load_range: %s %s" % (indices, step))
-        db = self.db.xapiandb
-        matches = self.current_matches
-
-        n_matches = len(matches or [])
-
         start = indices[0]
-        end = start + step
-
-        if end >= n_matches:
-            end = n_matches
-
-        for i in range(start, end):
-            try:
-                row_content = self[(i,)][0]
-            except IndexError as e:
-                LOG.warn("failed to load rows: '%s'" % e)
-                break
-
-            if row_content:
-                continue
-            doc = db.get_document(matches[i].docid)
-            doc.available = doc.installed = doc.purchasable = None
-            self[(i,)][0] = doc
+        end = min(start + step, len(self._docids))
+        for page_nr in range(start // self.PAGE_SIZE,
+                             (end - 1) // self.PAGE_SIZE + 1):
+            self._get_page(page_nr)
 
     def clear(self):
         # reset the transaction map because it will now be invalid
         self.transaction_path_map = {}
+        self.icon_loader.cancel()
         self.current_matches = None
-        Gtk.ListStore.clear(self)
+        n_rows = len(self._docids)
+        self._set_docids([])
+        for i in range(n_rows):
+            self.row_deleted(Gtk.TreePath(n_rows - i - 1))
+
+    # Gtk.TreeModel implementation, the user_data of the iters is the
+    # row index + 1 (as 0 would be NULL)
+    def _make_iter(self, index):
+        it = Gtk.TreeIter()
+        if 0 <= index < len(self._docids):
+            it.stamp = self._stamp
+            it.user_data = index + 1
+            return (True, it)
+        return (False, it)
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY | Gtk.TreeModelFlags.ITERS_PERSIST
+
+    def do_get_n_columns(self):
+        return len(self.COL_TYPES)
+
+    def do_get_column_type(self, column):
+        return self.COL_TYPES[column]
+
+    def do_get_iter(self, path):
+        indices = path.get_indices()
+        if len(indices) != 1:
+            return (False, Gtk.TreeIter())
+        return self._make_iter(indices[0])
+
+    def do_get_path(self, it):
+        return Gtk.TreePath(it.user_data - 1)
+
+    def do_get_value(self, it, column):
+        index = it.user_data - 1
+        if it.stamp != self._stamp or not 0 <= index < len(self._docids):
+            return None
+        return self.get_row(index)
+
+    def do_iter_next(self, it):
+        index = it.user_data
+        if index >= len(self._docids):
+            return False
+        it.user_data = index + 1
+        return True
+
+    def do_iter_previous(self, it):
+        index = it.user_data - 2
+        if index < 0:
+            return False
+        it.user_data = index + 1
+        return True
+
+    def do_iter_children(self, parent):
+        if parent is not None:
+            return (False, Gtk.TreeIter())
+        return self._make_iter(0)
+
+    def do_iter_has_child(self, it):
+        return False
+
+    def do_iter_n_children(self, it):
+        if it is None:
+            return len(self._docids)
+        return 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is not None:
+            return (False, Gtk.TreeIter())
+        return self._make_iter(n)
+
+    def do_iter_parent(self, child):
+        return (False, Gtk.TreeIter())
 
 
 class AppTreeStore(Gtk.TreeStore, AppGenericStore):
@@ -523,9 +641,7 @@ class AppTreeStore(Gtk.TreeStore, AppGenericStore):
 
     def set_documents(self, parent, documents):
         for doc in documents:
-            doc.available = None
-            doc.installed = doc.purchasable = None
-            self.append(parent, (doc,))
+            self.append(parent, (self.get_app_row(doc),))
 
         self.transaction_path_map = {}
 
@@ -548,6 +664,9 @@ class AppTreeStore(Gtk.TreeStore, AppGenericStore):
         self.set_documents(it, documents)
         return it
 
+    def set_row(self, it, row):
+        self.set_value(it, self.COL_ROW_DATA, row)
+
     def clear(self):
         # reset the transaction map because it will now be invalid
         self.transaction_path_map = {}
@@ -0,0 +1,277 @@
+# Copyright (C) 2013 Canonical
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import heapq
+import itertools
+import logging
+import threading
+
+from gi.repository import GObject, GLib, GdkPixbuf
+
+from softwarecenter.utils import split_icon_ext
+
+LOG = logging.getLogger(__name__)
+
+ICON_LOADER_THREADS = 2
+
+# the time (in ms) loaded icons are collected before the store is told
+# to refresh
+ICON_LOADER_BATCH_INTERVAL = 100
+
+# the amount of icon names that are looked up in the icon theme per
+# main loop iteration
+ICON_LOADER_RESOLVE_CHUNK = 20
+
+# the maximal number of rows whose icons are loaded in the background
+# before they are displayed
+ICON_LOADER_PRELOAD_ROWS = 200
+
+
+def get_row_icons(rows):
+    """ return the (icon_name, pkgname) pairs of the given AppRows """
+    return [(split_icon_ext(row.iconname), row.pkgname) for row in rows]
+
+
+class IconLoaderPool(object):
+    """
+    A small pool of persistent threads that run the jobs of all
+    IconLoaders, the job with the lowest priority value first
+    """
+
+    def __init__(self, nr_threads=ICON_LOADER_THREADS):
+        # required with older pygobject so that the workers can
+        # run while the main loop sleeps
+        GObject.threads_init()
+        self._cond = threading.Condition()
+        self._jobs = []
+        self._counter = itertools.count()
+        self._threads = []
+        for i in range(nr_threads):
+            t = threading.Thread(target=self._run,
+                                 name="IconLoader-%s" % (i + 1))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, owner, priority, func):
+        """ Run func in a worker thread, jobs with the same priority
+            are run in the order they were submitted
+        """
+        with self._cond:
+            heapq.heappush(
+                self._jobs, (priority, next(self._counter), owner, func))
+            self._cond.notify()
+
+    def cancel(self, owner):
+        """ Drop the jobs of owner that are not running yet """
+        with self._cond:
+            self._jobs = [job for job in self._jobs if job[2] is not owner]
+            heapq.heapify(self._jobs)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._jobs:
+                    self._cond.wait()
+                func = heapq.heappop(self._jobs)[3]
+            try:
+                func()
+            except Exception:
+                LOG.exception("loading icon in worker thread failed")
+
+
+_icon_loader_pool = None
+
+
+def get_icon_loader_pool():
+    global _icon_loader_pool
+    if _icon_loader_pool is None:
+        _icon_loader_pool = IconLoaderPool()
+    return _icon_loader_pool
+
+
+class IconLoader(object):
+    """
+    Loads the icons of (icon_name, pkgname) pairs (see get_row_icons())
+    into the icon_cache of a AppPropertiesHelper without blocking the
+    main loop.
+
+    The icons are decoded (or taken from the disk cache) in the
+    IconLoaderPool threads, they do not touch the xapian database. The
+    icon theme lookup of the filename runs in the main loop as
+    Gtk.IconTheme is not thread safe. Icons passed to prioritize() (e.g.
+    of the visible rows) are loaded first, load() only preloads as many
+    as fit into the icon cache next to them. The helper emits
+    "needs-refresh" (with an empty pkgname) once for every batch of
+    loaded icons.
+    """
+
+    def __init__(self, helper, pool=None):
+        self.helper = helper
+        self._pool = pool or get_icon_loader_pool()
+        self._lock = threading.Lock()
+        # changes on every cancel(), jobs of an older generation are
+        # ignored
+        self.generation = 0
+        # the icon names that are (being) loaded
+        self._started = set()
+        self._boost = 0
+        # (key, pkgname) of icons that need a icon theme lookup
+        self._unresolved = []
+        self._resolve_source = None
+        # pkgnames of the icons loaded since the last refresh
+        self._loaded = set()
+        self._refresh_source = None
+
+    @property
+    def preload_limit(self):
+        """ the number of icons load() loads in the background, at most
+            half of what fits into the icon cache so that preloading does
+            not evict the visible icons
+        """
+        size = self.helper.icon_size
+        # RGBA pixel data
+        nr_fit = self.helper.icon_cache.max_bytes // (4 * size * size)
+        return min(ICON_LOADER_PRELOAD_ROWS, nr_fit // 2)
+
+    def load(self, icons):
+        """ Load the first preload_limit of the given (icon_name,
+            pkgname) pairs (in that order), forgetting about the previous
+            ones
+        """
+        self.cancel()
+        with self._lock:
+            generation = self.generation
+        icons = list(icons)[:self.preload_limit]
+        for (index, (icon_name, pkgname)) in enumerate(icons):
+            if icon_name:
+                self._submit_load(
+                    (1, 0, index), generation, icon_name, pkgname)
+
+    def prioritize(self, icons):
+        """ Load the given (icon_name, pkgname) pairs (e.g. of the
+            visible rows) before all others
+        """
+        with self._lock:
+            self._boost += 1
+            boost = self._boost
+            generation = self.generation
+            icons = [(icon_name, pkgname) for (icon_name, pkgname) in icons
+                     if icon_name and icon_name not in self._started]
+        # the rows that became visible last are loaded first
+        for (index, (icon_name, pkgname)) in enumerate(icons):
+            self._submit_load(
+                (0, -boost, index), generation, icon_name, pkgname)
+
+    def cancel(self):
+        """ Forget about all icons that are not loaded yet """
+        with self._lock:
+            self.generation += 1
+            self._started = set()
+            self._unresolved = []
+            self._loaded = set()
+            for source_id in (self._resolve_source, self._refresh_source):
+                if source_id is not None:
+                    GLib.source_remove(source_id)
+            self._resolve_source = self._refresh_source = None
+        self._pool.cancel(self)
+
+    def _submit_load(self, priority, generation, icon_name, pkgname):
+        self._pool.submit(
+            self, priority,
+            lambda: self._load_icon(generation, icon_name, pkgname))
+
+    def _get_key(self, icon_name):
+        size = self.helper.icon_size
+        return (icon_name, size, size)
+
+    def _load_icon(self, generation, icon_name, pkgname):
+        """ runs in a worker thread """
+        with self._lock:
+            if generation != self.generation or icon_name in self._started:
+                return
+            self._started.add(icon_name)
+        key = self._get_key(icon_name)
+        icon_cache = self.helper.icon_cache
+        if key in icon_cache:
+            return
+        if icon_cache.lookup(key) is not None:
+            self._add_loaded(generation, pkgname)
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._unresolved.append((key, pkgname))
+            if self._resolve_source is None:
+                self._resolve_source = GLib.idle_add(self._resolve_icons)
+
+    def _resolve_icons(self):
+        """ runs in the main loop, looks up the filenames of a chunk of
+            icons and hands them to the workers for decoding
+        """
+        with self._lock:
+            chunk = self._unresolved[:ICON_LOADER_RESOLVE_CHUNK]
+            del self._unresolved[:ICON_LOADER_RESOLVE_CHUNK]
+            generation = self.generation
+            more = bool(self._unresolved)
+            if not more:
+                self._resolve_source = None
+        icons = self.helper.icons
+        for (key, pkgname) in chunk:
+            (icon_name, width, height) = key
+            if key in self.helper.icon_cache or not icons.has_icon(icon_name):
+                continue
+            info = icons.lookup_icon(icon_name, width, 0)
+            filename = info and info.get_filename()
+            if not filename:
+                continue
+            self._pool.submit(
+                self, (-1, 0, 0),
+                lambda key=key, filename=filename, pkgname=pkgname:
+                    self._decode_icon(generation, key, filename, pkgname))
+        return more
+
+    def _decode_icon(self, generation, key, filename, pkgname):
+        """ runs in a worker thread """
+        if generation != self.generation:
+            return
+        (icon_name, width, height) = key
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
+                filename, width, height)
+        except GObject.GError as e:
+            LOG.debug("failed to load icon '%s' (%s)", filename, e)
+            return
+        self.helper.icon_cache.set(key, pixbuf)
+        self._add_loaded(generation, pkgname)
+
+    def _add_loaded(self, generation, pkgname):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._loaded.add(pkgname)
+            if self._refresh_source is None:
+                self._refresh_source = GLib.timeout_add(
+                    ICON_LOADER_BATCH_INTERVAL, self._refresh)
+
+    def _refresh(self):
+        with self._lock:
+            loaded = self._loaded
+            self._loaded = set()
+            self._refresh_source = None
+        if loaded:
+            LOG.debug("loaded %s icons", len(loaded))
+            self.helper.emit("needs-refresh", "")
+        return False
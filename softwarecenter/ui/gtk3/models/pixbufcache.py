@@ -0,0 +1,272 @@
+# Copyright (C) 2013 Canonical
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import os
+import shutil
+import threading
+
+from collections import OrderedDict
+
+from gi.repository import GObject, GdkPixbuf, Gtk
+
+import softwarecenter.paths
+from softwarecenter.backgroundsave import (
+    atomic_write,
+    get_background_save_worker,
+)
+
+LOG = logging.getLogger(__name__)
+
+# bump this when the layout of the scaled icons on disk changes
+SCALED_ICONS_CACHE_VERSION = 1
+
+# the default amount of pixel data kept in memory, a 48px RGBA icon
+# needs ~9kB so this is enough for well over a thousand of them
+DEFAULT_PIXBUF_CACHE_BYTES = int(
+    os.environ.get("SOFTWARE_CENTER_ICON_CACHE_BYTES", 16 * 1024 * 1024))
+
+# the size of the scaled icons on disk, the least recently used ones are
+# removed when it grows beyond this
+DEFAULT_DISK_CACHE_BYTES = 32 * 1024 * 1024
+
+# the PNG text chunk with the icon theme stamp of a scaled icon on disk
+STAMP_OPTION = "tEXt::x-sc-icon-theme-stamp"
+
+
+def get_pixbuf_size(pixbuf):
+    """ return the number of bytes used by the pixel data of pixbuf """
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+def get_icon_theme_name():
+    settings = Gtk.Settings.get_default()
+    if settings is None:
+        return "default"
+    return settings.props.gtk_icon_theme_name or "default"
+
+
+def get_icon_theme_stamp(icons):
+    """ return a stamp that changes when icons of the given Gtk.IconTheme
+        are added, removed or updated: the newest mtime of its search path
+        dirs and of the icon-theme.cache files of the used themes in them
+    """
+    theme_names = (get_icon_theme_name(), "hicolor")
+    mtimes = [0]
+    for path in icons.get_search_path():
+        candidates = [path] + [os.path.join(path, name, "icon-theme.cache")
+                               for name in theme_names]
+        for candidate in candidates:
+            try:
+                mtimes.append(os.stat(candidate).st_mtime)
+            except OSError:
+                pass
+    return str(max(mtimes))
+
+
+class PixbufCache(object):
+    """ A LRU cache of pixbufs that keeps the size of their pixel data
+        below max_bytes.
+
+        The keys are (icon_name, width, height) tuples. If use_disk is
+        set, scaled icons are also written as PNGs to the software-center
+        cache dir so that the next run does not need to look them up in
+        the icon theme again. Each PNG carries the stamp of the icon theme
+        it was made from (see get_icon_theme_stamp()), icons with a
+        different stamp are removed instead of loaded. The least recently
+        used PNGs are pruned once per run to keep the disk cache below
+        max_disk_bytes.
+
+        The cache may be used from threads, only set_icon_theme() must be
+        called in the main loop as it reads the Gtk settings.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_PIXBUF_CACHE_BYTES, use_disk=True,
+                 max_disk_bytes=DEFAULT_DISK_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.use_disk = use_disk
+        self.max_disk_bytes = max_disk_bytes
+        # the stamp of the current icon theme, None to not check it
+        self.stamp = None
+        # the name of the icon theme the scaled icons on disk are from
+        self.theme_name = "default"
+        self.nr_bytes = 0
+        self._pruned = False
+        self._pixbufs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pixbufs)
+
+    def __contains__(self, key):
+        return key in self._pixbufs
+
+    def get(self, key, default=None):
+        """ return the pixbuf for key from memory (marking it as recently
+            used) or default
+        """
+        with self._lock:
+            pixbuf = self._pixbufs.pop(key, None)
+            if pixbuf is None:
+                return default
+            self._pixbufs[key] = pixbuf
+            return pixbuf
+
+    def __getitem__(self, key):
+        pixbuf = self.get(key)
+        if pixbuf is None:
+            raise KeyError(key)
+        return pixbuf
+
+    def __setitem__(self, key, pixbuf):
+        self.set(key, pixbuf, save=False)
+
+    def set(self, key, pixbuf, save=True):
+        """ add pixbuf to the memory cache and, if save is set, write it
+            to the disk cache in the background
+        """
+        size = get_pixbuf_size(pixbuf)
+        with self._lock:
+            old = self._pixbufs.pop(key, None)
+            if old is not None:
+                self.nr_bytes -= get_pixbuf_size(old)
+            self._pixbufs[key] = pixbuf
+            self.nr_bytes += size
+            # never drop the pixbuf that was just added
+            while self.nr_bytes > self.max_bytes and len(self._pixbufs) > 1:
+                (dropped_key, dropped) = self._pixbufs.popitem(last=False)
+                self.nr_bytes -= get_pixbuf_size(dropped)
+        if save and self.use_disk:
+            self._save_to_disk(key, pixbuf)
+
+    def lookup(self, key):
+        """ return the pixbuf for key from memory or from the disk cache,
+            None if it is in neither
+        """
+        pixbuf = self.get(key)
+        if pixbuf is None and self.use_disk:
+            pixbuf = self._load_from_disk(key)
+            if pixbuf is not None:
+                self.set(key, pixbuf, save=False)
+        return pixbuf
+
+    def clear(self):
+        """ drop all pixbufs from memory, the disk cache is kept """
+        with self._lock:
+            self._pixbufs.clear()
+            self.nr_bytes = 0
+
+    def set_icon_theme(self, icons):
+        """ use the scaled icons on disk that were made from the current
+            state of the given Gtk.IconTheme
+        """
+        self.theme_name = get_icon_theme_name()
+        self.stamp = get_icon_theme_stamp(icons)
+
+    def get_disk_dir(self):
+        return os.path.join(softwarecenter.paths.SOFTWARE_CENTER_CACHE_DIR,
+                            "scaled-icons")
+
+    def get_disk_path(self, key):
+        (icon_name, width, height) = key
+        return os.path.join(self.get_disk_dir(),
+                            str(SCALED_ICONS_CACHE_VERSION),
+                            self.theme_name,
+                            "%sx%s" % (width, height),
+                            icon_name.replace(os.sep, "_") + ".png")
+
+    def _load_from_disk(self, key):
+        path = self.get_disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+        except GObject.GError as e:
+            LOG.debug("failed to load scaled icon '%s' (%s)", path, e)
+            return None
+        if (self.stamp is not None and
+                pixbuf.get_option(STAMP_OPTION) != self.stamp):
+            LOG.debug("removing outdated scaled icon '%s'", path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        # the mtime is used to prune the least recently used ones
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return pixbuf
+
+    def _save_to_disk(self, key, pixbuf):
+        path = self.get_disk_path(key)
+        if self.stamp is not None:
+            (keys, values) = ([STAMP_OPTION], [self.stamp])
+        else:
+            (keys, values) = ([], [])
+
+        def _save():
+            (res, data) = pixbuf.save_to_bufferv("png", keys, values)
+            if res:
+                atomic_write(path, lambda f: f.write(data))
+        worker = get_background_save_worker()
+        worker.schedule(path, _save)
+        if not self._pruned:
+            self._pruned = True
+            worker.schedule(self.get_disk_dir(), self.prune_disk)
+
+    def prune_disk(self):
+        """ remove the scaled icons of other cache versions and the least
+            recently used ones until the disk cache is below max_disk_bytes
+        """
+        topdir = self.get_disk_dir()
+        if not os.path.isdir(topdir):
+            return
+        for name in os.listdir(topdir):
+            if name != str(SCALED_ICONS_CACHE_VERSION):
+                shutil.rmtree(os.path.join(topdir, name), ignore_errors=True)
+        icons = []
+        total = 0
+        for (dirpath, dirnames, filenames) in os.walk(topdir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                icons.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        icons.sort()
+        for (mtime, size, path) in icons:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        LOG.debug("scaled icons on disk use %i bytes", total)
+
+
+_pixbuf_cache = None
+
+
+def get_pixbuf_cache():
+    """ return the PixbufCache shared by all app stores """
+    global _pixbuf_cache
+    if _pixbuf_cache is None:
+        _pixbuf_cache = PixbufCache()
+    return _pixbuf_cache
@@ -32,7 +32,8 @@ from softwarecenter.enums import (NonAppVisibility,
 from softwarecenter.utils import (
     wait_for_apt_cache_ready, utf8, ExecutionTime)
 from softwarecenter.db.categories import (CategoriesParser,
-                                          categories_sorted_by_name)
+                                          categories_sorted_by_name,
+                                          categorise_documents)
 from softwarecenter.ui.gtk3.models.appstore2 import (
     AppTreeStore, CategoryRowReference)
 from softwarecenter.ui.gtk3.widgets.menubutton import MenuButton
@@ -41,7 +42,7 @@ from softwarecenter.ui.gtk3.widgets.spinner import SpinnerNotebook
 from softwarecenter.ui.gtk3.views.appview import AppView
 from softwarecenter.ui.gtk3.panes.softwarepane import SoftwarePane
 from softwarecenter.backend.oneconfhandler import get_oneconf_handler
-from softwarecenter.db.appfilter import AppFilter
+from softwarecenter.db.appfilter import AppFilter, get_global_filter
 
 LOG = logging.getLogger(__name__)
 
@@ -306,7 +307,7 @@ class InstalledPane(SoftwarePane, CategoriesParser):
         elif row is None:
             return False
 
-        return row.get_docid() in self.visible_docids
+        return row.docid in self.visible_docids
 
     def _use_category(self, cat):
         # System cat is large and slow to search, filter it in default mode
@@ -380,31 +381,30 @@ class InstalledPane(SoftwarePane, CategoriesParser):
             while Gtk.events_pending():
                 Gtk.main_iteration()
 
-            xfilter = AppFilter(self.db, self.cache)
-            xfilter.set_installed_only(True)
-
+            # assign each installed doc to its first matching category in
+            # a single pass instead of a filtered query per category
+            cats_and_queries = []
             for cat in self._all_cats:
-                # for each category do category query and append as a new
-                # node to tree_view
                 if not self._use_category(cat):
                     continue
-                query = self.get_query_for_cat(cat)
-                LOG.debug("xfilter.installed_only: %s" %
-                    xfilter.installed_only)
-                enq.set_query(query,
-                              sortmode=SortMethods.BY_ALPHABET,
-                              nonapps_visible=self.nonapps_visible,
-                              filter=xfilter,
-                              nonblocking_load=False,
-                              persistent_duplicate_filter=(i > 0))
-
-                L = len(enq.matches)
-                if L:
-                    i += L
-                    docs = enq.get_documents()
-                    self.cat_docid_map[cat.untranslated_name] = \
-                                        set([doc.get_docid() for doc in docs])
-                    model.set_category_documents(cat, docs)
+                cats_and_queries.append(
+                    (cat, self._get_installed_query_for_cat(cat)))
+            installed_docids = self.db.get_filter_docids("installed")
+            if get_global_filter().supported_only:
+                installed_docids = (installed_docids &
+                                    self.db.get_filter_docids("supported"))
+            categorised_docids = set()
+            for (cat, docids, docs) in categorise_documents(
+                    self.db, cats_and_queries, installed_docids):
+                i += len(docs)
+                categorised_docids.update(docids)
+                # the rows use the docids of the documents, see
+                # _row_visibility_func()
+                self.cat_docid_map[cat.untranslated_name] = set(
+                    [doc.get_docid() for doc in docs])
+                model.set_category_documents(cat, docs)
+            # the channel query below skips the categorised docs
+            enq.match_docids = categorised_docids
 
             while Gtk.events_pending():
                 Gtk.main_iteration()
@@ -630,6 +630,19 @@ class InstalledPane(SoftwarePane, CategoriesParser):
         return self.db.get_query_list_from_search_entry(
                                         self.state.search_term)
 
+    def _get_installed_query_for_cat(self, cat):
+        """ the query for the installed docs of the category, like
+            AppEnquire builds it for the current nonapps visibility
+        """
+        query = self.get_query_for_cat(cat)
+        if self.nonapps_visible != NonAppVisibility.ALWAYS_VISIBLE:
+            query = xapian.Query(xapian.Query.OP_AND,
+                                 xapian.Query("ATapplication"),
+                                 query)
+        # filter out docs of pkgs of which there exists a doc of the app
+        return xapian.Query(xapian.Query.OP_AND_NOT,
+                            query, xapian.Query("XD"))
+
     def get_query_for_cat(self, cat):
         LOG.debug("self.state.channel: %s" % self.state.channel)
         if self.state.channel and self.state.channel.query:
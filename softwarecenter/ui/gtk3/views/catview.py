@@ -22,7 +22,6 @@ import gettext
 from gi.repository import Gtk, GObject, GLib
 import logging
 import os
-import xapian
 
 from gettext import gettext as _
 
@@ -47,8 +46,8 @@ from softwarecenter.db.appfilter import AppFilter, get_global_filter
 from softwarecenter.db.enquire import AppEnquire
 from softwarecenter.db.categories import (
     Category,
-    categories_sorted_by_name)
-from softwarecenter.distro import get_distro
+    categories_sorted_by_name,
+    get_category_statistics)
 
 LOG = logging.getLogger(__name__)
 
@@ -283,31 +282,17 @@ class SubCategoryView(CategoriesView):
 
         # sort Category.name's alphabetically
         sorted_cats = categories_sorted_by_name(self.categories)
-        enquire = xapian.Enquire(self.db.xapiandb)
-        app_filter = AppFilter(self.db, self.cache)
-        distro = get_distro()
-        supported_only = get_global_filter().supported_only
-        for cat in sorted_cats:
-            # add the subcategory if and only if it is non-empty
-            if supported_only:
-                enquire.set_query(xapian.Query(xapian.Query.OP_AND,
-                                    cat.query,
-                                    distro.get_supported_query()))
-            else:
-                enquire.set_query(cat.query)
-            if len(enquire.get_mset(0, 1)):
-                tile = CategoryTile(cat.name, cat.iconname)
-                tile.connect('clicked', self.on_category_clicked, cat)
-                self.departments.add_child(tile)
+        stats = get_category_statistics(self.db)
+        # add the subcategory if and only if it is non-empty
+        for cat in stats.get_non_empty(sorted_cats):
+            tile = CategoryTile(cat.name, cat.iconname)
+            tile.connect('clicked', self.on_category_clicked, cat)
+            self.departments.add_child(tile)
 
         # partially work around a (quite rare) corner case
         if num_items == 0:
-            enquire.set_query(xapian.Query(xapian.Query.OP_AND,
-                                category.query,
-                                xapian.Query("ATapplication")))
-            # assuming that we only want apps is not always correct ^^^
-            tmp_matches = enquire.get_mset(0, len(self.db), None, app_filter)
-            num_items = tmp_matches.get_matches_estimated()
+            # assuming that we only want apps is not always correct
+            num_items = stats.get_stats(category).nr_apps
 
         # append an additional button to show all of the items in the category
         all_cat = Category("All", _("All"), "category-show-all",
@@ -41,12 +41,11 @@ from softwarecenter.ui.gtk3.widgets.recommendations import (
                                         RecommendationsPanelLobby)
 from softwarecenter.ui.gtk3.widgets.buttons import LabelTile
 from softwarecenter.db.appfilter import get_global_filter
-from softwarecenter.db.enquire import AppEnquire
 from softwarecenter.db.categories import (Category,
                                           CategoriesParser,
                                           get_category_by_name,
+                                          get_category_statistics,
                                           categories_sorted_by_name)
-from softwarecenter.distro import get_distro
 from softwarecenter.backend.scagent import SoftwareCenterAgent
 from softwarecenter.backend.reviews import get_review_loader
 
@@ -299,15 +298,10 @@ class LobbyView(CategoriesView):
         self._update_recommended_for_you_content()
 
     def _update_appcount(self):
-        enq = AppEnquire(self.cache, self.db)
-
-        distro = get_distro()
-        if get_global_filter().supported_only:
-            query = distro.get_supported_query()
-        else:
-            query = xapian.Query('')
-
-        length = enq.get_estimated_matches_count(query)
+        # the empty term matches all documents, the statistics add the
+        # supported query if needed
+        stats = get_category_statistics(self.db)
+        length = stats.get_stats_for_query(xapian.Query("")).nr_docs
         text = gettext.ngettext("%(amount)s item", "%(amount)s items", length
                                 ) % {'amount': length}
         self.appcount.set_text(text)
@@ -207,7 +207,7 @@ class AppTreeView(Gtk.TreeView):
                 CellButtonIDs.ACTION)
             if action_btn:
                 action_btn.set_sensitive(True)
-                pkgname = self.db.get_pkgname(self.selected_doc)
+                pkgname = self.appmodel.get_pkgname(self.selected_doc)
                 self._check_remove_pkg_from_blocklist(pkgname)
 
     def _on_realize(self, widget, tr):
@@ -552,7 +552,7 @@ class AppTreeView(Gtk.TreeView):
         if self.rowref_is_category(raw):
             text = raw.display_name
         elif raw:
-            text = self.db.get_pkgname(raw)
+            text = self.appmodel.get_pkgname(raw)
         else:
             # this can happen for empty/not-yet-loaded row, LP: #981992
             text = ""
@@ -22,6 +22,7 @@ from gi.repository import Gtk, Gdk, Atk, Gio, GObject, GdkPixbuf, GLib
 
 import logging
 
+from softwarecenter.downloadmanager import PRIORITY_HIGH, PRIORITY_LOW
 from softwarecenter.utils import SimpleFileDownloader
 
 from imagedialog import SimpleShowImageDialog
@@ -140,8 +141,9 @@ class ScreenshotGallery(Gtk.VBox):
             self._zoom_cursor = None
 
         # convenience class for handling the downloading (or not) of
-        # any screenshot
-        self.loader = SimpleFileDownloader()
+        # any screenshot, the visible screenshot is downloaded before
+        # the thumbnails
+        self.loader = SimpleFileDownloader(priority=PRIORITY_HIGH)
         self.loader.connect(
             'error',
             self._on_screenshot_load_error)
@@ -396,7 +398,7 @@ class Thumbnail(Gtk.Button):
             self.add(im)
             self.show_all()
 
-        loader = SimpleFileDownloader()
+        loader = SimpleFileDownloader(priority=PRIORITY_LOW)
         loader.connect("file-download-complete", download_complete_cb)
         loader.download_file(
             url, use_cache=ScreenshotGallery.USE_CACHING)
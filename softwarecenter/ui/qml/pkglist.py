@@ -22,6 +22,7 @@ import os
 from PyQt4 import QtCore
 from PyQt4.QtCore import QAbstractListModel, QModelIndex, pyqtSlot
 
+from softwarecenter.db.approw import get_app_rows
 from softwarecenter.db.database import StoreDatabase, Application
 from softwarecenter.db.pkginfo import get_pkg_info
 from softwarecenter.db.categories import CategoriesParser
@@ -44,7 +45,7 @@ class PkgListModel(QAbstractListModel):
 
     def __init__(self, parent=None):
         super(PkgListModel, self).__init__()
-        self._docs = []
+        self._rows = []
         roles = dict(enumerate(PkgListModel.COLUMNS))
         self.setRoleNames(roles)
         self._query = ""
@@ -64,21 +65,20 @@ class PkgListModel(QAbstractListModel):
 
     # QAbstractListModel code
     def rowCount(self, parent=QModelIndex()):
-        return len(self._docs)
+        return len(self._rows)
 
     def data(self, index, role):
         if not index.isValid():
             return None
-        doc = self._docs[index.row()]
+        row = self._rows[index.row()]
         role = self.COLUMNS[role]
-        pkgname = unicode(self.db.get_pkgname(doc), "utf8", "ignore")
-        appname = unicode(self.db.get_appname(doc), "utf8", "ignore")
+        pkgname = unicode(row.pkgname, "utf8", "ignore")
         if role == "_pkgname":
             return pkgname
         elif role == "_appname":
-            return appname
+            return unicode(row.display_name, "utf8", "ignore")
         elif role == "_summary":
-            return unicode(self.db.get_summary(doc))
+            return unicode(row.display_summary, "utf8", "ignore")
         elif role == "_installed":
             if not pkgname in self.cache:
                 return False
@@ -88,17 +88,14 @@ class PkgListModel(QAbstractListModel):
                 return ""
             return self.cache[pkgname].description
         elif role == "_icon":
-            iconname = self.db.get_iconname(doc)
-            return self._findIcon(iconname)
+            return self._findIcon(row.iconname)
         elif role == "_ratings_average":
-            stats = self.reviews.get_review_stats(Application(appname,
-                pkgname))
+            stats = self.reviews.get_review_stats(row.get_application())
             if stats:
                 return stats.ratings_average
             return 0
         elif role == "_ratings_total":
-            stats = self.reviews.get_review_stats(Application(appname,
-                pkgname))
+            stats = self.reviews.get_review_stats(row.get_application())
             if stats:
                 return stats.ratings_total
             return 0
@@ -127,18 +124,20 @@ class PkgListModel(QAbstractListModel):
         return path
 
     def clear(self):
-        if self._docs == []:
+        if self._rows == []:
             return
         self.beginRemoveRows(QModelIndex(), 0, self.rowCount() - 1)
-        self._docs = []
+        self._rows = []
         self.endRemoveRows()
 
     def _runQuery(self, querystr):
         self.clear()
-        docs = self.db.get_docs_from_query(
+        matches = self.db.get_matches_from_query(
             str(querystr), start=0, end=500, category=self._category)
-        self.beginInsertRows(QModelIndex(), 0, len(docs) - 1)
-        self._docs = docs
+        rows = get_app_rows(self.db, self.cache,
+                            [m.docid for m in matches])
+        self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+        self._rows = rows
         self.endInsertRows()
 
     # install/remove interface (for qml)
@@ -46,6 +46,7 @@ from paths import (
 )
 
 from config import get_config
+from downloadmanager import get_download_manager, PRIORITY_DEFAULT
 
 from gettext import gettext as _
 
@@ -845,6 +846,9 @@ def get_oem_channel_descriptor(path=OEM_CHANNEL_DESCRIPTOR):
 
 
 class SimpleFileDownloader(GObject.GObject):
+    """ Downloads a single url at a time with the shared DownloadManager
+        and emits signals when it is done
+    """
 
     LOG = logging.getLogger("softwarecenter.simplefiledownloader")
 
@@ -863,10 +867,13 @@ class SimpleFileDownloader(GObject.GObject):
                    GObject.TYPE_PYOBJECT,),),
     }
 
-    def __init__(self):
+    def __init__(self, priority=PRIORITY_DEFAULT):
         GObject.GObject.__init__(self)
         self.tmpdir = None
-        self._cancellable = None
+        self.priority = priority
+        self.url = None
+        self.dest_file_path = None
+        self._request = None
 
     def download_file(self, url, dest_file_path=None, use_cache=False,
                       simple_quoting_for_webkit=False):
@@ -876,19 +883,17 @@ class SimpleFileDownloader(GObject.GObject):
             If dest_file_path is given, download to that specific
             local filename.
             If use_cache is given it will not use a tempdir, but
-            instead a permanent cache dir - no etag or timestamp
-            checks are performed.
+            instead a permanent cache dir that is size limited and
+            revalidated with the etag or timestamp of the file.
         """
         self.LOG.debug(
             "download_file: %s %s %s" % (url, dest_file_path, use_cache))
 
         # cancel anything pending to avoid race conditions
         # like bug #839462
-        if self._cancellable:
-            self._cancellable.cancel()
-            self._cancellable.reset()
-        else:
-            self._cancellable = Gio.Cancellable()
+        if self._request:
+            self._request.cancel()
+            self._request = None
 
         # no need to cache file urls and no need to really download
         # them, its enough to adjust the dest_file_path
@@ -916,78 +921,27 @@ class SimpleFileDownloader(GObject.GObject):
         self.url = url
         self.dest_file_path = dest_file_path
 
-        # FIXME: we actually need to do etag based checking here to see
-        #        if the source needs refreshing
-        if os.path.exists(self.dest_file_path):
-            self.emit('file-url-reachable', True)
-            self.emit("file-download-complete", self.dest_file_path)
+        if url.startswith("file:"):
+            if os.path.exists(dest_file_path):
+                self._on_download_finished(dest_file_path, None)
+            else:
+                self._on_download_finished(dest_file_path, IOError(
+                    errno.ENOENT, "No such file", dest_file_path))
             return
 
-        f = Gio.File.new_for_uri(url)
-        # first check if the url is reachable
-        f.query_info_async(Gio.FILE_ATTRIBUTE_STANDARD_SIZE, 0, 0,
-                           self._cancellable,
-                           self._check_url_reachable_and_then_download_cb,
-                           url)
-
-    def _ensure_correct_url(self, want_url):
-        """This function will ensure that the url we requested to download
-           earlier matches that is now downloaded.
-        """
-        # this function is needed as there is a race condition when the
-        # operation is finished but the signal is not delivered yet (it's
-        # still in the gtk event loop). in this case there is nothing to
-        # self._cancel but self.url/self.dest_file_path will still point to
-        # the wrong file
-        if self.url != want_url:
-            self.LOG.warn(
-                "url changed from '%s' to '%s'" % (want_url, self.url))
-            return False
-        return True
+        self._request = get_download_manager().download(
+            url, dest_file_path, self._on_download_finished, self.priority)
 
-    def _check_url_reachable_and_then_download_cb(self, f, result, want_url):
-        self.LOG.debug("_check_url_reachable_and_then_download_cb: %s" % f)
-        if not self._ensure_correct_url(want_url):
-            return
-        # normal operation
-        try:
-            info = f.query_info_finish(result)
-            etag = info.get_etag()
-            self.emit('file-url-reachable', True)
-            self.LOG.debug("file reachable %s %s %s" % (self.url,
-                                                        info,
-                                                        etag))
-            # url is reachable, now download the file
-            f.load_contents_async(
-                self._cancellable, self._file_download_complete_cb, want_url)
-        except GObject.GError as e:
+    def _on_download_finished(self, path, error):
+        self._request = None
+        if error is not None:
             self.LOG.debug("file *not* reachable %s" % self.url)
             self.emit('file-url-reachable', False)
-            self.emit('error', GObject.GError, e)
-        del f
-
-    def _file_download_complete_cb(self, f, result, want_url):
-        self.LOG.debug("file download completed %s" % self.dest_file_path)
-        if not self._ensure_correct_url(want_url):
-            return
-        # The result from the download is actually a tuple with three
-        # elements (content, size, etag?)
-        # The first element is the actual content so let's grab that
-        try:
-            res, content, etag = f.load_contents_finish(result)
-        except Exception as e:
-            # I witnessed a strange error[1], so make the loader robust in this
-            # situation
-            # 1. content = f.load_contents_finish(result)[0]
-            #    Gio.Error: DBus error org.freedesktop.DBus.Error.NoReply
-            self.LOG.debug(e)
-            self.emit('error', Exception, e)
+            self.emit('error', type(error), error)
             return
-        # write out the data
-        outputfile = open(self.dest_file_path, "w")
-        outputfile.write(content)
-        outputfile.close()
-        self.emit('file-download-complete', self.dest_file_path)
+        self.LOG.debug("file download completed %s" % path)
+        self.emit('file-url-reachable', True)
+        self.emit('file-download-complete', path)
 
 
 # those helpers are packaging-system specific
@@ -1,3 +1,4 @@
+import time
 import unittest
 import xapian
 
@@ -12,6 +13,7 @@ from tests.utils import (
 )
 setup_test_env()
 
+from softwarecenter.db.approw import AppRow, make_app_row
 from softwarecenter.ui.gtk3.models.appstore2 import AppListStore
 from softwarecenter.db.enquire import AppEnquire
 
@@ -38,6 +40,27 @@ class AppStoreTestCase(unittest.TestCase):
             translated = model._category_translate(untranslated)
             self.assertNotEqual(untranslated, translated)
 
+    def test_app_row_of_document(self):
+        model = AppListStore(self.db, self.cache, self.icons)
+        doc = self.db.xapiandb.get_document(1)
+        with patch("softwarecenter.ui.gtk3.models.appstore2.make_app_row",
+                   wraps=make_app_row) as mock_make_app_row:
+            model.is_installed(doc)
+            model.is_available(doc)
+            model.get_markup(doc)
+            model.get_icon(doc)
+            self.assertEqual(mock_make_app_row.call_count, 1)
+            # the state follows the cache
+            row = model.get_app_row(doc)._replace(state=0)
+            with patch("softwarecenter.ui.gtk3.models.appstore2."
+                       "update_app_row_state", return_value=row):
+                self.assertFalse(model.is_available(doc))
+            # only the recently used documents are kept
+            model.MAX_CACHED_DOCUMENT_ROWS = 1
+            model.get_app_row(self.db.xapiandb.get_document(2))
+            model.get_app_row(doc)
+            self.assertEqual(mock_make_app_row.call_count, 3)
+
     def test_app_store(self):
         # get a enquire object
         enquirer = AppEnquire(self.cache, self.db)
@@ -50,25 +73,52 @@ class AppStoreTestCase(unittest.TestCase):
         self.assertEqual(len(model), 0)
         model.set_from_matches(enquirer.matches)
         self.assertTrue(len(model) > 0)
-        # ensure the first row has a xapian doc type
-        self.assertEqual(type(model[0][0]), xapian.Document)
-        # lazy loading of the docs
-        self.assertEqual(model[100][0], None)
+        self.assertEqual(len(model), len(enquirer.matches))
+        # ensure the first row is a AppRow
+        self.assertEqual(type(model[0][0]), AppRow)
+        # lazy loading of the docs, a page at a time
+        self.assertEqual(list(model._pages.keys()), [0])
+        self.assertEqual(model[100][0].docid,
+                         enquirer.matches[100].docid)
+        self.assertEqual(list(model._pages.keys()), [0, 2])
 
         # test the load range stuff
-        model.load_range(indices=[100], step=15)
-        self.assertEqual(type(model[100][0]), xapian.Document)
+        model.load_range(indices=[140], step=15)
+        self.assertEqual(list(model._pages.keys()), [0, 2, 3])
 
-        # ensure buffer_icons works and loads stuff into the cache
+        # only the most recently used pages are kept
+        model.MAX_CACHED_PAGES = 2
+        model[0][0]
+        model[50][0]
+        self.assertEqual(list(model._pages.keys()), [0, 1])
+
+        # ensure buffer_icons works and loads stuff into the cache in
+        # the background
+        model.icon_cache.clear()
         model.buffer_icons()
-        self.assertEqual(len(model.icon_cache), 0)
-        do_events()
+        for i in range(100):
+            do_events()
+            if len(model.icon_cache) > 0:
+                break
+            time.sleep(0.05)
         self.assertTrue(len(model.icon_cache) > 0)
 
         # ensure clear works
         model.clear()
         self.assertEqual(model.current_matches, None)
 
+    def test_get_icon_at_size(self):
+        model = AppListStore(self.db, self.cache, self.icons)
+        model.icon_cache.use_disk = False
+        enquirer = AppEnquire(self.cache, self.db)
+        enquirer.set_query(xapian.Query(""))
+        doc = enquirer.matches[0].document
+        icon = model.get_icon_at_size(doc, 16, 16)
+        self.assertEqual(icon.get_width(), 16)
+        # the scaled icon is cached per size
+        self.assertTrue(model.get_icon_at_size(doc, 16, 16) is icon)
+        self.assertEqual(model.get_icon_at_size(doc, 24, 24).get_width(), 24)
+
     def test_lp971776(self):
         """ ensure that refresh is not called for invalid image files """
         model = AppListStore(self.db, self.cache, self.icons)
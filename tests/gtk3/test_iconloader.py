@@ -0,0 +1,88 @@
+import heapq
+import unittest
+
+from mock import Mock
+
+from tests.utils import (
+    setup_test_env,
+)
+setup_test_env()
+
+from softwarecenter.db.approw import AppRow
+from softwarecenter.ui.gtk3.models.iconloader import (
+    ICON_LOADER_PRELOAD_ROWS,
+    IconLoader,
+    IconLoaderPool,
+    get_row_icons,
+)
+
+
+def make_icons(indices):
+    return [("icon%i" % i, "pkg%i" % i) for i in indices]
+
+
+def make_helper(max_bytes=16 * 1024 * 1024):
+    helper = Mock()
+    helper.icon_size = 48
+    helper.icon_cache.max_bytes = max_bytes
+    return helper
+
+
+class IconLoaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # no worker threads, the jobs are inspected by the tests
+        self.pool = IconLoaderPool(nr_threads=0)
+        self.loader = IconLoader(make_helper(), pool=self.pool)
+        self.loader._load_icon = Mock()
+
+    def _run_jobs(self):
+        while self.pool._jobs:
+            heapq.heappop(self.pool._jobs)[3]()
+        return [call[0][1] for call in self.loader._load_icon.call_args_list]
+
+    def test_visible_rows_first(self):
+        self.loader.load(make_icons(range(10)))
+        self.loader.prioritize(make_icons([7, 8]))
+        self.loader.prioritize(make_icons([3, 4]))
+        # the rows that became visible last come first, then the
+        # others in order
+        self.assertEqual(self._run_jobs()[:6],
+                         ["icon3", "icon4", "icon7", "icon8",
+                          "icon0", "icon1"])
+
+    def test_preload_limit(self):
+        self.loader.load(make_icons(range(ICON_LOADER_PRELOAD_ROWS + 10)))
+        self.assertEqual(len(self.pool._jobs), ICON_LOADER_PRELOAD_ROWS)
+        # at most half of the icon cache is used for preloading
+        loader = IconLoader(make_helper(max_bytes=10 * 4 * 48 * 48),
+                            pool=self.pool)
+        self.assertEqual(loader.preload_limit, 5)
+        # rows without icon are skipped
+        self.pool._jobs = []
+        loader.load([("", "pkg0"), ("icon1", "pkg1")])
+        self.assertEqual(len(self.pool._jobs), 1)
+
+    def test_get_row_icons(self):
+        row = AppRow(1, "pkg", "app", "App", "summary", "icon.png", None,
+                     "", "", 0)
+        self.assertEqual(get_row_icons([row]), [("icon", "pkg")])
+
+    def test_cancel(self):
+        other = IconLoader(make_helper(), pool=self.pool)
+        other.load(make_icons(range(5)))
+        self.loader.load(make_icons(range(10)))
+        generation = self.loader.generation
+        self.loader.cancel()
+        self.assertNotEqual(self.loader.generation, generation)
+        # only the jobs of the other loader are left
+        self.assertEqual(len(self.pool._jobs), 5)
+        self.assertTrue(all(job[2] is other for job in self.pool._jobs))
+        # a new load replaces the previous one
+        self.loader.load(make_icons(range(3)))
+        self.loader.load(make_icons(range(2)))
+        self.assertEqual(len(self.pool._jobs), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
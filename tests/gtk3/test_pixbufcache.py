@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from gi.repository import GdkPixbuf
+from mock import Mock, patch
+
+from tests.utils import (
+    setup_test_env,
+)
+setup_test_env()
+
+from softwarecenter.backgroundsave import get_background_save_worker
+from softwarecenter.ui.gtk3.models.pixbufcache import (
+    get_icon_theme_stamp,
+    get_pixbuf_size,
+    PixbufCache,
+)
+
+
+def make_pixbuf(size):
+    pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8,
+                                  size, size)
+    pixbuf.fill(0)
+    return pixbuf
+
+
+class PixbufCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = patch("softwarecenter.paths.SOFTWARE_CENTER_CACHE_DIR",
+                        self.tmpdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_byte_budget(self):
+        pixbuf_size = get_pixbuf_size(make_pixbuf(32))
+        cache = PixbufCache(max_bytes=2 * pixbuf_size, use_disk=False)
+        cache[("a", 32, 32)] = make_pixbuf(32)
+        cache[("b", 32, 32)] = make_pixbuf(32)
+        # "a" is now the most recently used one
+        self.assertNotEqual(cache.get(("a", 32, 32)), None)
+        cache[("c", 32, 32)] = make_pixbuf(32)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(("a", 32, 32) in cache)
+        self.assertFalse(("b", 32, 32) in cache)
+        self.assertEqual(cache.nr_bytes, 2 * pixbuf_size)
+        # a pixbuf bigger than the budget is still kept on its own
+        cache[("d", 64, 64)] = make_pixbuf(64)
+        self.assertEqual(len(cache), 1)
+
+    def test_disk_tier(self):
+        cache = PixbufCache()
+        key = ("software-center", 24, 24)
+        cache.set(key, make_pixbuf(24))
+        self.assertTrue(get_background_save_worker().flush())
+        self.assertTrue(os.path.exists(cache.get_disk_path(key)))
+        # a new cache (e.g. on the next run) finds it on disk
+        cache = PixbufCache()
+        self.assertFalse(key in cache)
+        pixbuf = cache.lookup(key)
+        self.assertEqual(pixbuf.get_width(), 24)
+        self.assertTrue(key in cache)
+        # pixbufs that are only set in memory are not written
+        cache[("placeholder", 24, 24)] = make_pixbuf(24)
+        self.assertTrue(get_background_save_worker().flush())
+        self.assertFalse(os.path.exists(
+            cache.get_disk_path(("placeholder", 24, 24))))
+
+    def test_disk_tier_outdated_theme(self):
+        cache = PixbufCache()
+        cache.stamp = "1"
+        key = ("software-center", 24, 24)
+        cache.set(key, make_pixbuf(24))
+        self.assertTrue(get_background_save_worker().flush())
+        cache = PixbufCache()
+        cache.stamp = "1"
+        self.assertNotEqual(cache.lookup(key), None)
+        # the icon theme changed since the icon was scaled
+        cache = PixbufCache()
+        cache.stamp = "2"
+        self.assertEqual(cache.lookup(key), None)
+        self.assertFalse(os.path.exists(cache.get_disk_path(key)))
+
+    def test_set_icon_theme(self):
+        cache = PixbufCache()
+        icons = Mock()
+        icons.get_search_path.return_value = [self.tmpdir]
+        with patch("softwarecenter.ui.gtk3.models.pixbufcache."
+                   "get_icon_theme_name", return_value="Humanity"):
+            cache.set_icon_theme(icons)
+        self.assertEqual(cache.theme_name, "Humanity")
+        self.assertNotEqual(cache.stamp, None)
+        # the disk path (used by the loader threads) does not read the
+        # Gtk settings
+        with patch("softwarecenter.ui.gtk3.models.pixbufcache."
+                   "get_icon_theme_name") as mock_theme_name:
+            path = cache.get_disk_path(("icon", 24, 24))
+            self.assertFalse(mock_theme_name.called)
+        self.assertTrue("/Humanity/" in path)
+
+    def test_icon_theme_stamp(self):
+        icons = Mock()
+        icons.get_search_path.return_value = [self.tmpdir, "/no/such/dir"]
+        stamp = get_icon_theme_stamp(icons)
+        os.utime(self.tmpdir, (0, 0))
+        self.assertNotEqual(get_icon_theme_stamp(icons), stamp)
+        self.assertEqual(get_icon_theme_stamp(icons), "0")
+
+    def test_prune_disk(self):
+        pixbuf_size = len(make_pixbuf(24).save_to_bufferv("png", [], [])[1])
+        cache = PixbufCache(max_disk_bytes=2 * pixbuf_size)
+        keys = [("icon%i" % i, 24, 24) for i in range(3)]
+        for (i, key) in enumerate(keys):
+            cache.set(key, make_pixbuf(24))
+            self.assertTrue(get_background_save_worker().flush())
+            os.utime(cache.get_disk_path(key), (i, i))
+        old_version_dir = os.path.join(cache.get_disk_dir(), "0")
+        os.makedirs(old_version_dir)
+        cache.prune_disk()
+        self.assertFalse(os.path.exists(old_version_dir))
+        # the least recently used one is gone
+        self.assertEqual([os.path.exists(cache.get_disk_path(key))
+                          for key in keys], [False, True, True])
+
+
+if __name__ == "__main__":
+    unittest.main()
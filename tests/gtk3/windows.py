@@ -170,8 +170,11 @@ def on_entry_changed(widget, data):
             with ExecutionTime("store.clear()"):
                 store.clear()
 
-            with ExecutionTime("store.set_from_matches()"):
-                store.set_from_matches(enquirer.matches)
+            # display_matches() detaches the store from the view while
+            # the rows are set, set_from_matches() does not emit a
+            # signal for every new row
+            with ExecutionTime("view.display_matches()"):
+                view.display_matches(enquirer.matches)
 
             with ExecutionTime("model settle (size=%s)" % len(store)):
                 do_events()
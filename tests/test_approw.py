@@ -0,0 +1,72 @@
+import itertools
+import unittest
+
+from tests.utils import (
+    get_test_db,
+    get_test_pkg_info,
+    setup_test_env,
+)
+setup_test_env()
+
+from softwarecenter.db.application import Application
+from softwarecenter.db.approw import (
+    AppRow,
+    get_app_rows,
+    make_app_row,
+    update_app_row_state,
+)
+from softwarecenter.enums import XapianValues
+
+
+class TestAppRow(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cache = get_test_pkg_info()
+        cls.db = get_test_db()
+
+    def test_make_app_row(self):
+        # a free app that is in the cache
+        for doc in self.db:
+            pkgname = self.db.get_pkgname(doc)
+            if (self.db.get_appname(doc) and pkgname in self.cache and
+                    not doc.get_value(XapianValues.PRICE)):
+                break
+        row = make_app_row(self.db, self.cache, doc)
+        self.assertEqual(row.docid, doc.get_docid())
+        self.assertEqual(row.pkgname, pkgname)
+        self.assertEqual(row.appname, self.db.get_appname(doc))
+        self.assertEqual(row.display_name,
+                         Application.get_display_name(self.db, doc))
+        self.assertEqual(row.display_summary,
+                         Application.get_display_summary(self.db, doc))
+        self.assertEqual(row.iconname, self.db.get_iconname(doc))
+        self.assertEqual(row.categories,
+                         doc.get_value(XapianValues.CATEGORIES))
+        self.assertEqual(row.get_application(),
+                         self.db.get_application(doc))
+        pkg = self.cache[pkgname]
+        self.assertEqual(row.is_available, pkg.candidate is not None)
+        self.assertEqual(row.is_installed,
+                         row.is_available and pkg.is_installed)
+        self.assertFalse(row.is_purchasable)
+        # rows are immutable
+        self.assertRaises(AttributeError, setattr, row, "pkgname", "foo")
+        self.assertRaises(AttributeError, setattr, row, "foo", "bar")
+
+    def test_app_row_state(self):
+        row = AppRow(1, "foo", "Foo", "Foo", "foo", "foo", "", "1.00", "",
+                     AppRow.INSTALLED)
+        row = update_app_row_state(self.cache, row)
+        # not in the cache but for sale
+        self.assertEqual(row.state, AppRow.AVAILABLE | AppRow.PURCHASABLE)
+        self.assertEqual(row.pkgname, "foo")
+
+    def test_get_app_rows(self):
+        docids = [doc.get_docid() for doc in itertools.islice(self.db, 10)]
+        rows = get_app_rows(self.db, self.cache, docids)
+        self.assertEqual([row.docid for row in rows], docids)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -43,6 +43,25 @@ class TestAptHistory(unittest.TestCase):
         self.assertEqual(history.transactions[1].upgrade,
                          ['acl (2.2.49-2, 2.2.49-3)'])
 
+    def test_installed_and_removed_date(self):
+        history = self._get_apt_history()
+        self.assertEqual(history.get_installed_date("gstreamer0.10-ffmpeg"),
+                         datetime.datetime(2010, 6, 1, 12, 18, 35))
+        self.assertEqual(history.get_removed_date("gstreamer0.10-ffmpeg"),
+                         datetime.datetime(2010, 6, 1, 11, 3, 12))
+        # the architecture is stripped
+        self.assertEqual(history.get_installed_date("4g8"),
+                         datetime.datetime(2010, 6, 1, 9, 22, 21))
+        self.assertEqual(history.get_installed_date("no-such-pkg"), None)
+        self.assertEqual(history.get_removed_date("no-such-pkg"), None)
+
+    def test_rescan_ignores_known_transactions(self):
+        history = self._get_apt_history()
+        history._scan(history.history_file)
+        self.assertEqual(len(history.transactions), 186)
+        history._scan(history.history_file, rescan=True)
+        self.assertEqual(len(history.transactions), 186)
+
     def _glib_timeout(self):
         self._timeouts.append(time.time())
         return True
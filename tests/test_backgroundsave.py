@@ -0,0 +1,66 @@
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import unittest
+
+from tests.utils import (
+    setup_test_env,
+)
+setup_test_env()
+
+from softwarecenter.backgroundsave import (
+    atomic_pickle_dump,
+    BackgroundSaveWorker,
+)
+
+
+class Unpicklable(object):
+
+    def __reduce__(self):
+        raise ValueError("can not be pickled")
+
+
+class TestBackgroundSave(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_atomic_pickle_dump(self):
+        path = os.path.join(self.tmpdir, "sub", "cache.p")
+        atomic_pickle_dump({"1": True}, path)
+        self.assertEqual(pickle.load(open(path)), {"1": True})
+        # a failing dump keeps the old file and leaves no temp file behind
+        self.assertRaises(
+            ValueError, atomic_pickle_dump, Unpicklable(), path)
+        self.assertEqual(pickle.load(open(path)), {"1": True})
+        self.assertEqual(os.listdir(os.path.dirname(path)), ["cache.p"])
+
+    def test_coalesce_and_flush(self):
+        worker = BackgroundSaveWorker()
+        blocker = threading.Event()
+        saved = []
+        # keep the worker busy so that the next requests are pending
+        worker.schedule("block", blocker.wait)
+        for i in range(5):
+            worker.schedule("votes", lambda i=i: saved.append(i))
+        self.assertFalse(worker.flush(timeout=0.1))
+        blocker.set()
+        self.assertTrue(worker.flush())
+        # only the last pending request for a key is run
+        self.assertEqual(saved, [4])
+        self.assertTrue("votes" in worker.save_durations)
+
+    def test_failing_save_does_not_stop_worker(self):
+        worker = BackgroundSaveWorker()
+        saved = []
+        worker.schedule("broken", lambda: 1 / 0)
+        worker.schedule("ok", lambda: saved.append(True))
+        self.assertTrue(worker.flush())
+        self.assertEqual(saved, [True])
+
+
+if __name__ == "__main__":
+    unittest.main()
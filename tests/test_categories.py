@@ -10,10 +10,16 @@ from tests.utils import (
 )
 setup_test_env()
 
+import softwarecenter.distro
+from softwarecenter.backgroundsave import get_background_save_worker
+from softwarecenter.db.appfilter import get_global_filter
 from softwarecenter.db.categories import (
     CategoriesParser,
+    CategoryStatistics,
     RecommendedForYouCategory,
+    categorise_documents,
     get_category_by_name, get_query_for_category)
+from softwarecenter.enums import XapianValues
 
 
 class TestCategories(unittest.TestCase):
@@ -55,6 +61,92 @@ class TestCategories(unittest.TestCase):
         query = get_query_for_category(self.db, "Education")
         self.assertNotEqual(query, None)
 
+    def test_categorise_documents(self):
+        parser = CategoriesParser(self.db)
+        cats = parser.parse_applications_menu(DATA_DIR)
+        all_docids = set([m.docid for m in self.db.xapiandb.postlist("")])
+        # a catch-all category after the real ones only gets the rest
+        all_apps = xapian.Query("ATapplication")
+        cats_and_queries = [(cat, cat.query) for cat in cats]
+        cats_and_queries.append(("rest", all_apps))
+        categorised = categorise_documents(
+            self.db, cats_and_queries, all_docids)
+        self.assertNotEqual(categorised, [])
+        seen = set()
+        for (cat, docids, docs) in categorised:
+            self.assertEqual(len(docids), len(docs))
+            docids = set(docids)
+            # each doc is only in its first category
+            self.assertEqual(docids & seen, set())
+            seen.update(docids)
+        # every app got a category
+        enquire = xapian.Enquire(self.db.xapiandb)
+        enquire.set_query(all_apps)
+        apps = set([m.docid for m in enquire.get_mset(0, len(self.db))])
+        self.assertTrue(apps.issubset(seen))
+        # only the given docids are categorised
+        some_docid = sorted(apps)[0]
+        categorised = categorise_documents(
+            self.db, cats_and_queries, set([some_docid]))
+        self.assertEqual(len(categorised), 1)
+        self.assertEqual(categorised[0][1], [some_docid])
+
+    def test_categorise_documents_with_added_database(self):
+        # the docids in a added database differ from the docids in the
+        # combined database
+        extra_db = xapian.inmemory_open()
+        doc = xapian.Document()
+        doc.add_term("ATapplication")
+        doc.add_term("XTextra")
+        doc.add_value(XapianValues.PKGNAME, "extra-pkg")
+        extra_db.add_document(doc)
+        self.db.add_database(extra_db)
+        (extra_docid,) = [
+            m.docid for m in self.db.xapiandb.postlist("XTextra")]
+        categorised = categorise_documents(
+            self.db, [("extra", xapian.Query("XTextra"))],
+            set([extra_docid]))
+        self.assertEqual(len(categorised), 1)
+        (cat, docids, docs) = categorised[0]
+        self.assertEqual(docids, [extra_docid])
+        self.assertEqual(self.db.get_pkgname(docs[0]), "extra-pkg")
+
+    def test_category_statistics(self):
+        parser = CategoriesParser(self.db)
+        cats = parser.parse_applications_menu(DATA_DIR)
+        stats = CategoryStatistics(self.db)
+        # finding the non-empty ones does not count the documents
+        with patch.object(self.db, "get_matches_count") as mock_count:
+            non_empty = stats.get_non_empty(cats)
+            self.assertFalse(mock_count.called)
+        self.assertNotEqual(non_empty, [])
+        for cat in cats:
+            enquire = xapian.Enquire(self.db.xapiandb)
+            enquire.set_query(cat.query)
+            nr_docs = len(enquire.get_mset(0, len(self.db)))
+            self.assertEqual(stats.get_stats(cat).nr_docs, nr_docs)
+            self.assertEqual(cat in non_empty, nr_docs > 0)
+            self.assertTrue(stats.get_stats(cat).nr_apps <= nr_docs)
+        # the stats are cached until the db is reopened
+        with patch.object(self.db, "has_matches") as mock_has_matches:
+            stats.get_stats(cats[0]).empty
+            self.assertFalse(mock_has_matches.called)
+            self.db.reopen()
+            mock_has_matches.return_value = False
+            self.assertTrue(stats.get_stats(cats[0]).empty)
+            self.assertTrue(mock_has_matches.called)
+        # and are separate for the supported-only filter
+        global_filter = get_global_filter()
+        self.addCleanup(setattr, global_filter, "supported_only", False)
+        global_filter.supported_only = True
+        supported = xapian.Query(
+            xapian.Query.OP_AND,
+            xapian.Query(""),
+            softwarecenter.distro.get_distro().get_supported_query())
+        self.assertEqual(
+            stats.get_stats_for_query(xapian.Query("")).nr_docs,
+            self.db.get_matches_count(supported))
+
 
 class TestCatParsing(unittest.TestCase):
     """ tests the "where is it in the menu" code """
@@ -82,6 +174,33 @@ class TestCatParsing(unittest.TestCase):
         for doc in docs:
             self.assertEqual(type(doc), xapian.Document)
 
+    def test_disk_cache(self):
+        def describe(cats):
+            return [(cat.untranslated_name, cat.name, cat.flags,
+                     str(cat.query), describe(cat.subcategories))
+                    for cat in cats]
+        parser = CategoriesParser(self.db)
+        cats = parser.parse_applications_menu(DATA_DIR, use_cache=False)
+        get_background_save_worker().flush()
+        # a new process only reads the cache
+        with patch.dict(CategoriesParser.CATEGORIES_PARSER_CACHE,
+                        clear=True):
+            with patch.object(CategoriesParser,
+                              "_parse_menu_files") as mock_parse:
+                cached_cats = CategoriesParser(
+                    self.db).parse_applications_menu(DATA_DIR)
+                self.assertFalse(mock_parse.called)
+        self.assertEqual(describe(cached_cats), describe(cats))
+        # but parses again if e.g. the region changed
+        with patch.dict(CategoriesParser.CATEGORIES_PARSER_CACHE,
+                        clear=True):
+            parser = CategoriesParser(self.db)
+            parser._template_dict["CURRENT_REGION"] = "zz"
+            with patch.object(CategoriesParser, "_parse_menu_files",
+                              return_value=[]) as mock_parse:
+                parser.parse_applications_menu(DATA_DIR)
+                self.assertTrue(mock_parse.called)
+
 
 class TestCategoryTemplates(unittest.TestCase):
 
@@ -1,7 +1,13 @@
+import shutil
+import tempfile
 import unittest
+import xapian
+
+from mock import patch
 
 from tests.utils import (
     get_test_db,
+    get_test_pkg_info,
     setup_test_env,
 )
 setup_test_env()
@@ -29,6 +35,51 @@ class TestChannels(unittest.TestCase):
         channels_installed = m.channels_installed_only
         self.assertNotEqual(channels_installed, [])
 
+    def test_channels_cache(self):
+        from softwarecenter.backend.channel_impl.aptchannels import (
+            AptChannelsManager)
+        db = get_test_db()
+        m = AptChannelsManager(db)
+        channels = m.channels
+        # the same channels until the db is reopened or the channels change
+        self.assertEqual(
+            [id(c) for c in m.channels], [id(c) for c in channels])
+        m.backend.emit("channels-changed", True)
+        self.assertNotEqual(
+            [id(c) for c in m.channels], [id(c) for c in channels])
+        channels = m.channels
+        db.reopen()
+        self.assertNotEqual(
+            [id(c) for c in m.channels], [id(c) for c in channels])
+
+    def test_channel_origins_metadata(self):
+        from softwarecenter.db.database import StoreDatabase
+        from softwarecenter.db.update import update_channel_origins_metadata
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        db = xapian.WritableDatabase(tmpdir, xapian.DB_CREATE_OR_OVERWRITE)
+        for (label, origin) in (("Ubuntu", "Ubuntu"), ("Foo", "foo-ppa")):
+            doc = xapian.Document()
+            doc.add_term("XOL" + label)
+            doc.add_term("XOO" + origin)
+            db.add_document(doc)
+        update_channel_origins_metadata(db)
+        # channels of documents added later are looked up in the termlist
+        doc = xapian.Document()
+        doc.add_term("XOLBar")
+        db.add_document(doc)
+        db.flush()
+        store_db = StoreDatabase(tmpdir, get_test_pkg_info())
+        store_db.open(use_axi=False, use_agent=False)
+        self.assertEqual(store_db.get_channel_origins(),
+                         [("Bar", ""), ("Foo", "foo-ppa"),
+                          ("Ubuntu", "Ubuntu")])
+        with patch("softwarecenter.db.database."
+                   "get_channel_origin_from_termlist") as mock_lookup:
+            mock_lookup.return_value = ""
+            store_db._channel_origins = None
+            store_db.get_channel_origins()
+            self.assertEqual(mock_lookup.call_count, 1)
 
 if __name__ == "__main__":
     unittest.main()
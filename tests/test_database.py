@@ -1,6 +1,7 @@
 import apt
 import os
 import re
+import shutil
 import tempfile
 import time
 import unittest
@@ -8,7 +9,7 @@ import xapian
 
 from gi.repository import GLib
 from piston_mini_client import PistonResponseObject
-from mock import Mock, patch
+from mock import Mock, PropertyMock, patch
 
 from tests.utils import (
     DATA_DIR,
@@ -25,17 +26,28 @@ setup_test_env()
 import softwarecenter.paths
 import softwarecenter.distro
 
+from softwarecenter.db.appfilter import AppFilter
 from softwarecenter.db.application import Application, AppDetails
 from softwarecenter.db.database import StoreDatabase
 from softwarecenter.db.enquire import AppEnquire
-from softwarecenter.db.database import parse_axi_values_file
+from softwarecenter.db.database import (
+    get_display_name_sort_key,
+    is_same_locale,
+    parse_axi_values_file,
+)
 from softwarecenter.db.pkginfo import get_pkg_info, _Version
 from softwarecenter.db.update import (
+    DatabaseIndexer,
+    get_system_collation_locale,
+    rebuild_database,
+    update,
+    update_database_incrementally,
     update_from_app_install_data,
     update_from_var_lib_apt_lists,
     update_from_appstream_xml,
     update_from_json_string,
     update_from_software_center_agent,
+    AppStreamXMLParser,
     SCAPurchasedApplicationParser,
     SCAApplicationParser,
     )
@@ -44,6 +56,8 @@ from softwarecenter.db.utils import (
     get_installed_apps_list,
 )
 from softwarecenter.enums import (
+    AVAILABLE_FOR_PURCHASE_MAGIC_CHANNEL_NAME,
+    AppInfoFields,
     NonAppVisibility,
     PkgStates,
     XapianValues,
@@ -112,6 +126,53 @@ class TestDatabase(unittest.TestCase):
         else:
             self.fail("Did not find scope file in Xapian database")
 
+    def test_update_adds_display_name_sort_key(self):
+        datadir = os.path.join(DATA_DIR, "desktop")
+        db = get_test_db_from_app_install_data(datadir)
+        for it in db.postlist("APsoftware-center"):
+            doc = db.get_document(it.docid)
+            self.assertEqual(
+                doc.get_value(XapianValues.DISPLAY_NAME_SORT_KEY),
+                get_display_name_sort_key(doc.get_data()))
+            break
+        else:
+            self.fail("Did not find software-center in Xapian database")
+
+    def test_display_name_sort_key_unicode(self):
+        # the SCA and AppStream parsers give unicode names
+        self.assertEqual(get_display_name_sort_key(u"\xdcber"),
+                         get_display_name_sort_key("\xc3\x9cber"))
+
+    def test_system_collation_locale(self):
+        fd, filename = tempfile.mkstemp()
+        self.addCleanup(os.remove, filename)
+        with os.fdopen(fd, "w") as f:
+            f.write('# set by the installer\nLANG="en_US.UTF-8"\n')
+        self.assertEqual(get_system_collation_locale(filename), "en_US.UTF-8")
+        self.assertEqual(get_system_collation_locale("/no/such/file"), None)
+
+    def test_display_name_sort_key_locale_mismatch(self):
+        # the keys are not used if the locale of the user differs from
+        # the one the database was built with, the LocaleSorter is used
+        # instead
+        db = get_test_db()
+        with patch("softwarecenter.db.database.get_sort_key_locale") as mock:
+            mock.return_value = "no-such-locale"
+            self.assertFalse(db.has_display_name_sort_key)
+
+    def test_display_name_sort_key_locale_spelling(self):
+        # the same locale spelled differently still uses the keys
+        db = get_test_db()
+        with patch.object(StoreDatabase, "xapiandb",
+                          new_callable=PropertyMock) as mock_xapiandb:
+            mock_xapiandb.return_value.get_metadata.return_value = \
+                "en_US.UTF-8"
+            with patch("softwarecenter.db.database.get_sort_key_locale",
+                       return_value="en_US.utf8"):
+                self.assertTrue(db.has_display_name_sort_key)
+        self.assertTrue(is_same_locale("de_DE.utf8", "de_DE.UTF-8"))
+        self.assertFalse(is_same_locale("de_DE.UTF-8", "en_US.UTF-8"))
+
     def test_regression_index_terms(self):
         """ this tests for a regression that we had in the term indexer
             that would index hundrets of size 1 terms due to a bug
@@ -128,6 +189,119 @@ class TestDatabase(unittest.TestCase):
         for t in db.termlist(docid):
             self.assertFalse(len(t.term) == 1)
 
+    def test_update_uses_one_indexer(self):
+        db = xapian.inmemory_open()
+        with patch("softwarecenter.db.update.DatabaseIndexer",
+                   wraps=DatabaseIndexer) as mock_indexer:
+            update(db, self.cache, os.path.join(DATA_DIR, "desktop"))
+        self.assertEqual(mock_indexer.call_count, 1)
+        self.assertTrue(db.get_doccount() > 1)
+
+    def test_indexer_batch_commit(self):
+        indexer = DatabaseIndexer(xapian.inmemory_open(), batch_size=2)
+        db = indexer.db = Mock()
+        for i in range(5):
+            indexer.add_document(xapian.Document())
+        self.assertEqual(indexer.nr_docs, 5)
+        self.assertEqual(db.flush.call_count, 2)
+        indexer.commit()
+        self.assertEqual(db.flush.call_count, 3)
+        # nothing pending
+        indexer.commit()
+        self.assertEqual(db.flush.call_count, 3)
+
+    def test_rebuild_database_parallel(self):
+        datadir = os.path.join(DATA_DIR, "desktop")
+        dbs = []
+        for jobs in (1, 3):
+            pathname = os.path.join(tempfile.mkdtemp(), "xapian")
+            os.makedirs(pathname)
+            self.assertTrue(rebuild_database(
+                pathname, appinfo_dir=datadir, jobs=jobs))
+            dbs.append(xapian.Database(pathname))
+        serial, parallel = dbs
+        self.assertEqual(serial.get_doccount(), parallel.get_doccount())
+        self.assertEqual(serial.get_metadata("popcon_max_desktop"),
+                         parallel.get_metadata("popcon_max_desktop"))
+        # same documents with the same docids
+        for it in serial.postlist(""):
+            self.assertEqual(
+                [t.term for t in serial.termlist(it.docid)],
+                [t.term for t in parallel.termlist(it.docid)])
+        # and the same search results
+        for term in ("APsoftware-center", "ATapplication", "ubuntu"):
+            results = []
+            for db in dbs:
+                enquire = xapian.Enquire(db)
+                enquire.set_query(xapian.Query(term))
+                results.append([m.docid for m in enquire.get_mset(0, 100)])
+            self.assertEqual(results[0], results[1])
+
+    def test_rebuild_database_popcon_max(self):
+        datadir = os.path.join(DATA_DIR, "desktop")
+        # a appstream source with a higher popcon than all debian ones
+        appstream_xml = os.path.join(tempfile.mkdtemp(), "appdata.xml")
+        with open(appstream_xml, "w") as f:
+            f.write(open(os.path.join(DATA_DIR, "app-info", "appdata.xml"))
+                    .read().replace("<pkgname>",
+                                    "<popcon>1000000</popcon><pkgname>"))
+        popcon_maxs = []
+        with patch.dict(AppStreamXMLParser.MAPPING,
+                        {AppInfoFields.POPCON: "popcon"}):
+            with patch("softwarecenter.db.update._get_appstream_xml_path",
+                       return_value=appstream_xml):
+                for (appstream_sources, jobs) in ((False, 1), (True, 1),
+                                                  (True, 3)):
+                    pathname = os.path.join(tempfile.mkdtemp(), "xapian")
+                    os.makedirs(pathname)
+                    self.assertTrue(rebuild_database(
+                        pathname, appstream_sources=appstream_sources,
+                        appinfo_dir=datadir, jobs=jobs))
+                    db = xapian.Database(pathname)
+                    popcon_maxs.append(xapian.sortable_unserialise(
+                        db.get_metadata("popcon_max_desktop")))
+        # only the debian sources count, serial and parallel
+        self.assertTrue(0 < popcon_maxs[0] < 1000000)
+        self.assertEqual(popcon_maxs, [popcon_maxs[0]] * 3)
+
+    def test_update_database_incrementally(self):
+        datadir = os.path.join(tempfile.mkdtemp(), "desktop")
+        shutil.copytree(os.path.join(DATA_DIR, "desktop"), datadir)
+        pathname = os.path.join(tempfile.mkdtemp(), "xapian")
+        os.makedirs(pathname)
+        # a empty dir needs a full rebuild
+        self.assertFalse(update_database_incrementally(pathname, datadir))
+        self.assertTrue(rebuild_database(pathname, appinfo_dir=datadir))
+        # remove one file and change another one
+        os.remove(os.path.join(datadir, "ubuntu-software-center.desktop"))
+        with open(os.path.join(datadir, "zynjacku.desktop"), "a") as f:
+            f.write("X-AppInstall-Popcon=12345\n")
+        self.assertTrue(update_database_incrementally(pathname, datadir))
+        # the result is the same as a full rebuild
+        fullpath = os.path.join(tempfile.mkdtemp(), "xapian")
+        os.makedirs(fullpath)
+        self.assertTrue(rebuild_database(fullpath, appinfo_dir=datadir))
+        incremental = xapian.Database(pathname)
+        full = xapian.Database(fullpath)
+        self.assertEqual(incremental.get_doccount(), full.get_doccount())
+        self.assertEqual(incremental.get_termfreq("APsoftware-center"), 0)
+        self.assertEqual(incremental.get_metadata("popcon_max_desktop"),
+                         full.get_metadata("popcon_max_desktop"))
+        self.assertEqual(
+            sorted([t.term for t in incremental.allterms("AP")]),
+            sorted([t.term for t in full.allterms("AP")]))
+        # unchanged sources are not reindexed
+        indexed = incremental.get_lastdocid()
+        self.assertTrue(update_database_incrementally(pathname, datadir))
+        self.assertEqual(xapian.Database(pathname).get_lastdocid(), indexed)
+        # the update is done in a copy that replaces the database
+        self.assertFalse(os.path.exists(pathname + "_rb"))
+        self.assertFalse(os.path.exists(pathname + "_old"))
+        # the apt data in the documents is outdated once the lists change
+        with patch("softwarecenter.db.update.get_apt_state_stamp") as mock:
+            mock.return_value = "changed"
+            self.assertFalse(update_database_incrementally(pathname, datadir))
+
     def test_update_from_appstream_xml(self):
         db = xapian.inmemory_open()
         res = update_from_appstream_xml(db, self.cache,
@@ -496,12 +670,141 @@ app-popcon	4	# app-install .desktop popcon rank
         self.assertTrue(len(enquirer.get_docids()) > 0)
         # FIXME: test more of the interface
 
+    def test_get_matches_count(self):
+        db = get_test_db()
+        query = xapian.Query("ATapplication")
+        enquire = xapian.Enquire(db.xapiandb)
+        enquire.set_query(query)
+        expected = len(enquire.get_mset(0, len(db)))
+        self.assertEqual(db.get_matches_count(query), expected)
+        self.assertEqual(db.get_matches_count("ATapplication"), expected)
+        self.assertEqual(db.get_matches_count(""), len(db))
+        self.assertTrue(db.get_matches_count(query, exact=False) > 0)
+
     def test_is_pkgname_known(self):
         db = StoreDatabase(cache=self.cache)
         db.open()
         self.assertTrue(db.is_pkgname_known("apt"))
         self.assertFalse(db.is_pkgname_known("i+am-not-a-pkg"))
 
+    def test_get_installed_apps(self):
+        db = StoreDatabase(cache=self.cache)
+        db.open()
+        # same result as a scan over all documents
+        expected = set()
+        for doc in db:
+            pkgname = db.get_pkgname(doc)
+            if (db.get_appname(doc) and pkgname in self.cache and
+                    self.cache[pkgname].is_installed):
+                expected.add(db.get_application(doc))
+        installed = db.get_installed_apps()
+        self.assertEqual(installed, expected)
+        # the index is updated for removed packages
+        app = list(installed)[0]
+        with patch.object(db, "_aptcache", {}):
+            db.update_installed_apps([app.pkgname])
+        self.assertFalse(app in db.get_installed_apps())
+        # and on cache-ready
+        self.cache.emit("cache-ready")
+        self.assertEqual(db.get_installed_apps(), expected)
+
+    def test_get_xapian_document(self):
+        db = StoreDatabase(cache=self.cache)
+        db.open()
+
+        def lookup_by_postlists(appname, pkgname):
+            for m in db.xapiandb.postlist("AA" + appname):
+                doc = db.xapiandb.get_document(m.docid)
+                if doc.get_value(XapianValues.PKGNAME) == pkgname:
+                    return m.docid
+            for m in db.xapiandb.postlist("AP" + pkgname):
+                doc = db.xapiandb.get_document(m.docid)
+                if doc.get_value(XapianValues.PKGNAME) == pkgname:
+                    return m.docid
+            for m in db.xapiandb.postlist("XP" + pkgname):
+                return m.docid
+        pairs = []
+        for doc in db:
+            pkgname = db.get_pkgname(doc)
+            if not pkgname:
+                continue
+            pairs.append((db.get_appname(doc) or "", pkgname))
+            # a unknown appname falls back to the pkgname
+            pairs.append(("no-such-app", pkgname))
+        docs = db.get_xapian_documents(pairs)
+        for ((appname, pkgname), doc) in zip(pairs, docs):
+            self.assertEqual(doc.get_docid(),
+                             lookup_by_postlists(appname, pkgname))
+            self.assertEqual(
+                db.get_xapian_document(appname, pkgname).get_docid(),
+                doc.get_docid())
+        self.assertEqual(db.get_xapian_documents([("", "no-such-pkg")]),
+                         [None])
+        self.assertRaises(IndexError, db.get_xapian_document,
+                          "", "no-such-pkg")
+        # the index is dropped on reopen
+        db.reopen()
+        self.assertEqual(db._docid_index, {})
+
+    def test_app_filter_docids(self):
+        db = StoreDatabase(cache=self.cache)
+        db.open()
+        # same result as looking at the pkgname of each document
+        installed = set()
+        available = set()
+        for doc in db:
+            pkgname = db.get_pkgname(doc)
+            if pkgname in self.cache:
+                available.add(doc.get_docid())
+                if self.cache[pkgname].is_installed:
+                    installed.add(doc.get_docid())
+            elif (doc.get_value(XapianValues.ARCHIVE_CHANNEL) ==
+                    AVAILABLE_FOR_PURCHASE_MAGIC_CHANNEL_NAME):
+                available.add(doc.get_docid())
+        self.assertEqual(db.get_filter_docids("installed"), installed)
+        self.assertEqual(db.get_filter_docids("available"), available)
+        app_filter = AppFilter(db, self.cache)
+        app_filter.set_installed_only(True)
+        app_filter.set_restricted_list(set(["software-center"]))
+        for doc in db:
+            self.assertEqual(
+                app_filter(doc),
+                (doc.get_docid() in installed and
+                 db.get_pkgname(doc) == "software-center"))
+        # the sets are rebuild once the cache is ready again
+        self.cache.emit("cache-ready")
+        self.assertEqual(db._filter_docids, {})
+        self.assertEqual(db.get_filter_docids("installed"), installed)
+
+    def test_app_filter_with_added_database(self):
+        db = StoreDatabase(cache=self.cache)
+        db.open()
+        installed_pkgname = sorted(db.get_filter_pkgnames("installed"))[0]
+        # the docids of the documents in a added database differ from
+        # their docids in the combined database
+        extra_db = xapian.inmemory_open()
+        for pkgname in (installed_pkgname, "no-such-pkg"):
+            doc = xapian.Document()
+            doc.add_term("AP" + pkgname)
+            doc.add_value(XapianValues.PKGNAME, pkgname)
+            doc.add_value(XapianValues.APPNAME, "Extra App")
+            extra_db.add_document(doc)
+        db.add_database(extra_db)
+        app_filter = AppFilter(db, self.cache)
+        app_filter.set_installed_only(True)
+        enquire = xapian.Enquire(db.xapiandb)
+        enquire.set_query(xapian.Query(""))
+        matches = enquire.get_mset(0, len(db), None, app_filter)
+        installed = db.get_filter_docids("installed")
+        for m in matches:
+            self.assertTrue(m.docid in installed)
+            self.assertTrue(
+                db.get_pkgname(m.document) in
+                db.get_filter_pkgnames("installed"))
+        extra_pkgnames = [db.get_pkgname(m.document) for m in matches
+                          if db.get_appname(m.document) == "Extra App"]
+        self.assertEqual(extra_pkgnames, [installed_pkgname])
+
 
 class UtilsTestCase(unittest.TestCase):
 
@@ -948,6 +1251,20 @@ class DBSearchTestCase(unittest.TestCase):
                                nonblocking_load=False)
         self.assertEqual(len(self.enquire._matches), 2)
 
+    def test_get_exact_matches(self):
+        pkgs = ["apt", "gedit", "no-such-pkg?foo"]
+        terms = self.db.get_pkgname_terms(pkgs)
+        self.assertEqual(terms[2], "XPno-such-pkg")
+        for term in terms[:2]:
+            self.assertTrue(self.db.xapiandb.term_exists(term))
+        matches = self.db.get_exact_matches(pkgs)
+        self.assertEqual(len(matches), 3)
+        self.assertEqual(self.db.get_pkgname(matches[0].document), "apt")
+        self.assertEqual(self.db.get_pkgname(matches[1].document), "gedit")
+        # unknown pkgnames are returned as a Application
+        self.assertEqual(matches[2].document.pkgname, "no-such-pkg")
+        self.assertEqual(matches[2].document.request, "foo")
+
 
 if __name__ == "__main__":
     unittest.main()
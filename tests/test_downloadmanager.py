@@ -0,0 +1,166 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from tests.utils import (
+    do_events,
+    setup_test_env,
+)
+setup_test_env()
+
+from softwarecenter.backgroundsave import get_background_save_worker
+from softwarecenter.downloadmanager import (
+    DownloadManager,
+    PRIORITY_HIGH,
+    PRIORITY_LOW,
+)
+
+
+class FakeHTTPServer(ThreadingMixIn, HTTPServer):
+    """ serves "content of <path>" with a ETag, requests for paths
+        starting with /block wait until unblock is set
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FakeHTTPRequestHandler)
+        self.requests = []
+        self.not_modified = 0
+        self.unblock = threading.Event()
+        self.unblock.set()
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%s" % self.server_port
+
+
+class FakeHTTPRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        if self.path.startswith("/block"):
+            server.unblock.wait()
+        content = "content of %s" % self.path
+        etag = '"%s"' % len(content)
+        try:
+            if self.headers.get("If-None-Match") == etag:
+                with server.lock:
+                    server.not_modified += 1
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        finally:
+            with server.lock:
+                server.running -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache_dir = os.path.join(self.tmpdir, "download-cache")
+        self.server = FakeHTTPServer()
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.addCleanup(self.server.shutdown)
+        self.results = []
+
+    def _get_manager(self, **kwargs):
+        return DownloadManager(cache_dir=self.cache_dir, **kwargs)
+
+    def _download(self, manager, name, priority=50):
+        manager.download(self.server.url + "/" + name,
+                         os.path.join(self.cache_dir, name),
+                         lambda path, error: self.results.append(
+                             (name, error)),
+                         priority)
+
+    def _wait_for_results(self, n):
+        for i in range(100):
+            do_events()
+            if len(self.results) >= n:
+                return
+            time.sleep(0.05)
+        self.fail("only got %s of %s results" % (len(self.results), n))
+
+    def test_download_and_revalidate(self):
+        manager = self._get_manager()
+        self._download(manager, "icon.png")
+        self._wait_for_results(1)
+        self.assertEqual(self.results, [("icon.png", None)])
+        path = os.path.join(self.cache_dir, "icon.png")
+        self.assertEqual(open(path).read(), "content of /icon.png")
+        # a fresh file is used right away
+        self._download(manager, "icon.png")
+        self.assertEqual(len(self.results), 2)
+        self.assertEqual(len(self.server.requests), 1)
+        # a stale one is revalidated with its etag
+        manager.max_age = 0
+        self._download(manager, "icon.png")
+        self._wait_for_results(3)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.not_modified, 1)
+
+    def test_deduplicate(self):
+        self.server.unblock.clear()
+        manager = self._get_manager()
+        for i in range(3):
+            self._download(manager, "block-1")
+        self.server.unblock.set()
+        self._wait_for_results(3)
+        self.assertEqual(self.server.requests, ["/block-1"])
+
+    def test_priority_and_per_host_limit(self):
+        self.server.unblock.clear()
+        manager = self._get_manager(max_per_host=1)
+        self._download(manager, "block-first")
+        # wait until the first download is running
+        while not self.server.requests:
+            time.sleep(0.01)
+        self._download(manager, "thumbnail", PRIORITY_LOW)
+        self._download(manager, "screenshot", PRIORITY_HIGH)
+        self.server.unblock.set()
+        self._wait_for_results(3)
+        self.assertEqual(self.server.requests,
+                         ["/block-first", "/screenshot", "/thumbnail"])
+        self.assertEqual(self.server.max_running, 1)
+
+    def test_cache_size_limit(self):
+        size = len("content of /a")
+        manager = self._get_manager(max_cache_bytes=2 * size)
+        for name in ("a", "b", "c"):
+            self._download(manager, name)
+            self._wait_for_results(len(self.results) + 1)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ["b", "c"])
+        # the index is kept for the next run
+        self.assertTrue(get_background_save_worker().flush())
+        manager = self._get_manager(max_cache_bytes=2 * size)
+        self.assertEqual(manager._cache_bytes, 2 * size)
+
+
+if __name__ == "__main__":
+    unittest.main()
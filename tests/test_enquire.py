@@ -1,7 +1,11 @@
+import threading
 import time
 import unittest
 import xapian
 
+from gi.repository import GLib
+from mock import patch
+
 from tests.utils import (
     get_test_db,
     get_test_pkg_info,
@@ -36,6 +40,83 @@ class TestEnquire(unittest.TestCase):
         # give the threads a bit of time
         time.sleep(5)
 
+    def test_app_enquire_query_complete_once(self):
+        db = get_test_db()
+        cache = get_test_pkg_info()
+        enquirer = AppEnquire(cache, db)
+        completed = []
+        enquirer.connect("query-complete",
+                         lambda enq: completed.append(len(enq.matches)))
+        for term in ["app", "foo", "game"]:
+            enquirer.set_query(xapian.Query(term), limit=0)
+        self.assertEqual(len(completed), 3)
+        # the worker threads are reused for each query
+        names = [t.name for t in threading.enumerate()
+                 if t.name.startswith("ThreadedQuery-")]
+        self.assertTrue(len(names) <= 2)
+
+    def test_app_enquire_superseded_query(self):
+        db = get_test_db()
+        cache = get_test_pkg_info()
+        enquirer = AppEnquire(cache, db)
+        completed = []
+        enquirer.connect("query-complete",
+                         lambda enq: completed.append(enq.search_query))
+        # simulate typing: start a new query while the first one waits
+        # for its worker in the main loop
+        GLib.idle_add(lambda: enquirer.set_query(xapian.Query("fire")) and
+                      False)
+        enquirer.set_query(xapian.Query("fir"))
+        self.assertEqual(len(completed), 1)
+        # xapian.Query has no __eq__, compare the descriptions
+        self.assertEqual([str(q) for q in completed[0]],
+                         [str(xapian.Query("fire"))])
+
+    def test_app_enquire_result_cache(self):
+        db = get_test_db()
+        cache = get_test_pkg_info()
+        enquirer = AppEnquire(cache, db)
+        completed = []
+        enquirer.connect("query-complete",
+                         lambda enq: completed.append(enq.get_docids()))
+        for i in range(2):
+            enquirer.set_query(xapian.Query("ATapplication"), limit=0)
+        result_cache = enquirer._result_cache
+        self.assertEqual((result_cache.hits, result_cache.misses), (1, 1))
+        self.assertEqual(len(completed), 2)
+        self.assertEqual(completed[0], completed[1])
+        self.assertEqual(enquirer.matches[0].document.get_docid(),
+                         completed[0][0])
+        # a different limit is a different query
+        enquirer.set_query(xapian.Query("ATapplication"), limit=1)
+        self.assertEqual(result_cache.misses, 2)
+        # the results are dropped once the cache is ready again
+        cache.emit("cache-ready")
+        enquirer.set_query(xapian.Query("ATapplication"), limit=0)
+        self.assertEqual((result_cache.hits, result_cache.misses), (1, 3))
+
+    def test_app_enquire_result_cache_is_shared(self):
+        db = get_test_db()
+        cache = get_test_pkg_info()
+        with patch.object(db, "connect") as mock_db_connect:
+            with patch.object(cache, "connect") as mock_cache_connect:
+                enquirers = [AppEnquire(cache, db) for i in range(3)]
+        # one cache for the database that connects to the signals once
+        self.assertTrue(all(enq._result_cache is enquirers[0]._result_cache
+                            for enq in enquirers))
+        self.assertEqual(mock_db_connect.call_count, 1)
+        self.assertEqual(mock_cache_connect.call_count, 1)
+        # a query of one enquirer is a cache hit for the others
+        enquirers[0].set_query(xapian.Query("ATapplication"), limit=0)
+        enquirers[1].set_query(xapian.Query("ATapplication"), limit=0)
+        self.assertEqual(enquirers[1]._result_cache.hits, 1)
+        self.assertEqual(enquirers[1].get_docids(),
+                         enquirers[0].get_docids())
+        # a different database gets its own cache
+        other_enquirer = AppEnquire(cache, get_test_db())
+        self.assertFalse(other_enquirer._result_cache is
+                         enquirers[0]._result_cache)
+
 
 if __name__ == "__main__":
     unittest.main()
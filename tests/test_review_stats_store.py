@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from tests.utils import (
+    setup_test_env,
+)
+setup_test_env()
+
+from softwarecenter.backend.reviews.stats_store import (
+    FLAG_MISSING_HISTOGRAM,
+    ReviewStatsStore,
+)
+
+
+class TestReviewStatsStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "review-stats.bin")
+
+    def test_missing_file(self):
+        store = ReviewStatsStore(self.path)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.get("foo"), None)
+        self.assertFalse("foo" in store)
+
+    def test_write_and_lookup(self):
+        items = [
+            ("zynjacku", (4.5, 10, [0, 0, 1, 3, 6], 4.1)),
+            ("apt", (None, 0, [0, 0, 0, 0, 0], 3.0)),
+            ("software-center", (3.0, 2, [0, 1, 0, 1], 3.2)),
+        ]
+        ReviewStatsStore.write(self.path, items, FLAG_MISSING_HISTOGRAM)
+        # no temp files are left behind
+        self.assertEqual(os.listdir(self.tmpdir), ["review-stats.bin"])
+        store = ReviewStatsStore(self.path)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.flags, FLAG_MISSING_HISTOGRAM)
+        self.assertEqual(store.get("zynjacku"),
+                         (4.5, 10, [0, 0, 1, 3, 6], 4.1))
+        self.assertEqual(store.get("apt"), (None, 0, [0, 0, 0, 0, 0], 3.0))
+        # short histograms are padded
+        self.assertEqual(store.get("software-center")[2], [0, 1, 0, 1, 0])
+        self.assertEqual(store.get("ap"), None)
+        self.assertEqual(store.get("zzz"), None)
+        self.assertEqual([pkgname for (pkgname, record) in store.iteritems()],
+                         ["apt", "software-center", "zynjacku"])
+
+    def test_reopen_after_write(self):
+        ReviewStatsStore.write(self.path, [("apt", (1.0, 1, [1], 2.0))])
+        store = ReviewStatsStore(self.path)
+        ReviewStatsStore.write(self.path, [("gimp", (5.0, 1, [], 4.0))])
+        # the old mapping stays valid until reopened
+        self.assertTrue("apt" in store)
+        store.open()
+        self.assertFalse("apt" in store)
+        self.assertTrue("gimp" in store)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,57 @@
+import pickle
+import socket
+import sys
+import threading
 import unittest
 
-from mock import patch
+from mock import Mock, patch
 
 from tests.utils import (
+    do_events_with_sleep,
     setup_test_env,
 )
 setup_test_env()
-from softwarecenter.backend.spawn_helper import SpawnHelper
+from softwarecenter.backend.framing import FrameReader, pack_frame
+from softwarecenter.backend.spawn_helper import (
+    PistonHelperDaemon,
+    SpawnHelper,
+)
+
+BIG_REPLY_SCRIPT = """
+import pickle, sys
+sys.stdout.write(pickle.dumps(range(200000)))
+"""
+
+FRAMED_REPLY_SCRIPT = """
+import pickle, struct, sys
+data = pickle.dumps({"foo": "bar"})
+sys.stdout.write(struct.pack("!I", len(data)) + data + "trailing garbage")
+"""
+
+FAILING_FRAMED_SCRIPT = """
+import struct, sys
+sys.stdout.write(struct.pack("!I", 100) + "partial")
+sys.stderr.write("failed")
+sys.exit(1)
+"""
+
+
+def fake_daemon(sock, replies):
+    """ answer each request with replies[func] in reverse order, a reply
+        of None closes the connection without answering
+    """
+    reader = FrameReader()
+    requests = []
+    while len(requests) < len(replies):
+        requests.extend(pickle.loads(p)
+                        for p in reader.feed(sock.recv(1024)))
+    for request in reversed(requests):
+        if replies[request["func"]] is None:
+            break
+        response = {"id": request["id"]}
+        response.update(replies[request["func"]])
+        sock.sendall(pack_frame(pickle.dumps(response)))
+    sock.close()
 
 
 class TestSpawnHelper(unittest.TestCase):
@@ -23,7 +68,149 @@ class TestSpawnHelper(unittest.TestCase):
             self.assertEqual(cmd[3], 'RatingsAndReviewsAPI')
             self.assertEqual(cmd[4], 'review_stats')
             self.assertEqual(cmd[5], '{"days": 6}')
+            self.assertEqual(cmd[-1], "--framed")
+        # only the generic helper call is framed
+        self.assertFalse(spawn_helper.framed)
+
+
+    def _run_and_wait(self, spawn_helper, script):
+        signals = []
+        spawn_helper.connect(
+            "data-available", lambda h, d: signals.append(("data", d)))
+        spawn_helper.connect(
+            "exited", lambda h, res: signals.append(("exited", res)))
+        spawn_helper.run([sys.executable, "-c", script])
+        while len(signals) < 2:
+            do_events_with_sleep(iterations=1)
+        return signals
+
+    def test_read_big_reply(self):
+        spawn_helper = SpawnHelper()
+        signals = self._run_and_wait(spawn_helper, BIG_REPLY_SCRIPT)
+        self.assertEqual(signals[0], ("data", range(200000)))
+        self.assertEqual(signals[1], ("exited", 0))
+
+    def test_read_framed_reply(self):
+        spawn_helper = SpawnHelper()
+        spawn_helper.framed = True
+        signals = self._run_and_wait(
+            spawn_helper, FRAMED_REPLY_SCRIPT)
+        self.assertEqual(signals, [("data", {"foo": "bar"}), ("exited", 0)])
+
+    def test_failed_framed_helper(self):
+        spawn_helper = SpawnHelper()
+        spawn_helper.framed = True
+        signals = []
+        spawn_helper.connect(
+            "data-available", lambda h, d: signals.append(("data", d)))
+        spawn_helper.connect(
+            "error", lambda h, err: signals.append(("error", err)))
+        spawn_helper.run([sys.executable, "-c", FAILING_FRAMED_SCRIPT])
+        while not signals:
+            do_events_with_sleep(iterations=1)
+        do_events_with_sleep()
+        # the partial reply is dropped
+        self.assertEqual(signals, [("error", "failed")])
+
+    def test_frame_reader(self):
+        data = pack_frame("x" * 5000) + pack_frame("") + pack_frame("abc")
+        reader = FrameReader()
+        payloads = []
+        for i in range(0, len(data), 7):
+            payloads.extend(reader.feed(data[i:i + 7]))
+        self.assertEqual(payloads, ["x" * 5000, "", "abc"])
+        self.assertEqual(reader.buffered, 0)
+
+
+class TestPistonHelperDaemon(unittest.TestCase):
+
+    def _make_daemon(self, replies):
+        daemon = PistonHelperDaemon()
+
+        def spawn_daemon(child_sock):
+            sock = socket.fromfd(child_sock.fileno(), socket.AF_UNIX,
+                                 socket.SOCK_STREAM)
+            t = threading.Thread(target=fake_daemon, args=(sock, replies))
+            t.daemon = True
+            t.start()
+            return Mock()
+        daemon._spawn_daemon = spawn_daemon
+        return daemon
+
+    def test_daemon_only_gets_the_socket(self):
+        daemon = PistonHelperDaemon()
+        (sock, child_sock) = socket.socketpair()
+        self.addCleanup(sock.close)
+        self.addCleanup(child_sock.close)
+        with patch("subprocess.Popen") as mock_popen:
+            daemon._spawn_daemon(child_sock)
+        (cmd,), kwargs = mock_popen.call_args
+        self.assertEqual(cmd[-2:], ["--daemon", "0"])
+        self.assertEqual(kwargs["stdin"], child_sock.fileno())
+        self.assertTrue(kwargs["close_fds"])
 
+    def test_daemon_multiplexes_calls(self):
+        daemon = self._make_daemon({
+            "review_stats": {"data": ["stats"]},
+            "get_usefulness": {"error": "no data"},
+        })
+        stats_helper = SpawnHelper()
+        usefulness_helper = SpawnHelper()
+        signals = []
+        stats_helper.connect(
+            "data-available", lambda h, d: signals.append(("stats", d)))
+        usefulness_helper.connect(
+            "error", lambda h, e: signals.append(("usefulness", e)))
+        with patch("softwarecenter.backend.spawn_helper."
+                   "get_piston_helper_daemon", return_value=daemon):
+            stats_helper.run_generic_piston_helper(
+                "RatingsAndReviewsAPI", "review_stats", days=1)
+            usefulness_helper.run_generic_piston_helper(
+                "RatingsAndReviewsAPI", "get_usefulness", username="foo")
+        do_events_with_sleep()
+        self.assertEqual(
+            sorted(signals),
+            [("stats", ["stats"]), ("usefulness", "no data")])
+
+    def test_daemon_big_reply(self):
+        # the fake daemon closes the connection right after the reply
+        daemon = self._make_daemon({
+            "review_stats": {"data": range(200000)},
+        })
+        spawn_helper = SpawnHelper()
+        signals = []
+        spawn_helper.connect(
+            "data-available", lambda h, d: signals.append(d))
+        on_io = daemon._on_io
+        with patch.object(daemon, "_on_io") as mock_on_io:
+            mock_on_io.side_effect = on_io
+            with patch.object(spawn_helper, "run") as mock_run:
+                with patch("softwarecenter.backend.spawn_helper."
+                           "get_piston_helper_daemon", return_value=daemon):
+                    spawn_helper.run_generic_piston_helper(
+                        "RatingsAndReviewsAPI", "review_stats", days=1)
+                while not signals:
+                    do_events_with_sleep(iterations=1)
+        self.assertEqual(signals, [range(200000)])
+        # the reply is read in several main loop iterations and is not
+        # redone when the daemon exits while it is deserialized
+        self.assertTrue(mock_on_io.call_count > 2)
+        self.assertFalse(mock_run.called)
+
+    def test_fallback_when_daemon_dies(self):
+        # the fake daemon exits without replying once it got one request
+        daemon = self._make_daemon({"review_stats": None})
+        spawn_helper = SpawnHelper()
+        with patch.object(spawn_helper, "run") as mock_run:
+            with patch("softwarecenter.backend.spawn_helper."
+                       "get_piston_helper_daemon", return_value=daemon):
+                spawn_helper.run_generic_piston_helper(
+                    "RatingsAndReviewsAPI", "review_stats", days=6)
+                do_events_with_sleep()
+            self.assertFalse(daemon.running)
+            cmd = mock_run.call_args[0][0]
+            self.assertEqual(cmd[3:], ['RatingsAndReviewsAPI', 'review_stats',
+                                       '{"days": 6}', '--framed'])
 
 
 if __name__ == "__main__":
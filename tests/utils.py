@@ -283,6 +283,8 @@ def setup_test_env():
     os.environ["PYTHONPATH"] = basedir
     softwarecenter.paths.datadir = os.path.join(basedir, "data")
     softwarecenter.paths.SOFTWARE_CENTER_CACHE_DIR = tempfile.mkdtemp()
+    # run one piston helper per call unless a test asks for the daemon
+    os.environ["SOFTWARE_CENTER_DISABLE_PISTON_HELPER_DAEMON"] = "1"
 
 
 # factory stuff for the agent
@@ -23,7 +23,9 @@ import logging
 import os
 import json
 import pickle
+import socket
 import sys
+import threading
 
 
 # useful for debugging
@@ -32,7 +34,7 @@ if "SOFTWARE_CENTER_DEBUG_HTTP" in os.environ:
 
 import piston_mini_client.auth
 import piston_mini_client.failhandlers
-from piston_mini_client.failhandlers import APIError
+from piston_mini_client.failhandlers import APIError, UnauthorizedError
 
 try:
     import softwarecenter
@@ -45,6 +47,7 @@ except ImportError:
 import softwarecenter.paths
 from softwarecenter.paths import SOFTWARE_CENTER_CACHE_DIR
 
+from softwarecenter.backend.framing import FrameReader, pack_frame
 from softwarecenter.backend.ubuntusso import UbuntuSSO
 
 # the piston import
@@ -74,6 +77,184 @@ SoftwareCenterRecommenderAPI # pyflakes
 
 LOG = logging.getLogger(__name__)
 
+
+class PistonHelperError(Exception):
+    pass
+
+
+class PistonHelperTokenError(PistonHelperError):
+    """ no oauth token could be obtained """
+
+
+class PistonHelperAuthError(PistonHelperError):
+    """ the server did not accept the oauth token """
+
+
+# the api objects are reused by the daemon mode, each api object is only
+# used by one thread at a time. The api objects with a oauth token are
+# dropped once the server rejects the token so that the next call logs
+# in again
+_apis = {}
+_apis_lock = threading.Lock()
+# held while the api object of a key (and its oauth token) is created, so
+# concurrent requests for it wait for the first one and reuse its api
+_api_create_locks = {}
+# only one login (with its own main loop and maybe a dialog) at a time
+_login_lock = threading.Lock()
+
+
+def get_oauth_token(parent_xid, no_relogin):
+    with _login_lock:
+        helper = UbuntuSSO(parent_xid)
+        return helper.get_oauth_token_and_verify_sync(no_relogin=no_relogin)
+
+
+def get_api(klass_name, needs_auth=False, no_relogin=False, parent_xid=0,
+            ignore_cache=False):
+    """ return a (api, lock) tuple for the given piston api class """
+    key = (klass_name, needs_auth, ignore_cache)
+    with _apis_lock:
+        if key in _apis:
+            return _apis[key]
+        create_lock = _api_create_locks.setdefault(key, threading.Lock())
+    with create_lock:
+        with _apis_lock:
+            if key in _apis:
+                return _apis[key]
+        api = _create_api(klass_name, needs_auth, no_relogin, parent_xid,
+                          ignore_cache)
+        with _apis_lock:
+            _apis[key] = (api, threading.Lock())
+            return _apis[key]
+
+
+def _create_api(klass_name, needs_auth, no_relogin, parent_xid,
+                ignore_cache):
+    if ignore_cache:
+        cachedir = None
+    else:
+        cachedir = os.path.join(SOFTWARE_CENTER_CACHE_DIR, "piston-helper")
+    klass = globals()[klass_name]
+    if needs_auth:
+        token = get_oauth_token(parent_xid, no_relogin)
+        # if we don't have a token, error here
+        if not token:
+            raise PistonHelperTokenError(
+                "ERROR: can not obtain a oauth token")
+        auth = piston_mini_client.auth.OAuthAuthorizer(
+            token["token"], token["token_secret"],
+            token["consumer_key"], token["consumer_secret"])
+        api = klass(cachedir=cachedir, auth=auth)
+    else:
+        api = klass(cachedir=cachedir)
+    return api
+
+
+def forget_api(klass_name, needs_auth=False, ignore_cache=False):
+    """ drop the cached api object, the next get_api() creates a new one
+        (and gets a new oauth token if needed)
+    """
+    with _apis_lock:
+        _apis.pop((klass_name, needs_auth, ignore_cache), None)
+
+
+def call_api(klass, func, kwargs=None, needs_auth=False, no_relogin=False,
+             parent_xid=0, ignore_cache=False, disable_offline_mode=False):
+    """ call func of the given api class and return the piston reply,
+        raises PistonHelperError on failure
+    """
+    args = (klass, func, kwargs, needs_auth, no_relogin, parent_xid,
+            ignore_cache, disable_offline_mode)
+    try:
+        return _call_api(*args)
+    except PistonHelperAuthError as e:
+        if not needs_auth:
+            raise
+        # the token got invalid, log in again and retry once
+        LOG.info("oauth token rejected (%s), logging in again" % e)
+        return _call_api(*args)
+
+
+def _call_api(klass, func, kwargs, needs_auth, no_relogin, parent_xid,
+              ignore_cache, disable_offline_mode):
+    (api, lock) = get_api(klass, needs_auth, no_relogin, parent_xid,
+                          ignore_cache)
+    piston_reply = None
+    with lock:
+        # handle the args
+        f = getattr(api, func)
+        try:
+            piston_reply = f(**(kwargs or {}))
+        except httplib2.ServerNotFoundError as e:
+            if not disable_offline_mode:
+                # switch to offline mode and try again from the cache
+                try:
+                    api._offline_mode = True
+                    piston_reply = f(**(kwargs or {}))
+                except Exception as e:
+                    LOG.warn(e)
+                    raise PistonHelperError(str(e))
+                finally:
+                    api._offline_mode = False
+        except UnauthorizedError as e:
+            LOG.warn(e)
+            forget_api(klass, needs_auth, ignore_cache)
+            raise PistonHelperAuthError(str(e))
+        except APIError as e:
+            LOG.warn(e)
+            raise PistonHelperError(str(e))
+        except:
+            LOG.exception("urclient_apps")
+            raise PistonHelperError("%s.%s failed" % (klass, func))
+
+    # no data is a error, the server does always return something,
+    # this can happen if e.g. we try cached data but have nothing
+    # in the cache
+    if piston_reply is None:
+        LOG.warn("no data")
+        raise PistonHelperError("no data")
+    return piston_reply
+
+
+def _handle_daemon_request(sock, write_lock, request):
+    request_id = request.pop("id")
+    try:
+        response = {"id": request_id, "data": call_api(**request)}
+    except PistonHelperError as e:
+        response = {"id": request_id, "error": str(e)}
+    except:
+        LOG.exception("daemon request %r failed", request)
+        response = {"id": request_id, "error": "unexpected error"}
+    try:
+        payload = pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
+    except:
+        LOG.exception("can not pickle reply")
+        payload = pickle.dumps({"id": request_id, "error": "bad reply"})
+    with write_lock:
+        sock.sendall(pack_frame(payload))
+
+
+def run_daemon(fd):
+    """ serve framed, pickled request dicts from the socket fd until the
+        parent closes it, each request is handled in its own thread so
+        calls to different apis do not wait for each other
+    """
+    sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(fd)
+    write_lock = threading.Lock()
+    reader = FrameReader()
+    while True:
+        chunk = sock.recv(64 * 1024)
+        if not chunk:
+            break
+        for payload in reader.feed(chunk):
+            t = threading.Thread(target=_handle_daemon_request,
+                                 args=(sock, write_lock,
+                                       pickle.loads(payload)))
+            t.daemon = True
+            t.start()
+
+
 if __name__ == "__main__":
     logging.basicConfig()
 
@@ -95,10 +276,16 @@ if __name__ == "__main__":
                         help="do not attempt relogin if token is invalid")
     parser.add_argument("--output", default="pickle",
                         help="output result as [pickle|json|text]")
+    parser.add_argument("--framed", action="store_true", default=False,
+                        help="write the output as a single length prefixed "
+                             "frame")
     parser.add_argument("--parent-xid", default=0,
                         help="xid of the parent window")
-    parser.add_argument('klass', help='class to use')
-    parser.add_argument('function', help='function to call')
+    parser.add_argument("--daemon", type=int, default=None, metavar="FD",
+                        help="serve requests from the given socket fd "
+                             "instead of doing a single call")
+    parser.add_argument('klass', nargs="?", help='class to use')
+    parser.add_argument('function', nargs="?", help='function to call')
     parser.add_argument('kwargs', nargs="?",
                         help='kwargs for the function call as json')
     args = parser.parse_args()
@@ -107,65 +294,30 @@ if __name__ == "__main__":
         logging.basicConfig(level=logging.DEBUG)
         LOG.setLevel(logging.DEBUG)
 
-    if args.ignore_cache:
-        cachedir = None
-    else:
-        cachedir = os.path.join(SOFTWARE_CENTER_CACHE_DIR, "piston-helper")
-        
-    # check what we need to call
-    klass = globals()[args.klass]
-    func = args.function
-    kwargs = json.loads(args.kwargs or '{}')
-
     softwarecenter.paths.datadir = args.datadir
 
-    if args.needs_auth:
-        helper = UbuntuSSO(args.parent_xid)
-        token = helper.get_oauth_token_and_verify_sync(
-            no_relogin=args.no_relogin)
-        # if we don't have a token, error here
-        if not token:
-            # it may happen that the parent is closed already so the pipe
-            # is gone, that is ok as we exit anyway
-            try:
-                sys.stderr.write("ERROR: can not obtain a oauth token\n")
-            except IOError:
-                pass
-            sys.exit(1)
+    if args.daemon is not None:
+        run_daemon(args.daemon)
+        sys.exit(0)
+
+    if not args.klass or not args.function:
+        parser.error("klass and function are required")
 
-        auth = piston_mini_client.auth.OAuthAuthorizer(
-            token["token"], token["token_secret"],
-            token["consumer_key"], token["consumer_secret"])
-        api = klass(cachedir=cachedir, auth=auth)
-    else:
-        api = klass(cachedir=cachedir)
-        
-    piston_reply = None
-    # handle the args
-    f = getattr(api, func)
     try:
-        piston_reply = f(**kwargs)
-    except httplib2.ServerNotFoundError as e:
-        if not args.disable_offline_mode:
-            # switch to offline mode and try again from the cache
-            try:
-                api._offline_mode = True
-                piston_reply = f(**kwargs)
-            except Exception as e:
-                LOG.warn(e)
-                sys.exit(1)
-    except APIError as e:
-        LOG.warn(e)
+        piston_reply = call_api(
+            args.klass, args.function, json.loads(args.kwargs or '{}'),
+            needs_auth=args.needs_auth, no_relogin=args.no_relogin,
+            parent_xid=args.parent_xid, ignore_cache=args.ignore_cache,
+            disable_offline_mode=args.disable_offline_mode)
+    except PistonHelperTokenError as e:
+        # it may happen that the parent is closed already so the pipe
+        # is gone, that is ok as we exit anyway
+        try:
+            sys.stderr.write("%s\n" % e)
+        except IOError:
+            pass
         sys.exit(1)
-    except:
-        LOG.exception("urclient_apps")
-        sys.exit(1)
-
-    # no data is a error, the server does always return something,
-    # this can happen if e.g. we try cached data but have nothing
-    # in the cache
-    if piston_reply is None:
-        LOG.warn("no data")
+    except PistonHelperError:
         sys.exit(1)
 
     if args.debug:
@@ -187,7 +339,11 @@ if __name__ == "__main__":
 
     # and output it
     try:
-        print res
+        if args.framed:
+            sys.stdout.write(pack_frame(res))
+            sys.stdout.flush()
+        else:
+            print res
     except IOError:
         # this can happen if the parent gets killed, no need to trigger
         # apport for this